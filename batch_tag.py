@@ -2,42 +2,288 @@
 them in the tei_files directory with the same name, but with ".tei" added to the end
 
 txt_files directory should be in your current working directory.
+
+Files are tagged in parallel by batch_workers worker processes, each with its own Wolfram kernels.
+Progress is journaled to a manifest in batch_state_dir, so rerunning after an interruption only
+tags the files that weren't finished or whose contents changed.
+
+Tagging and rendering are separate stages: each file is first tagged into a standoff annotation
+file in annotation_dir, then its TEI document is rendered from the text and the annotations.
+render_tei.py can render every file again later (e.g. after changing how entities are marked up)
+without a kernel.
+
+The entities of every file are recorded in a durable entity registry. With incremental_index set,
+an existing TEI index is only extended with the entities it doesn't have yet; otherwise it's
+rebuilt from scratch. Removing files from txt_files needs a full rebuild to drop their entities.
+
+A summary of where the run spent its time is printed at the end, and saved in the Prometheus text
+format to metrics_path. Setting profile_interval samples the stacks of every worker that often (in
+seconds) into batch_state_dir/profiles, in the collapsed format flame graph tools read.
 """
 import os
 import json
-from src.ner.flair_ner import NamedEntityRecognizer
-from src.tei.assemble_document import create_document
+import multiprocessing.util
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from src.ner.entity_registry import EntityRegistry
+from src.ner.flair_ner import NamedEntityRecognizer, load_seen_entities
+from src.ner.wlflairshim import SequenceTagger, DEFAULT_BATCH_BYTES
+from src.tei.assemble_document import annotate_document, render_annotated_file
 from src.tei.assemble_tei_index import IndexAssembler
+from src.tei.template_registry import TemplateRegistry
+from src.utils.job_manifest import JobManifest, hash_file
+from src.utils.metrics import metrics, SamplingProfiler
+from src.wiki.entity_store import EntityStore
+
+# NamedEntityRecognizer of a worker process, created by init_worker
+ner = None
+
+def create_ner(settings):
+    return NamedEntityRecognizer(
+        settings['wolfram_kernel_path'],
+        settings['content_types_precedence_order'],
+        settings['minimum_confidence'],
+        settings['generate_tei_index'],
+        settings['tei_index_name'],
+        batch_bytes=settings.get('kernel_batch_bytes', DEFAULT_BATCH_BYTES),
+        kernel_pool_size=settings.get('kernel_pool_size', 1),
+        kernel_licence_limit=settings.get('kernel_licence_limit'),
+        tagger_cache_dir=settings.get('tagger_cache_dir'),
+        tagger_backend=settings.get('tagger_backend', 'wolfram'),
+        tagger_options=settings.get('tagger_options'),
+        prefilter=settings.get('prefilter_paragraphs', False),
+        gazetteer_mode=settings.get('gazetteer_mode', 'off'),
+        chunk_chars=settings.get('kernel_chunk_chars'),
+        chunk_overlap=settings.get('kernel_chunk_overlap', 200),
+        kernel_session_options=settings.get('kernel_session'),
+        dedup=settings.get('dedup_paragraphs', False),
+        dedup_boilerplate=settings.get('dedup_boilerplate', False)
+    )
+
+def get_registry_path(settings):
+    return settings.get('entity_registry_path',
+                        os.path.join(settings.get('batch_state_dir', 'batch_state'), 'entities.sqlite'))
+
+def init_worker(settings):
+    """Start the kernels of a worker process, and stop them when the worker exits. The gazetteer
+    is seeded with the surface forms of every entity tagged in earlier runs, and xml:ids are given
+    out through the entity registry.
+    """
+    global ner
+    ner = create_ner(settings)
+    multiprocessing.util.Finalize(ner, ner.close, exitpriority=10)
+    if settings.get('profile_interval'):
+        profile_dir = os.path.join(settings.get('batch_state_dir', 'batch_state'), 'profiles')
+        os.makedirs(profile_dir, exist_ok=True)
+        profiler = SamplingProfiler(settings['profile_interval'])
+        profiler.start()
+        multiprocessing.util.Finalize(profiler, save_profile, args=(profiler, os.path.join(
+            profile_dir, f"worker-{os.getpid()}.folded")), exitpriority=20)
+    registry = EntityRegistry(get_registry_path(settings))
+    if ner.gazetteer_mode != 'off':
+        ner.load_gazetteer(registry.get_surface_forms())
+    if ner.generate_index:
+        # Workers claim the xml:ids of new entities in the registry, so entities that strip to the
+        # same xml:id get different ones even if two workers meet them at once
+        ner.set_xml_id_registry(registry)
+        multiprocessing.util.Finalize(registry, registry.close, exitpriority=5)
+    else:
+        registry.close()
+
+def get_annotation_dir(settings):
+    return settings.get('annotation_dir', os.path.join(settings.get('batch_state_dir', 'batch_state'),
+                                                       'annotations'))
+
+def save_profile(profiler, path):
+    profiler.stop()
+    profiler.save(path)
 
-with open('settings.json', 'r') as f:
-    settings = json.load(f)
-
-ner = NamedEntityRecognizer(
-    settings['wolfram_kernel_path'],
-    settings['content_types_precedence_order'],
-    settings['minimum_confidence'],
-    settings['generate_tei_index'],
-    settings['tei_index_name']
-)
-filenames = next(os.walk("txt_files"))[2]
-for filename in filenames:
-    print("Now tagging", filename)
-    with open(f"./tei_files/{filename}.tei", "w") as output_file:
+def tag_file(settings, filename, input_hash, annotation_path, output_path, shard_path):
+    """Tag one file in a worker process into an annotation file, render its TEI document, and save
+    the entities seen in it to a shard file. Returns the kernel utilisation, gazetteer and dedup
+    counters and metrics of the worker.
+    """
+    ner.clear_seen_entities()
+    with open(annotation_path, "wb") as annotation_file:
         with open(f"./txt_files/{filename}", "r") as book:
-            content = book.read()
-        output_file.write(create_document(ner, content, title=filename))
-print("All files in txt_files directory tagged.")
-if settings['generate_tei_index'] == True:
-    with open(f"./tei_files/{settings['tei_index_name']}.tei", 'w') as output_file:
+            annotate_document(ner, book, annotation_file, input_hash, title=filename)
+    render_annotated_file(f"./txt_files/{filename}", annotation_path, output_path,
+                          use_lxml=settings.get('use_lxml_builder', False),
+                          stream=settings.get('stream_documents', False))
+    ner.save_seen_entities(shard_path)
+    return (os.getpid(), ner.get_kernel_stats(), ner.get_gazetteer_stats(), ner.get_dedup_stats(),
+            metrics.snapshot())
+
+def get_worker_count(settings):
+    """Get the number of worker processes to run, keeping the total number of kernels within the
+    licence limit
+    """
+    workers = settings.get('batch_workers', 1)
+    licence_limit = settings.get('kernel_licence_limit')
+    if licence_limit != None:
+        workers = min(workers, licence_limit // settings.get('kernel_pool_size', 1))
+    return max(workers, 1)
+
+def tag_files(settings, manifest, shard_dir, annotation_dir):
+    """Tag every file in txt_files that isn't done yet, in parallel"""
+    jobs = dict()
+    for filename in sorted(next(os.walk("txt_files"))[2]):
+        input_hash = hash_file(f"./txt_files/{filename}")
+        if manifest.is_done(filename, input_hash):
+            print("Skipping unchanged", filename)
+            continue
+        jobs[filename] = input_hash
+    if not jobs:
+        return
+
+    kernel_stats = dict()
+    gazetteer_stats = dict()
+    dedup_stats = dict()
+    # Latest metrics of each worker, which include everything the worker did before
+    worker_metrics = dict()
+    with ProcessPoolExecutor(max_workers=get_worker_count(settings), initializer=init_worker,
+                             initargs=(settings,)) as executor:
+        futures = dict()
+        for filename, input_hash in jobs.items():
+            output_path = f"./tei_files/{filename}.tei"
+            shard_path = os.path.join(shard_dir, f"{filename}.wxf")
+            annotation_path = os.path.join(annotation_dir, f"{filename}.ann")
+            manifest.record(filename, 'started', input_hash=input_hash)
+            future = executor.submit(tag_file, settings, filename, input_hash, annotation_path,
+                                     output_path, shard_path)
+            futures[future] = (filename, input_hash, annotation_path, output_path, shard_path)
+        for future in as_completed(futures):
+            filename, input_hash, annotation_path, output_path, shard_path = futures[future]
+            try:
+                worker, stats, worker_gazetteer_stats, worker_dedup_stats, snapshot = future.result()
+            except Exception as error:
+                print("Failed to tag", filename, error)
+                manifest.record(filename, 'failed', input_hash=input_hash, error=repr(error))
+                continue
+            kernel_stats[worker] = stats
+            gazetteer_stats[worker] = worker_gazetteer_stats
+            dedup_stats[worker] = worker_dedup_stats
+            worker_metrics[worker] = snapshot
+            manifest.record(filename, 'done', input_hash=input_hash, output_path=output_path,
+                            shard_path=shard_path, annotation_path=annotation_path)
+            print("Tagged", filename)
+    for snapshot in worker_metrics.values():
+        metrics.merge(snapshot)
+    for worker, stats in sorted(kernel_stats.items()):
+        for kernel_index, kernel in enumerate(stats):
+            print(f"Worker {worker} kernel {kernel_index}: {kernel['paragraphs']} paragraphs in",
+                  f"{kernel['evaluations']} evaluations, {kernel['utilisation']:.0%} busy,",
+                  f"{kernel['restarts']} restarts")
+    for worker, stats in sorted(gazetteer_stats.items()):
+        if stats['paragraphs']:
+            print(f"Worker {worker} gazetteer: {stats['hit_rate']:.0%} of entities and",
+                  f"{stats['resolved_paragraphs']} of {stats['paragraphs']} paragraphs resolved",
+                  f"without the tagger, {stats['surface_forms']} surface forms")
+    # Dedup counters are cumulative per worker, like the gazetteer's
+    paragraphs = sum(stats['paragraphs'] for stats in dedup_stats.values())
+    if paragraphs:
+        duplicates = sum(stats['duplicates'] for stats in dedup_stats.values())
+        boilerplate = sum(stats['boilerplate'] for stats in dedup_stats.values())
+        print(f"Dedup: {duplicates} duplicate and {boilerplate} boilerplate paragraphs of {paragraphs}",
+              f"not tagged ({(duplicates + boilerplate) / paragraphs:.0%})")
+
+def register_shards(manifest, registry):
+    """Record the seen_entities shard of every finished file in the entity registry, unless it was
+    already recorded for the same input. Files are registered in name order, so the registry
+    doesn't depend on which worker finished first.
+    """
+    document_hashes = registry.get_document_hashes()
+    for job in manifest.get_done_jobs():
+        if document_hashes.get(job['file']) == job['input_hash']:
+            continue
+        seen_entities, occurrences, surface_forms = load_seen_entities(job['shard_path'])
+        registry.add_document(job['file'], seen_entities, occurrences, job['input_hash'], surface_forms)
+    registry.remove_documents_except(next(os.walk("txt_files"))[2])
+
+def create_index(settings, registry):
+    index_path = f"./tei_files/{settings['tei_index_name']}.tei"
+    incremental = settings.get('incremental_index', False) and os.path.exists(index_path)
+    if incremental:
+        with open(index_path, 'r') as index_file:
+            index_text = index_file.read()
+        seen_entities = registry.get_entities(unindexed_only=True)
+        print(f"Adding {len(seen_entities)} new entities to the TEI index")
+    else:
+        registry.clear_indexed()
+        seen_entities = registry.get_entities()
         print("Creating TEI index")
-        assembler = IndexAssembler(ner.tagger.session)
-        output_file.write(assembler.create_index(
-            ner.get_seen_entities(),
-            settings['tei_index_title'],
-            settings['tei_index_author'],
-            settings['tei_index_sponsor'],
-            settings['tei_index_authority'],
-            settings['tei_index_licence'],
-            settings['tei_index_ref_type']
-        ))
-ner.close()
\ No newline at end of file
+
+    with open(index_path, 'w') as output_file:
+        # The kernel only starts if some Wikidata IDs aren't cached yet, and doesn't need TextContents
+        tagger = SequenceTagger(settings['wolfram_kernel_path'], settings.get('tagger_cache_dir'),
+                                {**(settings.get('kernel_session') or dict()), 'eager': False, 'warm_up': False})
+        entity_store = None
+        if settings.get('wikidata_store_path'):
+            ttl_days = settings.get('wikidata_ttl_days')
+            entity_store = EntityStore(settings['wikidata_store_path'],
+                                       ttl_days * 24 * 60 * 60 if ttl_days != None else None,
+                                       settings.get('wikidata_store_max_entities'),
+                                       settings.get('wikidata_offline', False))
+        assembler = IndexAssembler(tagger.session,
+                                   TemplateRegistry(settings.get('tei_index_template_dir')),
+                                   settings.get('wikidata_base_url', 'https://www.wikidata.org/'),
+                                   settings.get('wikidata_workers', 4),
+                                   entity_store,
+                                   tagger.cache)
+        if incremental:
+            output_file.write(assembler.update_index(index_text, seen_entities,
+                                                     settings['tei_index_ref_type']))
+        elif settings.get('index_render_workers', 1) > 1:
+            shard_dir = settings.get('index_shard_dir')
+            if shard_dir != None:
+                os.makedirs(shard_dir, exist_ok=True)
+            assembler.write_index(
+                output_file,
+                seen_entities,
+                settings['tei_index_title'],
+                settings['tei_index_author'],
+                settings['tei_index_sponsor'],
+                settings['tei_index_authority'],
+                settings['tei_index_licence'],
+                settings['tei_index_ref_type'],
+                settings['index_render_workers'],
+                shard_dir
+            )
+        else:
+            output_file.write(assembler.create_index(
+                seen_entities,
+                settings['tei_index_title'],
+                settings['tei_index_author'],
+                settings['tei_index_sponsor'],
+                settings['tei_index_authority'],
+                settings['tei_index_licence'],
+                settings['tei_index_ref_type']
+            ))
+        registry.mark_indexed(set(seen_entities) - assembler.failed_urns)
+        if entity_store != None:
+            entity_store.close()
+        tagger.close()
+
+if __name__ == '__main__':
+    with open('settings.json', 'r') as f:
+        settings = json.load(f)
+
+    state_dir = settings.get('batch_state_dir', 'batch_state')
+    shard_dir = os.path.join(state_dir, 'shards')
+    annotation_dir = get_annotation_dir(settings)
+    os.makedirs(shard_dir, exist_ok=True)
+    os.makedirs(annotation_dir, exist_ok=True)
+    manifest = JobManifest(os.path.join(state_dir, 'manifest.jsonl'))
+    registry = EntityRegistry(get_registry_path(settings))
+
+    tag_files(settings, manifest, shard_dir, annotation_dir)
+    print("All files in txt_files directory tagged.")
+    register_shards(manifest, registry)
+    if settings['generate_tei_index'] == True:
+        create_index(settings, registry)
+    registry.close()
+    manifest.close()
+    print("Run metrics:")
+    print(metrics.format_summary())
+    if settings.get('metrics_path'):
+        with open(settings['metrics_path'], 'w') as metrics_file:
+            metrics_file.write(metrics.to_prometheus())
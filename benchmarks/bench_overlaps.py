@@ -0,0 +1,108 @@
+"""bench_overlaps.py - Compares the old all-pairs overlap resolution against the sweep-line one in
+src/ner/overlaps.py on synthetic entity lists, and checks that both keep the same entities when no
+overlaps are chained.
+
+Run from the repository root: python -m benchmarks.bench_overlaps [--sizes 10000 100000]
+"""
+import argparse
+import functools
+import json
+import random
+import time
+from src.ner.overlaps import resolve_overlaps
+
+with open('settings.json', 'r') as f:
+    type_precedence = json.load(f)['content_types_precedence_order']
+
+def legacy_remove_entity_overlaps(entities_in, type_precedence):
+    """The original NamedEntityRecognizer.remove_entity_overlaps, kept here for comparison"""
+    def is_overlapping(x1, x2, y1, y2):
+        return x1 <= y2 and y1 <= x2
+
+    def compare_entities(e1, e2):
+        if len(e1['text']) > len(e2['text']):
+            return 1
+        elif len(e1['text']) < len(e2['text']):
+            return -1
+        elif type_precedence.index(e1['type']) < type_precedence.index(e2['type']):
+            return 1
+        elif type_precedence.index(e1['type']) > type_precedence.index(e2['type']):
+            return -1
+        elif e1['confidence'] > e2['confidence']:
+            return 1
+        elif e1['confidence'] < e2['confidence']:
+            return -1
+        else:
+            return 0
+
+    entities_out = []
+    all_overlaps = set()
+    for entity in entities_in:
+        overlapping_entities = set()
+        for other_entity in entities_in:
+            if entity != other_entity and is_overlapping(
+                entity['start_pos'], entity['end_pos'], other_entity['start_pos'], other_entity['end_pos']):
+                overlapping_entities.add(tuple(other_entity.items()))
+        if len(overlapping_entities) > 0:
+            overlapping_entities.add(tuple(entity.items()))
+            all_overlaps.add(tuple(sorted(overlapping_entities)))
+        else:
+            entities_out.append(entity)
+
+    for overlapping_set in all_overlaps:
+        entities = [dict(tup) for tup in overlapping_set]
+        entities_out.append(sorted(entities, key=functools.cmp_to_key(compare_entities))[-1])
+    return sorted(entities_out, key=lambda entity: entity['start_pos'])
+
+def make_entities(count, rng):
+    """Make a shuffled list of about count synthetic entities. Overlapping entities come in groups
+    that all share a common position, so no overlaps are chained.
+    """
+    entities = []
+    position = 0
+    while len(entities) < count:
+        center = position + 12
+        for _ in range(rng.choice([1, 1, 2, 3, 4])):
+            start = center - rng.randint(0, 10)
+            end = center + rng.randint(1, 10)
+            entities.append({
+                'text': 'x' * (end - start),
+                'start_pos': start,
+                'end_pos': end,
+                'type': rng.choice(type_precedence),
+                'confidence': rng.random()
+            })
+        position = center + 12
+    rng.shuffle(entities)
+    return entities
+
+def time_call(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[2000, 10000, 25000, 50000, 100000])
+    parser.add_argument('--legacy-max', type=int, default=2000,
+                        help='largest size to run the quadratic legacy implementation on. It takes '
+                             'about a second at 2000 entities and 25 times that at 10000')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    for size in args.sizes:
+        entities = make_entities(size, rng)
+        new_output, new_seconds = time_call(resolve_overlaps, entities, type_precedence)
+        line = f"{len(entities):>7} spans: sweep {new_seconds:8.3f}s"
+        if size <= args.legacy_max:
+            old_output, old_seconds = time_call(legacy_remove_entity_overlaps, entities, type_precedence)
+            same = ([tuple(sorted(e.items())) for e in old_output] ==
+                    [tuple(sorted(e.items())) for e in new_output])
+            line += f"  legacy {old_seconds:8.3f}s  speedup {old_seconds / new_seconds:8.1f}x  same winners: {same}"
+        else:
+            line += "  legacy skipped"
+        print(line)
+
+if __name__ == '__main__':
+    main()
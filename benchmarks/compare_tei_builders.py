@@ -0,0 +1,81 @@
+"""compare_tei_builders.py - Builds the TEI document for a corpus with both the BeautifulSoup and
+the lxml body builders in src/tei/assemble_tei.py, checks that the output is byte-for-byte the same
+and reports how long each builder took.
+
+Entities are placed on capitalized words and numbers of each paragraph, so no Wolfram kernel is
+needed. Run from the repository root:
+    python -m benchmarks.compare_tei_builders [--corpus txt_files]
+"""
+import argparse
+import os
+import re
+import time
+from wolframclient.language import wl
+from src.ner.entity_record import EntityRecord
+from src.tei.assemble_tei import create_header, create_body, create_xml
+
+SAMPLE_TEXT = """We left Cairo on the 3rd of March 1850 & sailed 120 miles up the Nile to Thebes.
+
+Mr. Lane told us the Great Pyramid at Giza was built for Khufu <or so they say>.
+
+Today I saw the Louvre's collection, which cost 3 pounds to see."""
+
+def annotate(paragraph, paragraph_number):
+    """Make a Flair-like annotated paragraph with synthetic entities of every interpretation kind"""
+    entities = []
+    for word_number, match in enumerate(re.finditer(r'[A-Z][a-z]+|\d+', paragraph)):
+        word = match.group()
+        kind = (paragraph_number + word_number) % 5
+        if word.isdigit():
+            if kind % 2:
+                entity_type, interpretation = 'Quantity', wl.Quantity(int(word), 'Miles')
+            else:
+                entity_type, interpretation = 'Date', wl.DateObject((int(word), 3, 1), 'Day')
+        elif kind == 0:
+            entity_type, interpretation = 'Person', word
+        elif kind == 1:
+            entity_type, interpretation = 'City', wl.GeoPosition((30.04, 31.23))
+        else:
+            entity_type, interpretation = 'City', wl.Entity('City', (word, 'Egypt'))
+        entities.append(EntityRecord.from_tagger_entity({
+            'text': word,
+            'start_pos': match.start(),
+            'end_pos': match.end(),
+            'type': entity_type,
+            'confidence': 1.0,
+            'interpretation': interpretation,
+            'ref': None if kind == 0 else f'urn:teiindex:testTeiIndex:{word}'
+        }))
+    return {'text': paragraph, 'entities': entities}
+
+def build(flair_output, use_lxml):
+    start = time.perf_counter()
+    document = create_xml(create_header(title='Comparison'), create_body(flair_output, use_lxml))
+    return document, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--corpus', help='directory of text files to use instead of the sample text')
+    args = parser.parse_args()
+
+    documents = {'sample': SAMPLE_TEXT}
+    if args.corpus:
+        documents = {}
+        for filename in sorted(os.listdir(args.corpus)):
+            with open(os.path.join(args.corpus, filename), 'r') as book:
+                documents[filename] = book.read().replace('\r', '')
+
+    all_same = True
+    for name, text in documents.items():
+        flair_output = [annotate(paragraph, number)
+                        for number, paragraph in enumerate(re.split(r'\n{2,}', text))]
+        soup_document, soup_seconds = build(flair_output, use_lxml=False)
+        lxml_document, lxml_seconds = build(flair_output, use_lxml=True)
+        same = soup_document == lxml_document
+        all_same = all_same and same
+        print(f"{name}: soup {soup_seconds:.3f}s  lxml {lxml_seconds:.3f}s  identical: {same}")
+    if not all_same:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
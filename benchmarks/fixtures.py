@@ -0,0 +1,305 @@
+"""fixtures.py - Corpora, tagger recordings and Wikidata data for the benchmarks, so they run the
+same way every time without a Wolfram kernel or network access
+
+A fixture is a list of paragraphs, the TextContents responses for them (replayed through
+backends.ReplayTagger), and canned Wikidata data: the Wikidata ID of each Wolfram entity (answered
+by FakeSession in place of the kernel) and the JSON of each Wikidata entity (served by
+WikidataStandIn in place of wikidata.org). Fixtures are either made up by make_synthetic_fixture,
+or recorded from a real kernel and wikidata.org by record_fixture.
+"""
+import json
+import random
+import threading
+import urllib.parse
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from wolframclient.language import wl
+from src.ner.backends import RecordingTagger
+from src.ner.entity_record import to_wolfram_entity
+from src.tei.assemble_tei_index import IndexAssembler, wiki_pids, linked_entity_props
+
+FIRST_NAMES = ['Amelia', 'Lucie', 'Gustave', 'Florence', 'Edward', 'Harriet', 'Auguste', 'Isabella',
+               'Richard', 'Maxime', 'William', 'Marianne', 'John', 'Sophia', 'Karl', 'Emily']
+LAST_NAMES = ['Edwards', 'Gordon', 'Flaubert', 'Nightingale', 'Lane', 'Martineau', 'Mariette',
+              'Bird', 'Burton', 'Camp', 'Thackeray', 'North', 'Wilkinson', 'Poole', 'Lepsius', 'Eden']
+PLACES = {
+    'City': ['Cairo', 'Luxor', 'Aswan', 'Alexandria', 'Thebes', 'Asyut', 'Minya', 'Esna', 'Edfu',
+             'Qena', 'Rosetta', 'Damietta', 'Suez', 'Giza', 'Memphis', 'Abydos'],
+    'River': ['Nile', 'Blue Nile', 'White Nile', 'Atbara'],
+    'Building': ['Great Pyramid', 'Citadel', 'Shepheard Hotel', 'Mosque of Ibn Tulun'],
+    'HistoricalSite': ['Karnak', 'Philae', 'Abu Simbel', 'Valley of the Kings', 'Dendera'],
+    'Country': ['Egypt', 'Nubia', 'Syria', 'England', 'France']
+}
+COMPANIES = ['Thomas Cook', 'Peninsular Company', 'Suez Canal Company']
+SHIPS = ['Cleopatra', 'Philae', 'Hathor', 'Rameses']
+FILLER_WORDS = ('the of and to a in we was it that our with on for as at by were from which this '
+                'had but all not they be upon boat river morning wind sand temple shore some there '
+                'very great little after before when our dragoman crew sailed saw walked').split()
+MONTHS = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September',
+          'October', 'November', 'December']
+
+# Wikidata entities that synthetic entities link to
+EGYPT_QID = 'Q79'
+LINKED_ENTITIES = {
+    EGYPT_QID: ('Egypt', 'country in Africa', {'P297': 'EG'}),
+    'Q6581072': ('female', 'to be used in "sex or gender"', {}),
+    'Q6581097': ('male', 'to be used in "sex or gender"', {}),
+    'Q36180': ('writer', 'person who uses written words', {}),
+    'Q85': ('Cairo', 'capital city of Egypt', {})
+}
+
+def make_synthetic_fixture(paragraph_count, seed=0, entities_per_paragraph=6, unique_people=500):
+    """Make up a corpus that reads a bit like a Nile travelogue, with the TextContents response of
+    every paragraph. Names and places come back as Wolfram entities, numbers as Quantity and
+    DateObject. Some names are also tagged partly as other entities, and some responses have low
+    confidence, so overlap resolution and the confidence filter have work to do. Returns the
+    paragraphs and the recording, as ReplayTagger takes it.
+
+    paragraph_count -- number of paragraphs to make
+    seed -- seed of the random generator, the same seed always makes the same fixture
+    entities_per_paragraph -- average number of mentions per paragraph
+    unique_people -- number of different people mentioned across the corpus
+    """
+    rng = random.Random(seed)
+    people = [f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}' for _ in range(unique_people)]
+    paragraphs = []
+    recording = dict()
+    for _ in range(paragraph_count):
+        text = ''
+        entities = []
+        for _ in range(rng.randint(0, 2 * entities_per_paragraph)):
+            text += ' '.join(rng.choice(FILLER_WORDS) for _ in range(rng.randint(2, 12))) + ' '
+            mention, mention_entities = make_mention(rng, people)
+            for entity in mention_entities:
+                entities.append({**entity, 'start_pos': entity['start_pos'] + len(text),
+                                 'end_pos': entity['end_pos'] + len(text)})
+            text += mention + ' '
+        text += ' '.join(rng.choice(FILLER_WORDS) for _ in range(rng.randint(3, 30))) + '.'
+        paragraphs.append(text)
+        recording[text] = entities
+    return paragraphs, recording
+
+def make_mention(rng, people):
+    """Make up a mention of an entity. Returns its text, and the entities TextContents would
+    return for it with positions relative to the start of the mention.
+    """
+    kind = rng.random()
+    if kind < 0.3:
+        name = rng.choice(people)
+        canonical_name = name.replace(' ', '') + f'::{zlib.crc32(name.encode()) % 100000:05d}'
+        entities = [make_entity(name, 0, 'Person', rng.uniform(0.7, 1.0), wl.Entity('Person', canonical_name))]
+        last_name = name.split(' ')[-1]
+        if rng.random() < 0.3: # Also tagged as a place, e.g. "Gordon" inside "Lucie Gordon"
+            entities.append(make_entity(last_name, len(name) - len(last_name), 'City', rng.uniform(0.5, 1.0),
+                                        wl.Entity('City', (last_name, 'Cairo', 'Egypt'))))
+    elif kind < 0.7:
+        entity_type = rng.choice(list(PLACES))
+        name = rng.choice(PLACES[entity_type])
+        entities = [make_entity(name, 0, entity_type, rng.uniform(0.6, 1.0),
+                                wl.Entity(entity_type, (name.replace(' ', ''), 'Egypt')))]
+    elif kind < 0.75:
+        entity_type, name = rng.choice([('Company', rng.choice(COMPANIES)), ('Ship', rng.choice(SHIPS))])
+        entities = [make_entity(name, 0, entity_type, rng.uniform(0.7, 1.0),
+                                wl.Entity(entity_type, name.replace(' ', '')))]
+    elif kind < 0.9:
+        year = rng.randint(1798, 1914)
+        month = rng.randint(1, 12)
+        day = rng.randint(1, 28)
+        name = f'{day} {MONTHS[month - 1]} {year}'
+        entities = [make_entity(name, 0, 'Date', 0.95, wl.DateObject((year, month, day), 'Day')),
+                    make_entity(str(year), len(name) - 4, 'Quantity', 0.6, wl.Quantity(year, 'Years'))]
+    else:
+        amount = rng.randint(2, 500)
+        unit = rng.choice(['miles', 'feet', 'pounds'])
+        name = f'{amount} {unit}'
+        entities = [make_entity(name, 0, 'Quantity', 0.9, wl.Quantity(amount, unit.capitalize()))]
+    return name, entities
+
+def make_entity(text, start_pos, entity_type, confidence, interpretation):
+    return {
+        'text': text,
+        'start_pos': start_pos,
+        'end_pos': start_pos + len(text),
+        'type': entity_type,
+        'confidence': confidence,
+        'interpretation': interpretation
+    }
+
+def make_synthetic_wikidata(seen_entities):
+    """Make up a Wikidata ID and Wikidata entity JSON for every seen Wolfram entity, with every
+    claim IndexAssembler reads for its type. Returns {Mathematica URN: QID} and {QID: entity JSON}.
+
+    seen_entities -- seen entities of a NamedEntityRecognizer
+    """
+    wikidata_ids = dict()
+    entities = {qid: make_wikidata_entity(qid, label, description, claims)
+                for qid, (label, description, claims) in LINKED_ENTITIES.items()}
+    for number, (urn, (xml_id, interpretation)) in enumerate(sorted(seen_entities.items())):
+        qid = f'Q{1000000 + number}'
+        wikidata_ids[urn] = qid
+        label = json.loads(interpretation.canonical_name)
+        label = label[0] if isinstance(label, list) else label.split('::')[0]
+        claims = {'P17': EGYPT_QID, 'P625': (30.04 + number % 90 / 100, 31.23 + number % 70 / 100)}
+        if interpretation.type == 'Person':
+            claims = {
+                'P21': 'Q6581072' if number % 2 else 'Q6581097',
+                'P569': (1790 + number % 60, 11),
+                'P19': 'Q85',
+                'P570': (1850 + number % 60, 9),
+                'P20': 'Q85',
+                'P106': 'Q36180'
+            }
+        entities[qid] = make_wikidata_entity(qid, label, f'{interpretation.type} in the benchmark', claims)
+    return wikidata_ids, entities
+
+def make_wikidata_entity(qid, label, description, claims):
+    """Make the Special:EntityData JSON of a Wikidata entity
+
+    qid -- Wikidata ID of the entity
+    label -- English label
+    description -- English description
+    claims -- {PID: value}, where a value is a QID, a string, a (latitude, longitude) tuple or a
+        (year, precision) tuple for dates
+    """
+    entity = {
+        'type': 'item',
+        'id': qid,
+        'labels': {'en': {'language': 'en', 'value': label}},
+        'descriptions': {'en': {'language': 'en', 'value': description}},
+        'claims': dict()
+    }
+    for pid, value in claims.items():
+        if pid == 'P625':
+            datatype, datavalue = 'globe-coordinate', {
+                'type': 'globecoordinate',
+                'value': {'latitude': value[0], 'longitude': value[1], 'altitude': None,
+                          'precision': 0.0001, 'globe': 'http://www.wikidata.org/entity/Q2'}}
+        elif isinstance(value, tuple):
+            datatype, datavalue = 'time', {
+                'type': 'time',
+                'value': {'time': f'+{value[0]}-01-01T00:00:00Z', 'timezone': 0, 'before': 0,
+                          'after': 0, 'precision': value[1],
+                          'calendarmodel': 'http://www.wikidata.org/entity/Q1985727'}}
+        elif value.startswith('Q'):
+            datatype, datavalue = 'wikibase-item', {
+                'type': 'wikibase-entityid',
+                'value': {'entity-type': 'item', 'numeric-id': int(value[1:]), 'id': value}}
+        else:
+            datatype, datavalue = 'external-id', {'type': 'string', 'value': value}
+        entity['claims'][pid] = [{
+            'mainsnak': {'snaktype': 'value', 'property': pid, 'datatype': datatype, 'datavalue': datavalue},
+            'type': 'statement',
+            'rank': 'normal'
+        }]
+    return entity
+
+def record_fixture(ner, paragraphs, recording_path, wikidata_path, wl_session, wikidata_base_url):
+    """Tag a corpus with a real tagger and look its entities up on Wikidata, saving everything a
+    benchmark needs to replay the run without a kernel or network
+
+    ner -- NamedEntityRecognizer that tags with the tagger to record
+    paragraphs -- list of paragraphs of the corpus
+    recording_path -- WXF file to save the tagger responses to
+    wikidata_path -- JSON file to save the Wikidata IDs and entities to
+    wl_session -- Wolfram kernel session to get Wikidata IDs from
+    wikidata_base_url -- base URL of the Wikidata site to get entities from
+    """
+    ner.tagger = RecordingTagger(ner.tagger)
+    for _ in ner.tag_paragraphs(paragraphs):
+        pass
+    ner.tagger.save(recording_path)
+
+    assembler = IndexAssembler(wl_session, wikidata_base_url=wikidata_base_url)
+    wikidata_ids, failures = assembler.resolve_wikidata_ids(ner.get_seen_entities())
+    qids = {qid for qid in wikidata_ids.values() if qid != None}
+    pids = [wiki_pids[prop] for prop in linked_entity_props]
+    assembler.prefetcher.prefetch_with_links(qids, pids)
+    entities = dict()
+    for qid in qids | assembler.prefetcher.linked_qids(qids, pids):
+        data = assembler.prefetcher.get_cached(qid)
+        if data != None:
+            entities[qid] = data
+    with open(wikidata_path, 'w') as wikidata_file:
+        json.dump({'wikidata_ids': wikidata_ids, 'entities': entities}, wikidata_file)
+
+def load_wikidata_fixture(path):
+    """Load the Wikidata IDs and entities saved by record_fixture"""
+    with open(path, 'r') as wikidata_file:
+        fixture = json.load(wikidata_file)
+    return fixture['wikidata_ids'], fixture['entities']
+
+class FakeSession:
+    def __init__(self, wikidata_ids):
+        """Stand-in for the Wolfram kernel session of IndexAssembler, which answers the
+        WikidataData lookups of resolve_wikidata_ids from canned Wikidata IDs
+
+        wikidata_ids -- {Mathematica URN: QID or None}
+        """
+        self.wikidata_ids = wikidata_ids
+        self.evaluations = 0
+
+    def evaluate(self, expr):
+        self.evaluations += 1
+        results = []
+        # expr is Map[Function[...WikidataData...], List[entities...]]
+        for interpretation in expr.args[1].args:
+            qid = self.wikidata_ids.get(to_wolfram_entity(interpretation).urn)
+            results.append((wl.Rule(interpretation, qid),) if qid != None else ())
+        return results
+
+class WikidataStandIn:
+    def __init__(self, entities):
+        """Local HTTP server that answers the Special:EntityData and wbgetentities requests of the
+        wikidata client and WikidataPrefetcher from canned entity JSON. Use base_url as the
+        wikidata_base_url of IndexAssembler.
+
+        entities -- {QID: entity JSON}
+        """
+        self.entities = entities
+        self.requests = 0
+        # wbgetentities requests for any of these IDs fail with a 500, like an overloaded API
+        self.failing_ids = set()
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stand_in.requests += 1
+                url = urllib.parse.urlparse(self.path)
+                if url.path == '/w/api.php':
+                    ids = urllib.parse.parse_qs(url.query).get('ids', [''])[0].split('|')
+                    if stand_in.failing_ids.intersection(ids):
+                        self.send_error(500)
+                        return
+                    body = {'entities': {qid: stand_in.entities.get(qid, {'id': qid, 'missing': ''})
+                                         for qid in ids}}
+                elif url.path.startswith('/wiki/Special:EntityData/') and url.path.endswith('.json'):
+                    qid = url.path[len('/wiki/Special:EntityData/'):-len('.json')]
+                    if qid not in stand_in.entities:
+                        self.send_error(404)
+                        return
+                    body = {'entities': {qid: stand_in.entities[qid]}}
+                else:
+                    self.send_error(404)
+                    return
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.base_url = f'http://127.0.0.1:{self.server.server_address[1]}/'
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
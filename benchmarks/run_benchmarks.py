@@ -0,0 +1,245 @@
+"""run_benchmarks.py - Times every stage of turning a corpus into TEI: tagging, overlap resolution,
+building the TEI body, assembling the document and generating the TEI index (serially and in
+worker processes, see IndexAssembler.write_index). No Wolfram kernel or network access is needed;
+tagger responses are replayed and Wikidata is served locally (see fixtures.py).
+
+For each stage, reports the best time over the repeats, throughput (paragraphs/s and entities/s)
+and the peak RSS of the process once the stage has run. Results can be saved as JSON and compared
+against a saved baseline, in which case stages that got slower by more than the threshold are
+flagged and the exit status is 1.
+
+Run from the repository root:
+    python -m benchmarks.run_benchmarks [--paragraphs 2000] [--output results.json]
+        [--baseline baseline.json] [--threshold 0.1]
+To benchmark a real corpus, record the kernel's responses and the Wikidata entities once, on a
+machine with Mathematica:
+    python -m benchmarks.run_benchmarks --corpus txt_files --record fixtures/corpus
+and replay them anywhere afterwards:
+    python -m benchmarks.run_benchmarks --corpus txt_files --fixture fixtures/corpus
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import sys
+import time
+from src.ner.backends import ReplayTagger
+from src.ner.flair_ner import NamedEntityRecognizer
+from src.ner.wlflairshim import SequenceTagger
+from src.tei.assemble_document import read_paragraphs
+from src.tei.assemble_tei import create_body, create_header, create_xml
+from src.tei.assemble_tei_index import IndexAssembler
+from benchmarks.fixtures import (FakeSession, WikidataStandIn, load_wikidata_fixture,
+    make_synthetic_fixture, make_synthetic_wikidata, record_fixture)
+
+with open('settings.json', 'r') as f:
+    settings = json.load(f)
+
+def create_ner(tagger_backend='fake', **kwargs):
+    return NamedEntityRecognizer(
+        settings['wolfram_kernel_path'],
+        settings['content_types_precedence_order'],
+        settings['minimum_confidence'],
+        True,
+        settings['tei_index_name'],
+        tagger_backend=tagger_backend,
+        **kwargs
+    )
+
+def read_corpus(corpus_dir):
+    """Read the paragraphs of every text file in a directory, in name order"""
+    paragraphs = []
+    for filename in sorted(next(os.walk(corpus_dir))[2]):
+        with open(os.path.join(corpus_dir, filename), 'r') as book:
+            paragraphs.extend(read_paragraphs(book))
+    return paragraphs
+
+def get_peak_rss():
+    """Get the peak resident set size of this process so far, in kilobytes"""
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss // 1024 if sys.platform == 'darwin' else peak_rss
+
+def time_stage(function, repeat, setup=None):
+    """Run a stage repeat times. Returns what its last run returned and its best time in seconds.
+
+    function -- stage to time
+    repeat -- number of times to run it
+    setup -- untimed function to call before each run, whose result is passed to function
+    """
+    best = None
+    for _ in range(repeat):
+        args = [setup()] if setup != None else []
+        start = time.perf_counter()
+        result = function(*args)
+        seconds = time.perf_counter() - start
+        best = seconds if best == None else min(best, seconds)
+    return result, best
+
+def run_benchmarks(paragraphs, recording, wikidata, repeat=3, prefilter=False, gazetteer_mode='off'):
+    """Run every stage on a fixture and return the results of each stage
+
+    paragraphs -- list of paragraphs of the corpus
+    recording -- tagger responses of the paragraphs, as ReplayTagger takes them
+    wikidata -- canned ({URN: QID}, {QID: entity JSON}), or None to make them up
+    repeat -- number of times to run each stage
+    prefilter -- pre-filter paragraphs before tagging, see NamedEntityRecognizer
+    gazetteer_mode -- gazetteer mode of the NamedEntityRecognizer
+    """
+    stages = dict()
+
+    def record(stage, seconds, paragraph_count=None, entity_count=None):
+        stages[stage] = {'seconds': seconds, 'peak_rss_kb': get_peak_rss()}
+        if paragraph_count != None:
+            stages[stage]['paragraphs'] = paragraph_count
+            stages[stage]['paragraphs_per_second'] = paragraph_count / seconds if seconds else None
+        if entity_count != None:
+            stages[stage]['entities'] = entity_count
+            stages[stage]['entities_per_second'] = entity_count / seconds if seconds else None
+        print(f"{stage:>12}: {seconds:8.3f}s  peak RSS {stages[stage]['peak_rss_kb'] / 1024:8.1f} MB")
+
+    raw_entities = sum(len(entities) for entities in recording.values())
+
+    # Tagging: replayed responses through the confidence filter, overlap resolution and refs
+    def tag():
+        ner = create_ner(prefilter=prefilter, gazetteer_mode=gazetteer_mode)
+        ner.tagger = ReplayTagger(recording)
+        return ner, list(ner.tag_paragraphs(paragraphs))
+    (ner, flair_output), seconds = time_stage(tag, repeat)
+    entity_count = sum(len(paragraph['entities']) for paragraph in flair_output)
+    record('tag', seconds, len(paragraphs), raw_entities)
+
+    # Overlap resolution on its own, on the raw responses
+    responses = [[entity for entity in recording[paragraph] if entity['confidence'] >= ner.min_confidence]
+                 for paragraph in paragraphs if paragraph in recording]
+    _, seconds = time_stage(lambda: [ner.remove_entity_overlaps(entities) for entities in responses], repeat)
+    record('overlaps', seconds, len(responses), sum(len(entities) for entities in responses))
+
+    for builder, use_lxml in [('bs4', False), ('lxml', True)]:
+        _, seconds = time_stage(lambda: create_body(flair_output, use_lxml), repeat)
+        record(f'body_{builder}', seconds, len(flair_output), entity_count)
+        # create_xml takes the header and body apart, so each run needs new ones
+        _, seconds = time_stage(lambda parts: create_xml(*parts), repeat,
+                                lambda: (create_header(title='Benchmark'), create_body(flair_output, use_lxml)))
+        record(f'xml_{builder}', seconds, len(flair_output), entity_count)
+
+    # TEI index, with Wikidata IDs and entities served locally
+    seen_entities = ner.get_seen_entities()
+    wikidata_ids, wikidata_entities = wikidata if wikidata != None else make_synthetic_wikidata(seen_entities)
+    stand_in = WikidataStandIn(wikidata_entities)
+    stand_in.start()
+    try:
+        def create_index():
+            # A new assembler each time, so Wikidata entities aren't cached between repeats
+            assembler = IndexAssembler(FakeSession(wikidata_ids), wikidata_base_url=stand_in.base_url,
+                                       wikidata_workers=settings.get('wikidata_workers', 4))
+            return assembler.create_index(seen_entities, 'Benchmark', '', '', '', '',
+                                          settings['tei_index_ref_type'])
+        _, seconds = time_stage(create_index, repeat)
+        record('index', seconds, entity_count=len(seen_entities))
+
+        def write_index():
+            assembler = IndexAssembler(FakeSession(wikidata_ids), wikidata_base_url=stand_in.base_url,
+                                       wikidata_workers=settings.get('wikidata_workers', 4))
+            output_file = io.StringIO()
+            assembler.write_index(output_file, seen_entities, 'Benchmark', '', '', '', '',
+                                  settings['tei_index_ref_type'], settings.get('index_render_workers', 4))
+            return output_file.getvalue()
+        _, seconds = time_stage(write_index, repeat)
+        record('index_pool', seconds, entity_count=len(seen_entities))
+    finally:
+        stand_in.stop()
+    return stages
+
+def compare(results, baseline, threshold):
+    """Print how each stage compares to a baseline. Returns the stages that got slower by more
+    than threshold (a fraction, e.g. 0.1 for 10%).
+    """
+    regressions = []
+    for stage, stage_results in results['stages'].items():
+        if stage not in baseline['stages']:
+            continue
+        ratio = stage_results['seconds'] / baseline['stages'][stage]['seconds']
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  REGRESSION'
+            regressions.append(stage)
+        elif ratio < 1 - threshold:
+            flag = '  faster'
+        print(f"{stage:>12}: {baseline['stages'][stage]['seconds']:8.3f}s -> "
+              f"{stage_results['seconds']:8.3f}s ({ratio - 1:+.0%}){flag}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--corpus', help='directory of text files (defaults to a synthetic corpus)')
+    parser.add_argument('--fixture', help='path prefix of a recorded fixture (.wxf and .json)')
+    parser.add_argument('--record', help='record a fixture of --corpus with the Wolfram kernel to this path prefix')
+    parser.add_argument('--paragraphs', type=int, default=2000, help='size of the synthetic corpus')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--prefilter', action='store_true')
+    parser.add_argument('--gazetteer-mode', default='off', choices=['off', 'residual', 'paragraph'],
+                        help='a fixture can only be replayed with the gazetteer mode it was recorded with')
+    parser.add_argument('--output', help='JSON file to save the results to')
+    parser.add_argument('--baseline', help='JSON file of earlier results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown (as a fraction) that counts as a regression')
+    args = parser.parse_args()
+
+    if args.record:
+        if not args.corpus:
+            parser.error('--record needs --corpus')
+        ner = create_ner(settings.get('tagger_backend', 'wolfram'),
+                         tagger_cache_dir=settings.get('tagger_cache_dir'),
+                         prefilter=args.prefilter, gazetteer_mode=args.gazetteer_mode,
+                         kernel_session_options=settings.get('kernel_session'))
+        tagger = SequenceTagger(settings['wolfram_kernel_path'],
+                                session_options={**(settings.get('kernel_session') or dict()), 'warm_up': False})
+        record_fixture(ner, read_corpus(args.corpus), f'{args.record}.wxf', f'{args.record}.json',
+                       tagger.session, settings.get('wikidata_base_url', 'https://www.wikidata.org/'))
+        tagger.close()
+        ner.close()
+        print(f"Recorded {args.record}.wxf and {args.record}.json")
+        return
+
+    if args.corpus:
+        if not args.fixture:
+            parser.error('--corpus needs a recorded --fixture to replay')
+        paragraphs = read_corpus(args.corpus)
+        recording = ReplayTagger.from_file(f'{args.fixture}.wxf').recording
+        wikidata = load_wikidata_fixture(f'{args.fixture}.json')
+        corpus = {'corpus': args.corpus, 'fixture': args.fixture}
+    else:
+        if args.gazetteer_mode != 'off':
+            # The gazetteer changes what text is sent to the tagger, which wasn't made up
+            parser.error('the synthetic corpus can only be tagged with --gazetteer-mode off')
+        paragraphs, recording = make_synthetic_fixture(args.paragraphs, args.seed)
+        wikidata = None
+        corpus = {'corpus': 'synthetic', 'paragraphs': args.paragraphs, 'seed': args.seed}
+    print(f"{len(paragraphs)} paragraphs, {sum(len(paragraph) for paragraph in paragraphs)} characters")
+
+    results = {
+        'time': time.time(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        **corpus,
+        'repeat': args.repeat,
+        'prefilter': args.prefilter,
+        'gazetteer_mode': args.gazetteer_mode,
+        'stages': run_benchmarks(paragraphs, recording, wikidata, args.repeat, args.prefilter,
+                                 args.gazetteer_mode)
+    }
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+        print(f"Compared to {args.baseline}:")
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
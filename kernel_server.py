@@ -0,0 +1,50 @@
+"""kernel_server.py - Keeps a warmed-up Wolfram kernel running for other runs to attach to
+
+Booting a kernel and loading its entity recognition models takes many seconds, which short runs
+of batch_tag.py, tag_ia_texts.py or the tagging service would otherwise each pay for. Start this
+once, set kernel_session.server_address in settings.json to the same address and
+kernel_session.server_authkey to a secret (the server refuses to start without one), and those runs
+evaluate on this kernel instead of booting their own (they start their own if it isn't running).
+The kernel evaluates one expression at a time, so every run attached to it shares it; runs that
+need several kernels at once should start their own.
+
+    python kernel_server.py [--address localhost:47617]
+
+The kernel is recycled and health-checked as set in kernel_session (see src/ner/kernel_session.py).
+"""
+import argparse
+import json
+from src.ner.kernel_session import KernelServer, ManagedSession, check_authkey
+from src.utils.metrics import metrics
+
+# open_session options that are about attaching to a server rather than the kernel itself
+SERVER_OPTIONS = ['eager', 'server_address', 'server_authkey']
+
+if __name__ == '__main__':
+    with open('settings.json', 'r') as f:
+        settings = json.load(f)
+    session_options = dict(settings.get('kernel_session') or dict())
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--address', default=session_options.get('server_address') or 'localhost:47617',
+                        help='"host:port" or the path of a Unix socket to listen on')
+    args = parser.parse_args()
+    try:
+        check_authkey(session_options.get('server_authkey'))
+    except ValueError as error:
+        parser.error(str(error))
+
+    session = ManagedSession(settings['wolfram_kernel_path'],
+                             **{name: value for name, value in session_options.items()
+                                if name not in SERVER_OPTIONS})
+    session.start()
+    server = KernelServer(session, args.address, session_options.get('server_authkey', ''))
+    print(f"Serving a kernel on {args.address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        session.stop()
+        print(metrics.format_summary())
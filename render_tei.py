@@ -0,0 +1,47 @@
+"""render_tei.py - Renders the TEI document of every raw text file in the txt_files directory out of
+the annotation file batch_tag.py tagged it into, and puts it in the tei_files directory with the
+same name, but with ".tei" added to the end
+
+Rendering doesn't need Mathematica, so it can run on any machine with a copy of txt_files and the
+annotation files, e.g. after changing how entities are marked up or what goes in the TEI header.
+Files are rendered in parallel by render_workers worker processes. Files without an annotation
+file, or that changed since they were tagged, are skipped; run batch_tag.py to (re)tag them.
+"""
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from src.tei.assemble_document import render_annotated_file
+
+if __name__ == '__main__':
+    with open('settings.json', 'r') as f:
+        settings = json.load(f)
+
+    parser = argparse.ArgumentParser(description='Render TEI documents from annotation files')
+    parser.add_argument('--workers', type=int, default=settings.get('render_workers', 1))
+    parser.add_argument('--annotation-dir', default=settings.get(
+        'annotation_dir', os.path.join(settings.get('batch_state_dir', 'batch_state'), 'annotations')))
+    parser.add_argument('--input-dir', default='txt_files')
+    parser.add_argument('--output-dir', default='tei_files')
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=max(args.workers, 1)) as executor:
+        futures = dict()
+        for filename in sorted(next(os.walk(args.input_dir))[2]):
+            annotation_path = os.path.join(args.annotation_dir, f"{filename}.ann")
+            if not os.path.exists(annotation_path):
+                print("Skipping untagged", filename)
+                continue
+            future = executor.submit(render_annotated_file, os.path.join(args.input_dir, filename),
+                                     annotation_path, os.path.join(args.output_dir, f"{filename}.tei"),
+                                     settings.get('use_lxml_builder', False),
+                                     settings.get('stream_documents', False))
+            futures[future] = filename
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as error:
+                print("Failed to render", futures[future], error)
+                continue
+            print("Rendered", futures[future])
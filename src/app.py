@@ -1,70 +1,186 @@
-import re
-from flask import Flask, request, render_template
-from gevent.pywsgi import WSGIServer
-from ner.flair_ner import NamedEntityRecognizer
-from tei.assemble_tei import create_header, create_xml, create_body
-
-app = Flask(__name__)
-ner = NamedEntityRecognizer()
-
-@app.route('/')
-def index():
-    return render_template('markup.html')
-
-
-@app.route('/about')
-def about():
-    return render_template('about.html')
-
-
-@app.route('/output')
-def output():
-    return render_template('output.html')
-
-
-@app.route('/', methods=['POST'])
-def submit_text():
-    title = request.form['teiHeaderTitle']
-    author = request.form['teiHeaderAuthor']
-    editor = request.form['teiHeaderEditor']
-    publisher = request.form['teiHeaderPublisher']
-    publisher_address = request.form['teiHeaderPublisherAddress']
-    publication_date = request.form['teiHeaderPublicationDate']
-    license_desc = request.form['teiHeaderLicense']
-    project_description = request.form['teiHeaderProjectDescription']
-    source_description = request.form['teiHeaderSourceDescription']
-
-    project_description = re.sub('\n|\t\r|\r\n', ' ', project_description)
-    project_description = re.sub(' +', ' ', project_description)
-    if project_description != '':
-        project_description = ner.tag_entities(project_description)
-
-    source_description = re.sub('\n|\t\r|\r\n', ' ', source_description)
-    source_description = re.sub(' +', ' ', source_description)
-    if source_description != '':
-        source_description = ner.tag_entities(source_description
-                                          )
-    # Create header
-    tei_header = create_header(title, author, editor, publisher, publisher_address,
-                               publication_date, license_desc, project_description, source_description)
-
-    # Create body
-    text = request.form['rawText']
-    text = re.sub('\r', '', text)
-    #text = re.sub('\n|\t\r|\r\n', ' ', text)
-    #text = re.sub(' +', ' ', text)
-
-    flair_output = ner.tag_entities(text)
-    tei_body = create_body(flair_output)
-
-    # Assemble document
-    tei_document = create_xml(tei_header, tei_body).decode('unicode-escape')
-    return render_template('output.html',
-                           tei=tei_document)
+"""app.py - HTTP service that tags texts and turns them into TEI documents
 
+Run from the repository root (reads settings.json there):
+    python -m src.app [--host HOST] [--port PORT]
+
+Endpoints:
+    POST /jobs              submit {"text": ..., "title": ..., ...}, returns the job ID (202)
+    GET  /jobs/{id}         status of a job, with its paragraphs and TEI document once done
+    GET  /jobs/{id}/stream  tagged paragraphs as newline-delimited JSON, as they are tagged
+    GET  /jobs/{id}/tei     TEI document of a finished job
+    POST /tag               submit and wait for the TEI document, up to the request timeout
+    GET  /stats             service and kernel counters
+    GET  /metrics           timings and counters in the Prometheus text format
+
+Submissions are refused with 503 while the job queue is full. Submitting the same text and header
+again gives back the cached job.
+"""
+import argparse
+import json
+from aiohttp import web
+from src.ner.flair_ner import NamedEntityRecognizer
+from src.ner.wlflairshim import DEFAULT_BATCH_BYTES
+from src.service.tagging_service import TaggingService, QueueFullError, HEADER_FIELDS
+from src.utils.license_utils import license_dict
+from src.utils.metrics import metrics
+
+async def read_submission(request):
+    """Get the text and TEI header fields of a submission from a JSON or form request body"""
+    if request.content_type == 'application/json':
+        try:
+            submission = await request.json()
+        except json.JSONDecodeError:
+            raise web.HTTPBadRequest(text='Request body is not valid JSON')
+    else:
+        submission = dict(await request.post())
+    if not isinstance(submission, dict) or not isinstance(submission.get('text'), str):
+        raise web.HTTPBadRequest(text='Submission needs a "text" string')
+    header = {field: submission[field] for field in HEADER_FIELDS if submission.get(field)}
+    for field, value in header.items():
+        if not isinstance(value, str):
+            raise web.HTTPBadRequest(text=f'"{field}" must be a string')
+    if 'license_desc' in header and header['license_desc'] not in license_dict:
+        raise web.HTTPBadRequest(text=f'Unknown license_desc, use one of {", ".join(license_dict)}')
+    return submission['text'], header
+
+def submit(request, text, header):
+    """Submit a job to the service, turning a full queue into a 503"""
+    try:
+        return request.app['service'].submit(text, header)
+    except QueueFullError as error:
+        raise web.HTTPServiceUnavailable(text=f'Tagging queue is full ({error}), try again later',
+                                         headers={'Retry-After': str(request.app['retry_after'])})
+
+def get_job(request):
+    """Get the job a request is about, or raise a 404"""
+    job = request.app['service'].get_job(request.match_info['job_id'])
+    if job == None:
+        raise web.HTTPNotFound(text='No such job (it may have expired)')
+    return job
+
+async def submit_job(request):
+    text, header = await read_submission(request)
+    job, cached = submit(request, text, header)
+    return web.json_response({**job.to_dict(include_results=False), 'cached': cached}, status=202,
+                             headers={'Location': f'/jobs/{job.job_id}'})
+
+async def job_status(request):
+    return web.json_response(get_job(request).to_dict())
+
+async def job_tei(request):
+    job = get_job(request)
+    if job.status != 'done':
+        return web.json_response(job.to_dict(), status=409 if job.finished else 202)
+    return web.Response(text=job.tei, content_type='application/tei+xml')
+
+async def stream_job(request):
+    job = get_job(request)
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+    await response.prepare(request)
+    sent = 0
+    while True:
+        # Grab the event before looking at the job, so no update is missed in between
+        update_event = job.update_event
+        while sent < len(job.paragraphs):
+            line = {'paragraph': sent, **job.paragraphs[sent]}
+            await response.write((json.dumps(line) + '\n').encode('utf-8'))
+            sent += 1
+        if job.finished:
+            break
+        await update_event.wait()
+    await response.write((json.dumps(job.to_dict(include_results=False)) + '\n').encode('utf-8'))
+    await response.write_eof()
+    return response
+
+async def tag_text(request):
+    text, header = await read_submission(request)
+    job, _ = submit(request, text, header)
+    if not await request.app['service'].wait(job, request.app['request_timeout']):
+        return web.json_response({**job.to_dict(include_results=False),
+                                  'error': 'Still tagging, poll the job for the result'},
+                                 status=504, headers={'Location': f'/jobs/{job.job_id}'})
+    if job.status != 'done':
+        return web.json_response(job.to_dict(), status=500)
+    return web.Response(text=job.tei, content_type='application/tei+xml')
+
+async def stats(request):
+    service_stats = request.app['service'].get_stats()
+    kernel_stats = []
+    if hasattr(request.app['service'].ner, 'get_kernel_stats'):
+        kernel_stats = request.app['service'].ner.get_kernel_stats()
+    return web.json_response({'service': service_stats, 'kernels': kernel_stats})
+
+async def export_metrics(request):
+    gauges = {f'service_{name}': value for name, value in request.app['service'].get_stats().items()}
+    return web.Response(text=metrics.to_prometheus(gauges), content_type='text/plain')
+
+def create_app(service, request_timeout=60, retry_after=5, max_request_bytes=16 * 1024 * 1024):
+    """Create the aiohttp application of the tagging service. The service's workers are started
+    and stopped with the application.
+
+    service -- TaggingService to submit texts to
+    request_timeout -- number of seconds POST /tag waits for a job before answering 504
+    retry_after -- number of seconds clients are told to wait when the queue is full
+    max_request_bytes -- largest request body accepted
+    """
+    app = web.Application(client_max_size=max_request_bytes)
+    app['service'] = service
+    app['request_timeout'] = request_timeout
+    app['retry_after'] = retry_after
+
+    async def start_service(app):
+        await service.start()
+
+    async def stop_service(app):
+        await service.stop()
+
+    app.on_startup.append(start_service)
+    app.on_cleanup.append(stop_service)
+    app.router.add_post('/jobs', submit_job)
+    app.router.add_get('/jobs/{job_id}', job_status)
+    app.router.add_get('/jobs/{job_id}/stream', stream_job)
+    app.router.add_get('/jobs/{job_id}/tei', job_tei)
+    app.router.add_post('/tag', tag_text)
+    app.router.add_get('/stats', stats)
+    app.router.add_get('/metrics', export_metrics)
+    return app
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the tagging service')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=3000)
+    args = parser.parse_args()
+
+    with open('settings.json', 'r') as f:
+        settings = json.load(f)
+    ner = NamedEntityRecognizer(
+        settings['wolfram_kernel_path'],
+        settings['content_types_precedence_order'],
+        settings['minimum_confidence'],
+        False,
+        settings['tei_index_name'],
+        batch_bytes=settings.get('kernel_batch_bytes', DEFAULT_BATCH_BYTES),
+        kernel_pool_size=settings.get('kernel_pool_size', 1),
+        kernel_licence_limit=settings.get('kernel_licence_limit'),
+        tagger_cache_dir=settings.get('tagger_cache_dir'),
+        tagger_backend=settings.get('tagger_backend', 'wolfram'),
+        tagger_options=settings.get('tagger_options'),
+        prefilter=settings.get('prefilter_paragraphs', False),
+        gazetteer_mode=settings.get('gazetteer_mode', 'off'),
+        chunk_chars=settings.get('kernel_chunk_chars'),
+        chunk_overlap=settings.get('kernel_chunk_overlap', 200),
+        kernel_session_options=settings.get('kernel_session'),
+        dedup=settings.get('dedup_paragraphs', False),
+        dedup_boilerplate=settings.get('dedup_boilerplate', False)
+    )
+    service = TaggingService(ner,
+                             workers=settings.get('service_workers', settings.get('kernel_pool_size', 1)),
+                             max_queued_jobs=settings.get('service_max_queued_jobs', 100),
+                             job_timeout=settings.get('service_job_timeout', 300),
+                             max_finished_jobs=settings.get('service_max_finished_jobs', 1000),
+                             use_lxml=settings.get('use_lxml_builder', False))
     try:
-        WSGIServer(('0.0.0.0', 3000), app).serve_forever()
-    except KeyboardInterrupt:
+        web.run_app(create_app(service, settings.get('service_request_timeout', 60)),
+                    host=args.host, port=args.port)
+    finally:
         ner.close()
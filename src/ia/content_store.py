@@ -0,0 +1,93 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+class ContentStore:
+    def __init__(self, root):
+        """Open (or create) a local content-addressed store of downloaded texts. Each text is kept
+        once under the SHA-256 of its contents, and an index maps the identifiers of items (e.g.
+        Internet Archive identifiers) to their text and metadata.
+
+        root -- directory of the store
+        """
+        self.root = root
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+        os.makedirs(os.path.join(root, 'tmp'), exist_ok=True)
+        self.connection = sqlite3.connect(os.path.join(root, 'index.sqlite'), timeout=60,
+                                          check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS items (
+                identifier TEXT PRIMARY KEY,
+                sha256 TEXT NOT NULL,
+                source_name TEXT,
+                source_md5 TEXT,
+                metadata TEXT NOT NULL,
+                stored_at REAL NOT NULL
+            )''')
+
+    def close(self):
+        """Close the store"""
+        self.connection.close()
+
+    def get_object_path(self, sha256):
+        """Get the path a text with the given SHA-256 hex digest is stored at"""
+        return os.path.join(self.root, 'objects', sha256[:2], sha256)
+
+    def make_temp_path(self):
+        """Get a path in the store to download a file to before adding it with put_file"""
+        return os.path.join(self.root, 'tmp', uuid.uuid4().hex)
+
+    def get(self, identifier):
+        """Get the record of a stored item, or None if it isn't stored (or its text went missing).
+        Records look like {'identifier', 'sha256', 'path', 'source_name', 'source_md5', 'metadata'}.
+
+        identifier -- identifier of the item
+        """
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT sha256, source_name, source_md5, metadata FROM items WHERE identifier = ?',
+                (identifier,)).fetchone()
+        if row == None or not os.path.exists(self.get_object_path(row[0])):
+            return None
+        sha256, source_name, source_md5, metadata = row
+        return {
+            'identifier': identifier,
+            'sha256': sha256,
+            'path': self.get_object_path(sha256),
+            'source_name': source_name,
+            'source_md5': source_md5,
+            'metadata': json.loads(metadata)
+        }
+
+    def put_file(self, identifier, temp_path, metadata, source_name=None, source_md5=None):
+        """Move a downloaded file into the store and record it as the text of an item. If the
+        same text is already stored (e.g. under another identifier), the file is just deleted.
+        Returns the record of the item, like get.
+
+        identifier -- identifier of the item
+        temp_path -- file to move in, e.g. from make_temp_path
+        metadata -- JSON-friendly dict of metadata of the item, like its title
+        source_name -- name of the file at the source
+        source_md5 -- MD5 hex digest of the file according to the source
+        """
+        file_hash = hashlib.sha256()
+        with open(temp_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                file_hash.update(block)
+        sha256 = file_hash.hexdigest()
+        object_path = self.get_object_path(sha256)
+        if os.path.exists(object_path):
+            os.remove(temp_path)
+        else:
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            os.replace(temp_path, object_path)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?)',
+                (identifier, sha256, source_name, source_md5, json.dumps(metadata), time.time()))
+        return self.get(identifier)
@@ -0,0 +1,108 @@
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from src.utils.metrics import metrics
+
+# Put on the ready queue once every item has been fetched or has failed
+DONE = object()
+
+class IngestPipeline:
+    def __init__(self, source, store, fetch_workers=4, max_ready=8):
+        """Downloads items from a source into a content store on a few threads while the calling
+        thread tags the ones already downloaded, so the tagger doesn't wait on the network.
+        Items that are already in the store aren't downloaded again.
+
+        source -- where to get texts from, e.g. an InternetArchiveSource or DirectorySource
+        store -- ContentStore to keep downloaded texts in
+        fetch_workers -- number of items to download at once
+        max_ready -- number of downloaded items that can wait to be tagged before downloading pauses
+        """
+        self.source = source
+        self.store = store
+        self.fetch_workers = fetch_workers
+        self.max_ready = max_ready
+
+    def fetch(self, identifier):
+        """Download an item into the store. Returns its record."""
+        temp_path = self.store.make_temp_path()
+        try:
+            with metrics.time('ia_fetch_seconds', context=identifier):
+                metadata, source_name, source_md5 = self.source.fetch(identifier, temp_path)
+            metrics.increment('ia_fetch_bytes', os.path.getsize(temp_path))
+            return self.store.put_file(identifier, temp_path, metadata, source_name, source_md5)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def produce(self, identifiers, ready, slots, stopping):
+        """Queue every stored or downloaded item as ('cached' or 'downloaded', identifier, record),
+        or ('failed', identifier, exception), then DONE
+        """
+        def fetched(future, identifier):
+            if future.exception() != None:
+                ready.put(('failed', identifier, future.exception()))
+            else:
+                ready.put(('downloaded', identifier, future.result()))
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.fetch_workers) as executor:
+                seen = set()
+                for identifier in identifiers:
+                    if identifier in seen:
+                        continue
+                    seen.add(identifier)
+                    # Wait for the tagger to catch up, so downloads don't pile up on disk
+                    slots.acquire()
+                    if stopping.is_set():
+                        break
+                    record = self.store.get(identifier)
+                    if record != None:
+                        ready.put(('cached', identifier, record))
+                        continue
+                    future = executor.submit(self.fetch, identifier)
+                    future.add_done_callback(lambda future, identifier=identifier: fetched(future, identifier))
+        except Exception as exception:
+            # e.g. a search that failed part way through
+            ready.put(('failed', None, exception))
+        finally:
+            ready.put(DONE)
+
+    def run(self, identifiers, tag):
+        """Download items and tag each one as soon as it's in the store. Items are tagged in the
+        order their downloads finish. Returns the number of items that were 'downloaded', were
+        'cached' already, 'failed' to download and were 'tagged', and the failures as
+        [(identifier, exception)].
+
+        identifiers -- iterable of identifiers of items, e.g. from a source's search
+        tag -- function to call with the record (see ContentStore.get) of each item
+        """
+        ready = queue.Queue()
+        # Items being downloaded, plus items waiting to be tagged
+        slots = threading.Semaphore(self.fetch_workers + self.max_ready)
+        stopping = threading.Event()
+        stats = {'downloaded': 0, 'cached': 0, 'failed': 0, 'tagged': 0, 'failures': []}
+        producer = threading.Thread(target=self.produce, args=(identifiers, ready, slots, stopping),
+                                    name='IngestProducer', daemon=True)
+        producer.start()
+        try:
+            while True:
+                with metrics.time('ia_tagger_wait_seconds'):
+                    item = ready.get()
+                if item is DONE:
+                    break
+                status, identifier, result = item
+                slots.release()
+                stats[status] += 1
+                metrics.increment('ia_items', status=status)
+                if status == 'failed':
+                    stats['failures'].append((identifier, result))
+                    continue
+                tag(result)
+                stats['tagged'] += 1
+        finally:
+            stopping.set()
+            # Unblock the producer if it's waiting for a slot, then let running downloads finish
+            slots.release()
+            producer.join()
+        return stats
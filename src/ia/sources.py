@@ -0,0 +1,92 @@
+"""sources.py - Where the ingestion pipeline gets texts from
+
+A source has search(query), which yields the identifiers of matching items, and
+fetch(identifier, path), which downloads the text of an item to path and returns its metadata,
+the name of the file at the source and the file's MD5 (or None).
+"""
+import fnmatch
+import hashlib
+import json
+import os
+import shutil
+
+# Metadata fields kept from Internet Archive items, which the TEI header can use
+METADATA_FIELDS = ['title', 'creator', 'date', 'publisher', 'licenseurl']
+
+class InternetArchiveSource:
+    def __init__(self, glob_pattern='*djvu.txt'):
+        """Get texts from the Internet Archive. internetarchive is only imported here, so it only
+        needs to be installed to use this source.
+
+        glob_pattern -- pattern of the name of the file of an item to get
+        """
+        import internetarchive
+        self.internetarchive = internetarchive
+        self.glob_pattern = glob_pattern
+
+    def search(self, query):
+        for result in self.internetarchive.search_items(query):
+            yield result['identifier']
+
+    def fetch(self, identifier, path):
+        item = self.internetarchive.get_item(identifier)
+        files = list(item.get_files(glob_pattern=self.glob_pattern))
+        if not files:
+            raise LookupError(f'{identifier} has no file matching {self.glob_pattern}')
+        files[0].download(file_path=path)
+        metadata = {field: item.metadata[field] for field in METADATA_FIELDS if field in item.metadata}
+        return metadata, files[0].name, files[0].md5
+
+class DirectorySource:
+    def __init__(self, root, glob_pattern='*djvu.txt'):
+        """Stand-in for the Internet Archive that serves items from a local directory, laid out
+        like root/IDENTIFIER/IDENTIFIER_djvu.txt, with the item's metadata in an optional
+        root/IDENTIFIER/metadata.json
+
+        root -- directory of the items
+        glob_pattern -- pattern of the name of the file of an item to get
+        """
+        self.root = root
+        self.glob_pattern = glob_pattern
+
+    def get_metadata(self, identifier):
+        metadata_path = os.path.join(self.root, identifier, 'metadata.json')
+        if not os.path.exists(metadata_path):
+            return dict()
+        with open(metadata_path, 'r') as metadata_file:
+            metadata = json.load(metadata_file)
+        return {field: metadata[field] for field in METADATA_FIELDS if field in metadata}
+
+    def search(self, query):
+        """Yield the identifiers of the items matching every term of a query. A term is either
+        field:value, which matches items whose metadata field contains value (ignoring case), or a
+        glob pattern matched against the identifier.
+        """
+        terms = query.split()
+        for identifier in sorted(os.listdir(self.root)):
+            if not os.path.isdir(os.path.join(self.root, identifier)):
+                continue
+            metadata = self.get_metadata(identifier)
+            matches = True
+            for term in terms:
+                if ':' in term:
+                    field, value = term.split(':', 1)
+                    matches = value.lower() in str(metadata.get(field, '')).lower()
+                else:
+                    matches = fnmatch.fnmatch(identifier, term)
+                if not matches:
+                    break
+            if matches:
+                yield identifier
+
+    def fetch(self, identifier, path):
+        item_dir = os.path.join(self.root, identifier)
+        if not os.path.isdir(item_dir):
+            raise LookupError(f'No item {identifier}')
+        names = sorted(fnmatch.filter(os.listdir(item_dir), self.glob_pattern))
+        if not names:
+            raise LookupError(f'{identifier} has no file matching {self.glob_pattern}')
+        shutil.copyfile(os.path.join(item_dir, names[0]), path)
+        with open(path, 'rb') as f:
+            md5 = hashlib.md5(f.read()).hexdigest()
+        return self.get_metadata(identifier), names[0], md5
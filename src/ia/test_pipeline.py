@@ -0,0 +1,123 @@
+import json
+import os
+import threading
+from benchmarks.fixtures import make_synthetic_fixture
+from src.ia.content_store import ContentStore
+from src.ia.pipeline import IngestPipeline
+from src.ia.sources import DirectorySource
+from src.ner.backends import ReplayTagger
+from src.ner.flair_ner import NamedEntityRecognizer
+from src.tei.assemble_document import stream_document
+
+class CountingSource(DirectorySource):
+    """DirectorySource that counts the items it's asked to fetch"""
+    def __init__(self, root):
+        super().__init__(root)
+        self.fetched = []
+        self.lock = threading.Lock()
+
+    def fetch(self, identifier, path):
+        with self.lock:
+            self.fetched.append(identifier)
+        return super().fetch(identifier, path)
+
+def make_books(root, books):
+    """Lay out books like DirectorySource expects them
+
+    books -- {identifier: (paragraphs, metadata)}
+    """
+    for identifier, (paragraphs, metadata) in books.items():
+        os.makedirs(root / identifier)
+        with open(root / identifier / f'{identifier}_djvu.txt', 'w') as book:
+            book.write('\n\n'.join(paragraphs))
+        with open(root / identifier / 'metadata.json', 'w') as metadata_file:
+            json.dump(metadata, metadata_file)
+
+def make_corpus(tmp_path, book_count=6):
+    paragraphs, recording = make_synthetic_fixture(book_count * 5)
+    books = {f'nile{number:02}': (paragraphs[number * 5:(number + 1) * 5],
+                                  {'title': f'Nile Journal {number}', 'creator': 'Amelia Edwards' if number % 2 else 'Lucie Duff Gordon'})
+             for number in range(book_count)}
+    make_books(tmp_path / 'source', books)
+    return books, recording
+
+def run_pipeline(source, store, identifiers, fetch_workers=3):
+    tagged = []
+    stats = IngestPipeline(source, store, fetch_workers, max_ready=2).run(
+        identifiers, lambda record: tagged.append(record['identifier']))
+    return stats, tagged
+
+def test_items_are_downloaded_once_and_tagged(tmp_path):
+    books, _ = make_corpus(tmp_path)
+    source = CountingSource(str(tmp_path / 'source'))
+    store = ContentStore(str(tmp_path / 'store'))
+    stats, tagged = run_pipeline(source, store, sorted(books))
+    assert sorted(tagged) == sorted(books)
+    assert (stats['downloaded'], stats['cached'], stats['failed'], stats['tagged']) == (6, 0, 0, 6)
+    record = store.get('nile03')
+    with open(record['path'], 'r') as book:
+        assert book.read() == '\n\n'.join(books['nile03'][0])
+    assert record['metadata']['title'] == 'Nile Journal 3'
+    assert os.listdir(tmp_path / 'store' / 'tmp') == []
+    store.close()
+
+    # A second run picks up where the first left off, without downloading anything again
+    store = ContentStore(str(tmp_path / 'store'))
+    source.fetched = []
+    stats, tagged = run_pipeline(source, store, sorted(books) + ['nile00'])
+    assert source.fetched == []
+    assert (stats['downloaded'], stats['cached'], stats['tagged']) == (0, 6, 6)
+    store.close()
+
+def test_failed_downloads_dont_stop_the_others(tmp_path):
+    books, _ = make_corpus(tmp_path, 3)
+    store = ContentStore(str(tmp_path / 'store'))
+    stats, tagged = run_pipeline(DirectorySource(str(tmp_path / 'source')), store,
+                                 ['nile00', 'missing', 'nile01', 'nile02'])
+    assert sorted(tagged) == ['nile00', 'nile01', 'nile02']
+    assert stats['failed'] == 1
+    identifier, exception = stats['failures'][0]
+    assert identifier == 'missing' and isinstance(exception, LookupError)
+    assert store.get('missing') == None
+    store.close()
+
+def test_same_text_is_stored_once(tmp_path):
+    paragraphs, _ = make_synthetic_fixture(3)
+    make_books(tmp_path / 'source', {'copy1': (paragraphs, {}), 'copy2': (paragraphs, {})})
+    store = ContentStore(str(tmp_path / 'store'))
+    run_pipeline(DirectorySource(str(tmp_path / 'source')), store, ['copy1', 'copy2'])
+    assert store.get('copy1')['path'] == store.get('copy2')['path']
+    objects = [name for _, _, names in os.walk(tmp_path / 'store' / 'objects') for name in names]
+    assert len(objects) == 1
+    store.close()
+
+def test_search_matches_fields_and_identifiers(tmp_path):
+    make_corpus(tmp_path)
+    source = DirectorySource(str(tmp_path / 'source'))
+    assert list(source.search('creator:edwards')) == ['nile01', 'nile03', 'nile05']
+    assert list(source.search('nile0[12] creator:duff')) == ['nile02']
+    assert list(source.search('title:journal')) == [f'nile{number:02}' for number in range(6)]
+    # Fields that aren't kept from the metadata never match
+    assert list(source.search('subject:nile')) == []
+
+def test_tagging_stored_books(tmp_path):
+    books, recording = make_corpus(tmp_path, 2)
+    ner = NamedEntityRecognizer(None, ['Person', 'City'], 0.5, True, 'nile', tagger_backend='fake')
+    ner.tagger = ReplayTagger(recording)
+    store = ContentStore(str(tmp_path / 'store'))
+    os.makedirs(tmp_path / 'tei')
+
+    def tag(record):
+        with open(record['path'], 'r') as book:
+            stream_document(ner, book, str(tmp_path / 'tei' / f"{record['identifier']}.tei"),
+                            title=record['metadata']['title'])
+
+    stats = IngestPipeline(DirectorySource(str(tmp_path / 'source')), store).run(sorted(books), tag)
+    assert stats['tagged'] == 2
+    with open(tmp_path / 'tei' / 'nile01.tei', 'r') as tei:
+        document = tei.read()
+    assert '<title>Nile Journal 1</title>' in document
+    body = document[document.index('<body>'):]
+    assert body.count('<p>') == 5
+    assert 'urn:teiindex:nile:' in body
+    store.close()
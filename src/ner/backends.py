@@ -0,0 +1,243 @@
+"""backends.py - Taggers NamedEntityRecognizer can use instead of (or as) the Wolfram kernel
+
+Every backend has the same interface as wlflairshim.SequenceTagger: predict(text, **kwargs),
+predict_batch(texts, batch_bytes, **kwargs) and close(), returning Flair-like outputs of the form
+{"text": text, "entities": [{"text", "start_pos", "end_pos", "type", "confidence",
+"interpretation"}, ...]}.
+"""
+import json
+import re
+from abc import ABC, abstractmethod
+from wolframclient.language import wl
+from wolframclient.serializers import export
+from wolframclient.deserializers import binary_deserialize
+from .kernel_pool import KernelPool
+from .wlflairshim import SequenceTagger, DEFAULT_BATCH_BYTES
+
+class TaggerBackend(ABC):
+    """Base class of taggers that tag each text on its own, without any batching. Subclasses must
+    implement find_entities; those that tag in batches also override predict_batch.
+    """
+    def close(self):
+        """Free whatever the tagger holds on to"""
+        pass
+
+    def predict(self, text: str, **kwargs) -> dict:
+        """Get text entities in text. See SequenceTagger.predict"""
+        return self.predict_batch([text], **kwargs)[0]
+
+    def predict_batch(self, texts: list, batch_bytes=DEFAULT_BATCH_BYTES, **kwargs) -> list:
+        """Get text entities in many texts. See SequenceTagger.predict_batch
+
+        texts -- list of texts to get entities from
+        batch_bytes -- ignored, texts are tagged one at a time
+        """
+        return [{"text": text, "entities": self.find_entities(text, kwargs.get("entity_types"))}
+                for text in texts]
+
+    @abstractmethod
+    def find_entities(self, text, entity_types):
+        """Get the entities in a text
+
+        text -- text to get entities from
+        entity_types -- list of entity types to include, or None to include every type
+        """
+
+class FakeTagger(TaggerBackend):
+    def __init__(self, entity_type='Person'):
+        """Deterministic stand-in for the Wolfram kernel, e.g. for tests and benchmarks. Tags every
+        run of capitalised words as an entity of entity_type, interpreted as a Wolfram Entity
+        named after its text. Remembers every text it was asked to tag.
+
+        entity_type -- type given to every entity
+        """
+        self.entity_type = entity_type
+        self.texts = []
+
+    def find_entities(self, text, entity_types):
+        self.texts.append(text)
+        if entity_types != None and self.entity_type not in entity_types:
+            return []
+        return [{
+            "text": match.group(),
+            "start_pos": match.start(),
+            "end_pos": match.end(),
+            "type": self.entity_type,
+            "confidence": 1.0,
+            "interpretation": wl.Entity(self.entity_type, match.group())
+        } for match in re.finditer(r"\b[A-Z][a-z]+(?: [A-Z][a-z]+)*\b", text)]
+
+class GazetteerTagger(TaggerBackend):
+    def __init__(self, entries):
+        """Tag known names with a regular expression, without a kernel
+
+        entries -- list of dicts with the "text" of a name, its entity "type", and optionally the
+            "entity" [type, canonical name] of the Wolfram Entity it stands for and its "confidence"
+        """
+        self.entries = dict()
+        for entry in entries:
+            self.entries[entry["text"]] = entry
+        # Longest names first, so "New York City" wins over "New York"
+        names = sorted(self.entries, key=len, reverse=True)
+        self.pattern = re.compile(r"\b(?:" + "|".join(re.escape(name) for name in names) + r")\b") if names else None
+
+    @classmethod
+    def from_file(cls, path):
+        """Load a gazetteer from a JSON file holding a list of entries (see __init__)"""
+        with open(path, 'r') as gazetteer_file:
+            return cls(json.load(gazetteer_file))
+
+    def find_entities(self, text, entity_types):
+        if self.pattern == None:
+            return []
+        entities = []
+        for match in self.pattern.finditer(text):
+            entry = self.entries[match.group()]
+            if entity_types != None and entry["type"] not in entity_types:
+                continue
+            entities.append({
+                "text": match.group(),
+                "start_pos": match.start(),
+                "end_pos": match.end(),
+                "type": entry["type"],
+                "confidence": entry.get("confidence", 1.0),
+                "interpretation": wl.Entity(*entry["entity"]) if "entity" in entry else match.group()
+            })
+        return entities
+
+class RecordingTagger(TaggerBackend):
+    def __init__(self, tagger):
+        """Pass texts on to another tagger and record what it returns, so the responses can be
+        replayed later with ReplayTagger, e.g. in benchmarks on machines without a kernel
+
+        tagger -- tagger to record the responses of
+        """
+        self.tagger = tagger
+        # Looks like {text: [entities]}
+        self.recording = dict()
+
+    def close(self):
+        self.tagger.close()
+
+    def predict_batch(self, texts: list, batch_bytes=DEFAULT_BATCH_BYTES, **kwargs) -> list:
+        outputs = self.tagger.predict_batch(texts, batch_bytes, **kwargs)
+        for output in outputs:
+            self.recording[output["text"]] = output["entities"]
+        return outputs
+
+    def find_entities(self, text, entity_types):
+        kwargs = {"entity_types": entity_types} if entity_types != None else dict()
+        return self.predict_batch([text], **kwargs)[0]["entities"]
+
+    def save(self, path):
+        """Save the responses recorded so far to a WXF file that ReplayTagger.from_file can read"""
+        with open(path, 'wb') as recording_file:
+            export([[text, entities] for text, entities in self.recording.items()],
+                   stream=recording_file, target_format='wxf')
+
+class ReplayTagger(TaggerBackend):
+    def __init__(self, recording, fallback=None):
+        """Give back recorded tagger responses instead of tagging
+
+        recording -- dict mapping each text to the list of entities the tagger returned for it
+        fallback -- tagger for texts that weren't recorded, or None to raise a KeyError for them
+        """
+        self.recording = recording
+        self.fallback = fallback
+
+    @classmethod
+    def from_file(cls, path, fallback=None):
+        """Load responses saved with RecordingTagger.save"""
+        with open(path, 'rb') as recording_file:
+            recording = binary_deserialize(recording_file.read())
+        return cls({text: [dict(entity) for entity in entities] for text, entities in recording}, fallback)
+
+    def find_entities(self, text, entity_types):
+        entities = self.recording.get(text)
+        if entities == None:
+            if self.fallback == None:
+                raise KeyError(f'No recorded response for "{text[:50]}"')
+            return self.fallback.find_entities(text, entity_types)
+        return [dict(entity) for entity in entities
+                if entity_types == None or entity["type"] in entity_types]
+
+# Flair's CoNLL-03 labels as the closest Wolfram entity types
+flair_type_map = {
+    'PER': 'Person',
+    'LOC': 'City',
+    'ORG': 'Company',
+    'MISC': 'MISC'
+}
+
+class FlairTagger(TaggerBackend):
+    def __init__(self, model='ner', mini_batch_size=32):
+        """Tag with a Flair sequence tagger. Flair is only imported here, so it only needs to be
+        installed to use this backend. Entities are interpreted as their own text, so they get no
+        Wolfram URN and aren't put in the TEI index.
+
+        model -- name or path of the Flair model to load
+        mini_batch_size -- number of sentences Flair tags at once
+        """
+        from flair.data import Sentence
+        from flair.models import SequenceTagger as FlairSequenceTagger
+        self.sentence_class = Sentence
+        self.tagger = FlairSequenceTagger.load(model)
+        self.mini_batch_size = mini_batch_size
+
+    def predict_batch(self, texts: list, batch_bytes=DEFAULT_BATCH_BYTES, **kwargs) -> list:
+        entity_types = kwargs.get("entity_types")
+        sentences = [self.sentence_class(text) for text in texts]
+        self.tagger.predict([sentence for sentence in sentences if len(sentence) > 0],
+                            mini_batch_size=self.mini_batch_size)
+        outputs = []
+        for text, sentence in zip(texts, sentences):
+            entities = []
+            for span in sentence.get_spans('ner'):
+                label = span.labels[0]
+                entity_type = flair_type_map.get(label.value, label.value)
+                if entity_types != None and entity_type not in entity_types:
+                    continue
+                entities.append({
+                    "text": span.text,
+                    "start_pos": span.start_pos,
+                    "end_pos": span.end_pos,
+                    "type": entity_type,
+                    "confidence": label.score,
+                    "interpretation": span.text
+                })
+            outputs.append({"text": text, "entities": entities})
+        return outputs
+
+    def find_entities(self, text, entity_types):
+        kwargs = {"entity_types": entity_types} if entity_types != None else dict()
+        return self.predict_batch([text], **kwargs)[0]["entities"]
+
+def create_tagger(backend='wolfram', wl_kernel=None, kernel_pool_size=1, kernel_licence_limit=None,
+                  cache_dir=None, session_options=None, gazetteer_path=None, flair_model='ner',
+                  recording_path=None):
+    """Create the tagger of a backend
+
+    backend -- "wolfram", "gazetteer", "flair", "replay" or "fake"
+    wl_kernel -- location of Wolfram kernel (wolfram backend)
+    kernel_pool_size -- number of Wolfram kernels; more than 1 starts a KernelPool (wolfram backend)
+    kernel_licence_limit -- maximum number of kernels our licence allows (wolfram backend)
+    cache_dir -- directory of the persistent TextContents cache (wolfram backend)
+    session_options -- keyword args of the session of each kernel, see SequenceTagger (wolfram backend)
+    gazetteer_path -- JSON file of gazetteer entries (gazetteer backend)
+    flair_model -- name or path of the Flair model (flair backend)
+    recording_path -- WXF file of responses saved with RecordingTagger.save (replay backend)
+    """
+    if backend == 'wolfram':
+        if kernel_pool_size > 1:
+            return KernelPool(wl_kernel, kernel_pool_size, kernel_licence_limit, cache_dir=cache_dir,
+                              session_options=session_options)
+        return SequenceTagger(wl_kernel, cache_dir, session_options)
+    if backend == 'gazetteer':
+        return GazetteerTagger.from_file(gazetteer_path)
+    if backend == 'flair':
+        return FlairTagger(flair_model)
+    if backend == 'replay':
+        return ReplayTagger.from_file(recording_path)
+    if backend == 'fake':
+        return FakeTagger()
+    raise ValueError(f'Unknown tagger backend "{backend}"')
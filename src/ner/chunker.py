@@ -0,0 +1,144 @@
+import bisect
+import re
+from collections import namedtuple
+
+# The end of a sentence and the whitespace after it
+sentence_end_pattern = re.compile(r'[.!?]+["\')\]’”]*\s+')
+whitespace_pattern = re.compile(r'\s+')
+
+# A stretch of one text that is part of a work unit. The stretch covers text_start to text_end of
+# the text, and starts at unit_offset in the unit. Entities that start at or after next_start are
+# also seen by the next piece of a split text, which has more of the text after them, and belong
+# to it. next_start is None for the last piece of a text.
+Segment = namedtuple('Segment', ['text_index', 'unit_offset', 'text_start', 'text_end', 'next_start'])
+
+class WorkUnit:
+    def __init__(self, separator):
+        """Text sent to the tagger in one piece, made of stretches of one or more texts"""
+        self.separator = separator
+        self.parts = []
+        self.length = 0
+        self.segments = []
+        # unit_offset of each segment, for bisecting
+        self.offsets = []
+
+    @property
+    def text(self):
+        return ''.join(self.parts)
+
+    def add(self, text, text_index, text_start, text_end, next_start):
+        if self.segments:
+            self.parts.append(self.separator)
+            self.length += len(self.separator)
+        self.segments.append(Segment(text_index, self.length, text_start, text_end, next_start))
+        self.offsets.append(self.length)
+        self.parts.append(text[text_start:text_end])
+        self.length += text_end - text_start
+
+    def get_segment(self, start_pos, end_pos):
+        """Get the segment an entity of the unit is in, or None if it crosses a separator"""
+        segment = self.segments[bisect.bisect_right(self.offsets, start_pos) - 1]
+        if end_pos > segment.unit_offset + segment.text_end - segment.text_start:
+            return None
+        return segment
+
+class Chunker:
+    def __init__(self, target_chars=4000, overlap_chars=200, separator='\n\n'):
+        """Turn texts into work units of about target_chars characters for the tagger. Texts longer
+        than that are split on sentence boundaries (or whitespace if there are none), each piece
+        starting up to overlap_chars before the end of the last so an entity on the boundary is
+        seen whole by the later one. Consecutive short texts are joined into one unit with separator.
+        Entities found in the units are mapped back to the texts they came from by reassemble.
+
+        target_chars -- number of characters to aim for in a work unit
+        overlap_chars -- number of characters of the previous piece a piece of a split text starts with
+        separator -- what to join short texts with; it should end paragraphs for the tagger
+        """
+        self.target_chars = target_chars
+        self.overlap_chars = min(overlap_chars, target_chars // 4)
+        self.separator = separator
+
+    def split(self, text):
+        """Split a text into overlapping pieces of at most target_chars characters (plus the
+        overlap). Returns (start, end, start of the next piece or None) of each piece; a piece owns
+        the entities that start before the next piece does.
+        """
+        pieces = []
+        owned_start = 0
+        while len(text) - owned_start > self.target_chars:
+            end = self.find_boundary(text, owned_start + self.target_chars // 2, owned_start + self.target_chars)
+            pieces.append((self.find_piece_start(text, owned_start), end))
+            owned_start = end
+        pieces.append((self.find_piece_start(text, owned_start), len(text)))
+        return [(start, end, pieces[index + 1][0] if index + 1 < len(pieces) else None)
+                for index, (start, end) in enumerate(pieces)]
+
+    def find_boundary(self, text, low, high):
+        """Find where to end a piece between low and high: after the last sentence end, failing
+        that after the last whitespace, failing that at high
+        """
+        for pattern in [sentence_end_pattern, whitespace_pattern]:
+            boundary = None
+            for match in pattern.finditer(text, low, high):
+                boundary = match.end()
+            if boundary != None:
+                return boundary
+        return high
+
+    def find_piece_start(self, text, owned_start):
+        """Find where a piece that owns from owned_start should start, so it begins with up to
+        overlap_chars of the piece before: at the first sentence or word start in that window
+        """
+        if owned_start == 0:
+            return 0
+        low = max(0, owned_start - self.overlap_chars)
+        for pattern in [sentence_end_pattern, whitespace_pattern]:
+            match = pattern.search(text, low, owned_start)
+            if match != None and match.end() < owned_start:
+                return match.end()
+        return low
+
+    def plan(self, texts):
+        """Turn texts into work units. Returns the list of units; send the text of each to the
+        tagger, then give the outputs to reassemble.
+
+        texts -- list of texts to tag
+        """
+        units = []
+        unit = None
+        for text_index, text in enumerate(texts):
+            for start, end, next_start in self.split(text):
+                length = end - start
+                if unit == None or unit.length + len(self.separator) + length > self.target_chars:
+                    unit = WorkUnit(self.separator)
+                    units.append(unit)
+                unit.add(text, text_index, start, end, next_start)
+        return units
+
+    def reassemble(self, units, outputs, text_count):
+        """Map the entities the tagger found in work units back to the texts they came from.
+        Returns the list of entities of each text. Entities that cross from one text into the next
+        are dropped, and entities that start in the overlap of two pieces are only kept from the
+        later piece, which sees them whole even if the earlier piece ends in the middle of them.
+
+        units -- work units made by plan
+        outputs -- Flair-like tagger output of each unit
+        text_count -- number of texts given to plan
+        """
+        entities = [dict() for _ in range(text_count)]
+        for unit, output in zip(units, outputs):
+            for entity in output['entities']:
+                segment = unit.get_segment(entity['start_pos'], entity['end_pos'])
+                if segment == None:
+                    continue
+                shift = segment.text_start - segment.unit_offset
+                start_pos = entity['start_pos'] + shift
+                end_pos = entity['end_pos'] + shift
+                if segment.next_start != None and start_pos >= segment.next_start:
+                    continue # Belongs to the next piece
+                key = (start_pos, end_pos, entity['type'])
+                found = entities[segment.text_index]
+                if key not in found or entity['confidence'] > found[key]['confidence']:
+                    found[key] = {**entity, 'start_pos': start_pos, 'end_pos': end_pos}
+        return [sorted(found.values(), key=lambda entity: (entity['start_pos'], entity['end_pos']))
+                for found in entities]
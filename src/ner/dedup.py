@@ -0,0 +1,226 @@
+import bisect
+import hashlib
+import random
+import re
+import threading
+import zlib
+from collections import OrderedDict
+from ..utils.metrics import metrics
+
+# A page number at the start or end of a running header, e.g. "12 THE NILE" or "THE NILE. Page 13".
+# Four digits are more likely a year than a page.
+leading_page_number_pattern = re.compile(r'^\W*(?:(?:page|p\.)\s*)?\d{1,3}\b\W*', re.IGNORECASE)
+trailing_page_number_pattern = re.compile(r'\W*\b(?:(?:page|p\.)\s*)?\d{1,3}\W*$', re.IGNORECASE)
+# Only one-line paragraphs up to this long are taken for running headers whose page numbers are
+# stripped, so a paragraph of prose that starts with a year keeps it
+MAX_HEADER_CHARS = 100
+# Paragraphs longer than this are never checked for boilerplate
+MAX_BOILERPLATE_CHARS = 2000
+# Modulus of the MinHash permutations, a Mersenne prime larger than any CRC-32
+MINHASH_PRIME = (1 << 61) - 1
+
+def normalize(paragraph):
+    """Get the form of a paragraph duplicates are found by: case-folded, whitespace collapsed into
+    single spaces, and page numbers stripped from running headers. Returns the normalised text and
+    the index in paragraph of each of its characters.
+    """
+    start, end = 0, len(paragraph)
+    if len(paragraph) <= MAX_HEADER_CHARS and '\n' not in paragraph.strip():
+        match = leading_page_number_pattern.match(paragraph)
+        if match != None:
+            start = match.end()
+        match = trailing_page_number_pattern.search(paragraph, start)
+        if match != None:
+            end = match.start()
+    characters = []
+    positions = []
+    for match in re.finditer(r'\S+', paragraph[start:end]):
+        if characters:
+            characters.append(' ')
+            positions.append(start + match.start() - 1)
+        for offset, character in enumerate(match.group(), start + match.start()):
+            # Some characters case-fold into two, which both stand for the original
+            for folded in character.casefold():
+                characters.append(folded)
+                positions.append(offset)
+    return ''.join(characters), positions
+
+class MinHasher:
+    def __init__(self, permutations=32, bands=8, seed=0):
+        """MinHash signatures of word 3-shingles, with locality-sensitive hashing of the
+        signatures in bands to find candidate near-duplicates quickly
+
+        permutations -- number of hash functions in a signature
+        bands -- number of bands the signature is split into; candidates share at least one band
+        seed -- seed of the hash functions
+        """
+        generator = random.Random(seed)
+        self.permutations = [(generator.randrange(1, MINHASH_PRIME), generator.randrange(MINHASH_PRIME))
+                             for _ in range(permutations)]
+        self.rows = permutations // bands
+
+    def get_signature(self, normalized):
+        words = normalized.split(' ')
+        shingles = {' '.join(words[index:index + 3]) for index in range(max(len(words) - 2, 1))}
+        hashes = [zlib.crc32(shingle.encode('utf-8')) for shingle in shingles]
+        return tuple(min((a * value + b) % MINHASH_PRIME for value in hashes) for a, b in self.permutations)
+
+    def get_bands(self, signature):
+        return [(index, signature[index * self.rows:(index + 1) * self.rows])
+                for index in range(len(signature) // self.rows)]
+
+class ParagraphDeduplicator:
+    def __init__(self, max_paragraphs=100000, boilerplate=False, boilerplate_similarity=0.8,
+                 boilerplate_occurrences=3):
+        """Remembers what the tagger found in the paragraphs it tagged, so a paragraph that comes
+        again later in the corpus (e.g. a running header or a repeated licence notice) isn't tagged
+        again. Paragraphs are duplicates if they're the same once normalised (see normalize), and
+        the entities of the first one are moved onto the others.
+
+        With boilerplate set, paragraphs that are near-duplicates of one seen at least
+        boilerplate_occurrences times before (similar but not the same, e.g. because of OCR errors)
+        are flagged as boilerplate, and not tagged at all.
+
+        max_paragraphs -- number of unique paragraphs to remember; the least recently seen are forgotten
+        boilerplate -- skip paragraphs that are near-duplicates of frequent ones
+        boilerplate_similarity -- estimated Jaccard similarity of word 3-shingles from which two
+            paragraphs are near-duplicates
+        boilerplate_occurrences -- number of times a paragraph or its near-duplicates must have
+            been seen before the next near-duplicate is skipped as boilerplate
+        """
+        self.max_paragraphs = max_paragraphs
+        # Looks like {normalised text digest: ([(normalised start, normalised end, entity)], cluster)}
+        self.paragraphs = OrderedDict()
+        self.boilerplate = boilerplate
+        self.boilerplate_similarity = boilerplate_similarity
+        self.boilerplate_occurrences = boilerplate_occurrences
+        self.hasher = MinHasher() if boilerplate else None
+        # Near-duplicate clusters, each looking like [signature of its first paragraph, paragraphs seen]
+        self.clusters = []
+        # Looks like {(band index, band): [cluster index]}
+        self.buckets = dict()
+        self.stats = {'paragraphs': 0, 'duplicates': 0, 'boilerplate': 0}
+        # Held while looking paragraphs up and remembering them, but not while tagging
+        self.lock = threading.Lock()
+
+    def get_stats(self):
+        """Gets how many paragraphs were seen, how many were duplicates or boilerplate, and the
+        fraction of paragraphs that didn't need tagging
+        """
+        stats = dict(self.stats)
+        skipped = stats['duplicates'] + stats['boilerplate']
+        stats['dedup_ratio'] = skipped / stats['paragraphs'] if stats['paragraphs'] else 0.0
+        return stats
+
+    def predict(self, texts, predict):
+        """Gets the entities in each text like predict does, only tagging texts that aren't
+        duplicates or boilerplate, and each unique text only once
+
+        texts -- list of texts to tag
+        predict -- function that tags a list of texts, returning the list of entities of each
+        """
+        results = [None] * len(texts)
+        # Looks like {digest: (cluster, [(index of the text, positions of its normalised characters)])}
+        to_tag = OrderedDict()
+        with self.lock:
+            self.find_duplicates(texts, results, to_tag)
+        if not to_tag:
+            return results
+
+        tagged = predict([texts[occurrences[0][0]] for _, occurrences in to_tag.values()])
+        with self.lock:
+            for (digest, (cluster, occurrences)), entities in zip(to_tag.items(), tagged):
+                first_index, first_positions = occurrences[0]
+                results[first_index] = entities
+                normalized_entities = self.to_normalized(first_positions, entities)
+                for index, positions in occurrences[1:]:
+                    results[index] = self.fan_out(texts[index], positions, normalized_entities)
+                self.paragraphs[digest] = (normalized_entities, cluster)
+                if len(self.paragraphs) > self.max_paragraphs:
+                    self.paragraphs.popitem(last=False)
+        return results
+
+    def find_duplicates(self, texts, results, to_tag):
+        """Fill in the entities of texts that are duplicates of ones tagged before or boilerplate,
+        and group the rest by their normalised text in to_tag
+        """
+        duplicates, boilerplate = self.stats['duplicates'], self.stats['boilerplate']
+        for index, text in enumerate(texts):
+            self.stats['paragraphs'] += 1
+            normalized, positions = normalize(text)
+            digest = hashlib.blake2b(normalized.encode('utf-8'), digest_size=16).digest()
+            known = self.paragraphs.get(digest)
+            if known != None:
+                self.paragraphs.move_to_end(digest)
+                self.count_occurrence(known[1])
+                results[index] = self.fan_out(text, positions, known[0])
+                self.stats['duplicates'] += 1
+            elif digest in to_tag:
+                self.count_occurrence(to_tag[digest][0])
+                to_tag[digest][1].append((index, positions))
+                self.stats['duplicates'] += 1
+            else:
+                cluster = self.find_cluster(normalized) if self.boilerplate else None
+                if self.count_occurrence(cluster) > self.boilerplate_occurrences:
+                    results[index] = []
+                    self.stats['boilerplate'] += 1
+                else:
+                    to_tag[digest] = (cluster, [(index, positions)])
+        metrics.increment('dedup_paragraphs', len(texts))
+        metrics.increment('dedup_duplicates', self.stats['duplicates'] - duplicates)
+        metrics.increment('dedup_boilerplate', self.stats['boilerplate'] - boilerplate)
+
+    def to_normalized(self, positions, entities):
+        """Move entities of a text onto its normalised text. Entities in what normalising
+        stripped (e.g. a page number) are dropped.
+        """
+        normalized_entities = []
+        for entity in entities:
+            start = bisect.bisect_left(positions, entity['start_pos'])
+            end = bisect.bisect_left(positions, entity['end_pos'])
+            if start < end:
+                normalized_entities.append((start, end, entity))
+        return normalized_entities
+
+    def fan_out(self, text, positions, normalized_entities):
+        """Move entities of a normalised text onto a text that normalises to it"""
+        entities = []
+        for start, end, entity in normalized_entities:
+            start_pos = positions[start]
+            end_pos = positions[end - 1] + 1
+            entities.append({**entity, 'text': text[start_pos:end_pos], 'start_pos': start_pos,
+                             'end_pos': end_pos})
+        return entities
+
+    def find_cluster(self, normalized):
+        """Get the index of the near-duplicate cluster of a normalised paragraph, starting a new
+        cluster if it has no near-duplicates. Returns None if it's too long to be boilerplate.
+        """
+        if len(normalized) > MAX_BOILERPLATE_CHARS:
+            return None
+        signature = self.hasher.get_signature(normalized)
+        bands = self.hasher.get_bands(signature)
+        best, best_similarity = None, self.boilerplate_similarity
+        for band in bands:
+            for cluster in self.buckets.get(band, []):
+                cluster_signature = self.clusters[cluster][0]
+                similarity = sum(1 for a, b in zip(signature, cluster_signature) if a == b) / len(signature)
+                if similarity >= best_similarity:
+                    best, best_similarity = cluster, similarity
+        if best != None:
+            return best
+        if len(self.clusters) >= self.max_paragraphs:
+            return None
+        self.clusters.append([signature, 0])
+        for band in bands:
+            self.buckets.setdefault(band, []).append(len(self.clusters) - 1)
+        return len(self.clusters) - 1
+
+    def count_occurrence(self, cluster):
+        """Count another paragraph of a near-duplicate cluster. Returns the number of paragraphs
+        of the cluster seen so far, including this one.
+        """
+        if cluster == None:
+            return 0
+        self.clusters[cluster][1] += 1
+        return self.clusters[cluster][1]
@@ -0,0 +1,314 @@
+"""entity_record.py - Compact in-memory and on-disk form of tagged entities
+
+NamedEntityRecognizer turns the Flair-like entity dicts taggers return (which hold whole
+wolframclient expressions) into EntityRecords, which only keep what the TEI builders and the
+TEI index need. AnnotationWriter and read_annotations store tagged paragraphs in a binary file,
+so tagging and rendering can happen at different times.
+
+An annotation file starts with ANNOTATIONS_MAGIC, followed by records that each start with a
+record type byte:
+    H -- metadata of the document as JSON, e.g. the hash of the text it was tagged from
+    S -- a string, referred to by its index among the S records
+    P -- a paragraph with its text, then its entities
+    O -- a standoff paragraph: its offset and length in the text, then its entities
+"""
+import functools
+import json
+import struct
+import sys
+import threading
+from collections import namedtuple
+from wolframclient.language import wl
+
+# What an EntityRecord's payload holds, depending on its interpretation
+KIND_OTHER = 0 # payload is None
+KIND_ENTITY = 1 # payload is a WolframEntity
+KIND_QUANTITY = 2 # payload is (quantity, unit) strings
+KIND_DATE = 3 # payload is a tuple of 1 to 3 date part strings (year, month, day)
+KIND_GEO = 4 # payload is (latitude, longitude) strings
+
+# Entity types are stored as small ints in records, looked up in this table
+entity_types = []
+entity_type_ids = dict()
+entity_types_lock = threading.Lock()
+
+def get_type_id(entity_type):
+    """Get the id of an entity type, giving it a new one if it hasn't been seen before
+
+    entity_type -- name of the entity type, e.g. "City"
+    """
+    type_id = entity_type_ids.get(entity_type)
+    if type_id == None:
+        with entity_types_lock:
+            type_id = entity_type_ids.get(entity_type)
+            if type_id == None:
+                type_id = len(entity_types)
+                entity_types.append(entity_type)
+                entity_type_ids[entity_type] = type_id
+    return type_id
+
+# Number of recently made WolframEntities kept, so records of the same entity share one. Bounded
+# so a long run over many books doesn't keep every entity it has ever seen; an entity that has
+# fallen out only costs a duplicate tuple.
+WOLFRAM_ENTITY_CACHE_SIZE = 65536
+
+class WolframEntity(namedtuple('WolframEntity', ['type', 'canonical_name'])):
+    """A Wolfram Language Entity[type, canonical name], with the canonical name kept as compact
+    JSON instead of as a wolframclient expression
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_wl(cls, interpretation):
+        """Make a WolframEntity out of a wolframclient Entity[...] expression. The same entity
+        comes back from the tagger over and over, so expressions are looked up in an LRU cache
+        before their canonical names are turned into JSON.
+        """
+        try:
+            return wolfram_entity_of(interpretation)
+        except TypeError:
+            # Holds a list somewhere, so it can't be hashed
+            return make_wolfram_entity(interpretation)
+
+    @classmethod
+    def intern(cls, entity_type, canonical_name):
+        """Get the shared WolframEntity of an entity type and canonical name JSON"""
+        return interned_wolfram_entity(entity_type, canonical_name)
+
+    @property
+    def urn(self):
+        """Mathematica URN of the entity, as used as the key of seen_entities"""
+        return f"urn:WolframEntity:{self.type}:{self.canonical_name}"
+
+    def to_wl(self):
+        """Get the entity as a wolframclient expression that can be sent to the kernel"""
+        return wl.Entity(self.type, json.loads(self.canonical_name))
+
+@functools.lru_cache(maxsize=WOLFRAM_ENTITY_CACHE_SIZE)
+def interned_wolfram_entity(entity_type, canonical_name):
+    return WolframEntity(entity_type, canonical_name)
+
+def make_wolfram_entity(interpretation):
+    canonical_name = json.dumps(interpretation.args[1], separators=(',', ':'))
+    return WolframEntity.intern(interpretation.args[0], canonical_name)
+
+@functools.lru_cache(maxsize=65536)
+def wolfram_entity_of(interpretation):
+    return make_wolfram_entity(interpretation)
+
+def to_wolfram_entity(interpretation):
+    """Get the WolframEntity of an interpretation, or None if it isn't a Wolfram Entity. Takes
+    wolframclient expressions, WolframEntities, or the lists WolframEntities are saved as in WXF.
+
+    interpretation -- interpretation of a tagged entity
+    """
+    if isinstance(interpretation, WolframEntity):
+        return interpretation
+    if hasattr(interpretation, 'head'):
+        return WolframEntity.from_wl(interpretation) if interpretation.head.name == 'Entity' else None
+    if isinstance(interpretation, (list, tuple)) and len(interpretation) == 2:
+        return WolframEntity.intern(*interpretation)
+    return None
+
+def compact_interpretation(interpretation):
+    """Get the kind and payload (see the KIND_ constants) of an interpretation
+
+    interpretation -- interpretation of a tagged entity, as returned by a tagger
+    """
+    wolfram_entity = to_wolfram_entity(interpretation)
+    if wolfram_entity != None:
+        return KIND_ENTITY, wolfram_entity
+    if not hasattr(interpretation, 'head'):
+        return KIND_OTHER, None
+    head = interpretation.head.name
+    if head == 'Quantity':
+        return KIND_QUANTITY, (str(interpretation.args[0]), str(interpretation.args[1]))
+    if head == 'DateObject':
+        return KIND_DATE, tuple(str(part) for part in interpretation.args[0])
+    if head == 'GeoPosition':
+        latitude, longitude = interpretation.args[0][:2]
+        return KIND_GEO, (str(latitude), str(longitude))
+    return KIND_OTHER, None
+
+class EntityRecord:
+    __slots__ = ('start_pos', 'end_pos', 'type_id', 'confidence', 'text', 'ref', 'kind', 'payload')
+
+    def __init__(self, start_pos, end_pos, type_id, confidence, text, ref, kind, payload):
+        """A tagged entity, without the wolframclient expression it was interpreted as
+
+        start_pos -- position of the first character of the entity in its paragraph
+        end_pos -- position after the last character of the entity in its paragraph
+        type_id -- id of the entity type, see get_type_id
+        confidence -- confidence of the tagger in the entity
+        text -- text of the entity
+        ref -- TEI ref attribute of the entity, or None
+        kind -- what payload holds, one of the KIND_ constants
+        payload -- compact form of the interpretation
+        """
+        self.start_pos = start_pos
+        self.end_pos = end_pos
+        self.type_id = type_id
+        self.confidence = confidence
+        self.text = text
+        self.ref = ref
+        self.kind = kind
+        self.payload = payload
+
+    @classmethod
+    def from_tagger_entity(cls, entity):
+        """Make a record out of a Flair-like entity dict (with its ref attribute filled in)"""
+        kind, payload = compact_interpretation(entity.get('interpretation'))
+        ref = entity.get('ref')
+        return cls(entity['start_pos'], entity['end_pos'], get_type_id(entity['type']),
+                   entity['confidence'], sys.intern(entity['text']),
+                   sys.intern(ref) if ref != None else None, kind, payload)
+
+    @property
+    def type(self):
+        return entity_types[self.type_id]
+
+    def to_dict(self):
+        """Get the entity as a dict that can be sent as JSON"""
+        return {
+            'text': self.text,
+            'start_pos': self.start_pos,
+            'end_pos': self.end_pos,
+            'type': self.type,
+            'confidence': self.confidence,
+            'ref': self.ref
+        }
+
+    def __repr__(self):
+        return f'EntityRecord({self.text!r}, {self.start_pos}, {self.end_pos}, {self.type!r}, {self.ref!r})'
+
+ANNOTATIONS_MAGIC = b'TEIANN1\n'
+NO_STRING = 0xFFFFFFFF
+# start_pos, end_pos, type string, confidence, text string, ref string, kind, payload string
+entity_struct = struct.Struct('<IIIdIIBI')
+count_struct = struct.Struct('<I')
+# offset of a standoff paragraph in its text, in characters
+offset_struct = struct.Struct('<Q')
+
+class AnnotationWriter:
+    def __init__(self, output_file, metadata=None):
+        """Write tagged paragraphs to a binary annotation file. Strings that repeat (entity
+        types, texts, refs and payloads) are only written once, so the file stays small.
+
+        output_file -- binary file to write to
+        metadata -- dict of anything JSON-friendly to record about the document
+        """
+        self.output_file = output_file
+        self.string_ids = dict()
+        self.output_file.write(ANNOTATIONS_MAGIC)
+        if metadata != None:
+            encoded = json.dumps(metadata, sort_keys=True).encode('utf-8')
+            self.output_file.write(b'H' + count_struct.pack(len(encoded)) + encoded)
+
+    def get_string_id(self, string):
+        """Get the id of a string in the file, writing the string first if it's new"""
+        if string == None:
+            return NO_STRING
+        string_id = self.string_ids.get(string)
+        if string_id == None:
+            string_id = len(self.string_ids)
+            self.string_ids[string] = string_id
+            encoded = string.encode('utf-8')
+            self.output_file.write(b'S' + count_struct.pack(len(encoded)) + encoded)
+        return string_id
+
+    def write_paragraph(self, paragraph, offset=None):
+        """Write a paragraph tagged by NamedEntityRecognizer
+
+        paragraph -- dict with the paragraph "text" and its "entities" as EntityRecords
+        offset -- offset of the paragraph in the document text. If given, only the offset and
+            length of the paragraph are written instead of its text, and the text has to be given
+            back to read_annotations.
+        """
+        entities = []
+        for entity in paragraph['entities']:
+            payload = None
+            if entity.kind == KIND_ENTITY:
+                payload = json.dumps(list(entity.payload), separators=(',', ':'))
+            elif entity.payload != None:
+                payload = json.dumps(entity.payload, separators=(',', ':'))
+            entities.append(entity_struct.pack(
+                entity.start_pos, entity.end_pos, self.get_string_id(entity.type), entity.confidence,
+                self.get_string_id(entity.text), self.get_string_id(entity.ref), entity.kind,
+                self.get_string_id(payload)))
+        if offset != None:
+            self.output_file.write(b'O' + count_struct.pack(len(paragraph['text'])) +
+                                   offset_struct.pack(offset) + count_struct.pack(len(entities)) +
+                                   b''.join(entities))
+            return
+        text = paragraph['text'].encode('utf-8')
+        self.output_file.write(b'P' + count_struct.pack(len(text)) + text +
+                               count_struct.pack(len(entities)) + b''.join(entities))
+
+def read_exactly(input_file, size):
+    data = input_file.read(size)
+    if len(data) != size:
+        raise ValueError('Annotation file is truncated')
+    return data
+
+def read_annotation_metadata(input_file):
+    """Read the metadata an annotation file was written with, or None if it has none. Leaves the
+    file positioned at its first record after the metadata.
+
+    input_file -- binary file to read from
+    """
+    if input_file.read(len(ANNOTATIONS_MAGIC)) != ANNOTATIONS_MAGIC:
+        raise ValueError('Not an annotation file')
+    position = input_file.tell()
+    if input_file.read(1) != b'H':
+        input_file.seek(position)
+        return None
+    length = count_struct.unpack(read_exactly(input_file, count_struct.size))[0]
+    return json.loads(read_exactly(input_file, length).decode('utf-8'))
+
+def read_annotations(input_file, text=None):
+    """Read back the tagged paragraphs of an annotation file written by AnnotationWriter, one at a
+    time, in the same format NamedEntityRecognizer.tag_paragraphs yields them
+
+    input_file -- binary file to read from
+    text -- document text the offsets of standoff paragraphs point into
+    """
+    read_annotation_metadata(input_file)
+    strings = []
+    # The decoded payload of each payload string
+    payloads = dict()
+    while True:
+        record_type = input_file.read(1)
+        if record_type == b'':
+            return
+        length = count_struct.unpack(read_exactly(input_file, count_struct.size))[0]
+        if record_type == b'S':
+            strings.append(sys.intern(read_exactly(input_file, length).decode('utf-8')))
+            continue
+        if record_type == b'P':
+            paragraph_text = read_exactly(input_file, length).decode('utf-8')
+        elif record_type == b'O':
+            if text == None:
+                raise ValueError('Annotation file has standoff paragraphs, but no text was given')
+            offset = offset_struct.unpack(read_exactly(input_file, offset_struct.size))[0]
+            if offset + length > len(text):
+                raise ValueError('Standoff paragraph is outside of the text')
+            paragraph_text = text[offset:offset + length]
+        else:
+            raise ValueError(f'Unknown record type {record_type!r} in annotation file')
+        entity_count = count_struct.unpack(read_exactly(input_file, count_struct.size))[0]
+        data = read_exactly(input_file, entity_count * entity_struct.size)
+        entities = []
+        for start_pos, end_pos, type_string, confidence, text_string, ref_string, kind, payload_string \
+                in entity_struct.iter_unpack(data):
+            payload = None
+            if payload_string != NO_STRING:
+                if payload_string not in payloads:
+                    value = json.loads(strings[payload_string])
+                    payloads[payload_string] = (WolframEntity.intern(*value) if kind == KIND_ENTITY
+                                                else tuple(value))
+                payload = payloads[payload_string]
+            entities.append(EntityRecord(start_pos, end_pos, get_type_id(strings[type_string]),
+                                         confidence, strings[text_string],
+                                         strings[ref_string] if ref_string != NO_STRING else None,
+                                         kind, payload))
+        yield {'text': paragraph_text, 'entities': entities}
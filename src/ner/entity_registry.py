@@ -0,0 +1,172 @@
+import os
+import sqlite3
+from wolframclient.serializers import export
+from wolframclient.deserializers import binary_deserialize
+from .entity_record import to_wolfram_entity
+
+class EntityRegistry:
+    def __init__(self, path):
+        """Open (or create) a durable registry of every entity tagged in a corpus. For each entity it
+        keeps the xml:id it was given in the TEI index, its interpretation, which documents it occurs
+        in and how often, and whether it has been rendered into the index yet.
+
+        path -- file path of the registry database
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=60)
+        with self.connection:
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS entities (
+                urn TEXT PRIMARY KEY,
+                xml_id TEXT,
+                interpretation BLOB NOT NULL,
+                indexed INTEGER NOT NULL DEFAULT 0
+            )''')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS entities_xml_id ON entities (xml_id)')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS documents (
+                document TEXT PRIMARY KEY,
+                input_hash TEXT
+            )''')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS occurrences (
+                urn TEXT NOT NULL,
+                document TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (urn, document)
+            )''')
+            # urn is NULL for surface forms that were seen with more than one entity
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS surface_forms (
+                text TEXT PRIMARY KEY,
+                urn TEXT,
+                type TEXT,
+                confidence REAL
+            )''')
+
+    def close(self):
+        """Close the registry"""
+        self.connection.close()
+
+    def add_document(self, document, seen_entities, occurrences, input_hash=None, surface_forms=None):
+        """Record the entities seen in a document, replacing whatever was recorded for it before.
+        Entities that are already registered keep their xml:id.
+
+        document -- name of the document
+        seen_entities -- the document's entities, as returned by NamedEntityRecognizer.get_seen_entities
+        occurrences -- the document's occurrence counts, as returned by
+            NamedEntityRecognizer.get_entity_occurrences
+        input_hash -- hash of the document's text, to tell if it needs to be recorded again later
+        surface_forms -- surface forms of the document's entities, as returned by load_seen_entities
+        """
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO documents (document, input_hash) VALUES (?, ?)',
+                                    (document, input_hash))
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO entities (urn, xml_id, interpretation) VALUES (?, ?, ?)',
+                [(urn, xml_id, export(interpretation, target_format='wxf'))
+                 for urn, (xml_id, interpretation) in seen_entities.items()])
+            self.connection.execute('DELETE FROM occurrences WHERE document = ?', (document,))
+            self.connection.executemany(
+                'INSERT INTO occurrences (urn, document, count) VALUES (?, ?, ?)',
+                [(urn, document, occurrences.get(urn, 0)) for urn in seen_entities])
+            for urn, forms in (surface_forms or dict()).items():
+                for text, entity_type, confidence in forms:
+                    self.add_surface_form(text, urn, entity_type, confidence)
+
+    def claim_xml_id(self, urn, interpretation, candidates):
+        """Get the xml:id of an entity, registering it with the first of its candidate xml:ids
+        that no other entity has if it isn't registered yet. Safe to call from several processes
+        at once, so they all give an entity the same xml:id.
+
+        urn -- Mathematica URN of the entity
+        interpretation -- WolframEntity of the entity
+        candidates -- xml:ids the entity can have, most preferred first
+        """
+        with self.connection:
+            # Take the write lock before looking, so no other process claims the same xml:id meanwhile
+            self.connection.execute('BEGIN IMMEDIATE')
+            row = self.connection.execute('SELECT xml_id FROM entities WHERE urn = ?', (urn,)).fetchone()
+            if row != None:
+                return row[0]
+            xml_id = candidates[-1]
+            for candidate in candidates:
+                if self.connection.execute('SELECT 1 FROM entities WHERE xml_id = ?', (candidate,)).fetchone() == None:
+                    xml_id = candidate
+                    break
+            self.connection.execute('INSERT INTO entities (urn, xml_id, interpretation) VALUES (?, ?, ?)',
+                                    (urn, xml_id, export(interpretation, target_format='wxf')))
+            return xml_id
+
+    def add_surface_form(self, text, urn, entity_type, confidence):
+        """Record a surface form of an entity, marking it ambiguous if it was seen with another entity"""
+        row = self.connection.execute('SELECT urn FROM surface_forms WHERE text = ?', (text,)).fetchone()
+        if row == None:
+            self.connection.execute('INSERT INTO surface_forms (text, urn, type, confidence) VALUES (?, ?, ?, ?)',
+                                    (text, urn, entity_type, confidence))
+        elif row[0] != None and row[0] != urn:
+            self.connection.execute('UPDATE surface_forms SET urn = NULL WHERE text = ?', (text,))
+        elif row[0] == urn:
+            self.connection.execute('UPDATE surface_forms SET confidence = MAX(confidence, ?) WHERE text = ?',
+                                    (confidence, text))
+
+    def get_surface_forms(self):
+        """Get every unambiguous surface form, in the format NamedEntityRecognizer.load_gazetteer takes"""
+        rows = self.connection.execute('''SELECT surface_forms.text, surface_forms.urn, surface_forms.type,
+                entities.interpretation, surface_forms.confidence
+            FROM surface_forms JOIN entities ON entities.urn = surface_forms.urn''')
+        return [(text, urn, entity_type, to_wolfram_entity(binary_deserialize(interpretation)), confidence)
+                for text, urn, entity_type, interpretation, confidence in rows]
+
+    def get_document_hashes(self):
+        """Get the input hash of every recorded document"""
+        return dict(self.connection.execute('SELECT document, input_hash FROM documents'))
+
+    def remove_documents_except(self, documents):
+        """Forget the occurrences of every document not in the given list, e.g. because its file was
+        deleted. Entities that no longer occur anywhere are left out of get_entities.
+
+        documents -- names of the documents to keep
+        """
+        with self.connection:
+            self.connection.execute('CREATE TEMP TABLE IF NOT EXISTS kept_documents (document TEXT PRIMARY KEY)')
+            self.connection.execute('DELETE FROM kept_documents')
+            self.connection.executemany('INSERT OR IGNORE INTO kept_documents (document) VALUES (?)',
+                                        [(document,) for document in documents])
+            self.connection.execute(
+                'DELETE FROM occurrences WHERE document NOT IN (SELECT document FROM kept_documents)')
+            self.connection.execute(
+                'DELETE FROM documents WHERE document NOT IN (SELECT document FROM kept_documents)')
+
+    def get_entities(self, unindexed_only=False):
+        """Get the registered entities that occur in at least one document, in the order they were
+        first registered, in the same format as NamedEntityRecognizer.get_seen_entities
+
+        unindexed_only -- only get entities that haven't been rendered into the index yet
+        """
+        rows = self.connection.execute(f'''SELECT urn, xml_id, interpretation FROM entities
+            WHERE urn IN (SELECT urn FROM occurrences) {'AND NOT indexed' if unindexed_only else ''}
+            ORDER BY rowid''')
+        return {urn: (xml_id, to_wolfram_entity(binary_deserialize(interpretation)))
+                for urn, xml_id, interpretation in rows}
+
+    def get_occurrences(self, urn):
+        """Get the number of times an entity occurs in each document it occurs in
+
+        urn -- Mathematica URN of the entity
+        """
+        rows = self.connection.execute(
+            'SELECT document, count FROM occurrences WHERE urn = ? ORDER BY document', (urn,))
+        return dict(rows)
+
+    def mark_indexed(self, urns, indexed=True):
+        """Record that entities have (or haven't) been rendered into the index
+
+        urns -- Mathematica URNs of the entities
+        indexed -- whether the entities are in the index
+        """
+        with self.connection:
+            self.connection.executemany('UPDATE entities SET indexed = ? WHERE urn = ?',
+                                        [(int(indexed), urn) for urn in urns])
+
+    def clear_indexed(self):
+        """Record that no entities have been rendered into the index, e.g. before a full rebuild"""
+        with self.connection:
+            self.connection.execute('UPDATE entities SET indexed = 0')
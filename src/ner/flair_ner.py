@@ -1,43 +1,272 @@
-from .wlflairshim import SequenceTagger
+from .wlflairshim import DEFAULT_BATCH_BYTES
+from .kernel_pool import KernelPool
+from .backends import create_tagger
+from .chunker import Chunker
+from .dedup import ParagraphDeduplicator
+from .entity_record import EntityRecord, KIND_ENTITY, to_wolfram_entity
+from .gazetteer import Gazetteer, mask_entities
+from .overlaps import resolve_overlaps
+from .prefilter import has_candidates
+from .ref_registry import RefRegistry
+from ..utils.metrics import metrics, describe_text, COUNT_BUCKETS
 import re
-import functools
-import json
 import html
+import threading
+from collections import Counter
+from wolframclient.serializers import export
+from wolframclient.deserializers import binary_deserialize
 
 class NamedEntityRecognizer:
     def __init__(self, wolfram_kernel_path, type_precedence, min_confidence, generate_index,
-            index_name):
-        """Creates a new named entity recognizer"""
-        self.tagger = SequenceTagger(wolfram_kernel_path)
+            index_name, batch_bytes=DEFAULT_BATCH_BYTES, kernel_pool_size=1,
+            kernel_licence_limit=None, tagger_cache_dir=None, tagger_backend='wolfram',
+            tagger_options=None, prefilter=False, gazetteer_mode='off', chunk_chars=None,
+            chunk_overlap=200, kernel_session_options=None, dedup=False, dedup_boilerplate=False):
+        """Creates a new named entity recognizer. If kernel_pool_size is more than 1, paragraphs
+        are tagged concurrently on a KernelPool of that many kernels (capped at kernel_licence_limit).
+        If tagger_cache_dir is given, TextContents results are cached on disk there.
+        tagger_backend picks another tagger than the Wolfram kernel (see backends.create_tagger),
+        with tagger_options as its extra keyword args. If prefilter is True, paragraphs that
+        can't contain an entity (see prefilter.has_candidates) aren't sent to the tagger. If
+        chunk_chars is given, paragraphs are sent to the tagger in work units of about that many
+        characters: longer paragraphs are split on sentences, overlapping by chunk_overlap
+        characters, and shorter ones are joined together (see chunker.Chunker).
+        kernel_session_options are the keyword args of the session of each Wolfram kernel (see
+        kernel_session.open_session), e.g. to attach to a running kernel server. If dedup is True,
+        paragraphs that are the same as one tagged before once normalised (e.g. running headers)
+        get its entities instead of being tagged again, and if dedup_boilerplate is also True,
+        near-duplicates of frequent paragraphs are skipped as boilerplate (see
+        dedup.ParagraphDeduplicator).
+
+        gazetteer_mode picks how surface forms of already tagged entities are reused:
+        'off' -- every paragraph goes to the tagger, which is the default
+        'residual' -- known surface forms are tagged from the gazetteer, and only the rest of the
+            paragraph (known surface forms blanked out) goes to the tagger, if it has candidates left
+        'paragraph' -- paragraphs whose candidates are all known surface forms are tagged from the
+            gazetteer alone, every other paragraph goes to the tagger whole
+        The other modes trade accuracy for speed, and are opt-in: known surface forms are matched
+        as case-sensitive whole words whatever their context, the tagger doesn't see the context
+        blanked out in residual mode, and what's known depends on the paragraphs tagged before
+        (so output can change with processing order and the number of workers). Candidates left
+        over are judged ignoring capitalised words at the start of sentences, so an unknown entity
+        that starts a sentence in an otherwise known paragraph is missed.
+        """
+        self.tagger = create_tagger(tagger_backend, wolfram_kernel_path, kernel_pool_size,
+            kernel_licence_limit, tagger_cache_dir, kernel_session_options, **(tagger_options or dict()))
+        self.prefilter = prefilter
+        self.chunker = Chunker(chunk_chars, chunk_overlap) if chunk_chars != None else None
+        self.deduplicator = ParagraphDeduplicator(boilerplate=dedup_boilerplate) if dedup else None
+        self.prefilter_stats = {'paragraphs': 0, 'skipped': 0}
+        if gazetteer_mode not in ['off', 'residual', 'paragraph']:
+            raise ValueError(f'Unknown gazetteer mode "{gazetteer_mode}"')
+        self.gazetteer_mode = gazetteer_mode
+        self.gazetteer = Gazetteer()
+        self.gazetteer_stats = {'paragraphs': 0, 'resolved_paragraphs': 0, 'gazetteer_entities': 0,
+                                'tagger_entities': 0}
         self.type_precedence = type_precedence
         self.min_confidence = min_confidence
         self.generate_index = generate_index
         self.index_name = index_name
+        self.batch_bytes = batch_bytes
+        self.refs = RefRegistry(index_name, generate_index)
 
-        # Looks like {'Mathematica URN': ('entity_index_id', entity)}
+        # Looks like {'Mathematica URN': ('entity_index_id', WolframEntity)}
         # Each entity has a unique canonical URN, which is nice because it also prevents duplicates.
         # entity_index_id is the xml:id of the entity in the TEI index. If no index is requested by
         # the user, entity_index_id will be None
         self.seen_entities = dict() 
+        # Looks like {'Mathematica URN': number of times the entity was tagged}
+        self.entity_occurrences = Counter()
+        # Guards seen_entities when several threads tag at once, e.g. in the tagging service
+        self.seen_entities_lock = threading.Lock()
 
     def tag_entities(self, text):
         """Tags entities in plaintext in a format similar to Flair"""
-        paragraphs = re.split(r'\n{2,}', text)
+        with metrics.time('paragraph_split_seconds'):
+            paragraphs = re.split(r'\n{2,}', text)
+        return list(self.tag_paragraphs(paragraphs))
+
+    def tag_paragraphs(self, paragraphs):
+        """Tags entities in an iterable of paragraphs, yielding the Flair-like output of each
+        paragraph in order. Paragraphs are only pulled from the iterable one batch (batch_bytes)
+        at a time, so they can be streamed from a file. Tagger outputs come back in document order,
+        so seen_entities is always filled in the same order, even with a KernelPool.
+
+        paragraphs -- iterable of paragraph strings
+        """
+        batch = []
+        batch_bytes = 0
+        for paragraph in paragraphs:
+            batch.append(paragraph)
+            batch_bytes += len(paragraph.encode('utf-8'))
+            if batch_bytes >= self.batch_bytes:
+                yield from self.tag_batch(batch)
+                batch = []
+                batch_bytes = 0
+        if batch:
+            yield from self.tag_batch(batch)
+
+    def tag_batch(self, paragraphs):
+        """Tags entities in a list of paragraphs, returning the Flair-like output of each paragraph.
+        The entities of each paragraph are EntityRecords, which don't hold on to the wolframclient
+        expressions the tagger returned.
+
+        paragraphs -- list of paragraph strings
+        """
+        with metrics.time('tagger_seconds'):
+            tagger_outputs = self.get_tagger_outputs(paragraphs)
         output = []
-        for p in paragraphs:
-            tagger_output = self.tagger.predict(p, entity_types=self.type_precedence)
-            tagger_output['entities'] = [entity for entity in tagger_output['entities'] if entity['confidence'] >= self.min_confidence]
-            tagger_output['entities'] = self.remove_entity_overlaps(tagger_output['entities'])
-            for entity in tagger_output['entities']:
-                entity_ref = self.to_ref_attribute(entity['interpretation'])
-                entity['ref'] = entity_ref
-            output.append(tagger_output)
+        for tagger_output in tagger_outputs:
+            entities = [entity for entity in tagger_output['entities'] if entity['confidence'] >= self.min_confidence]
+            with metrics.time('overlap_resolution_seconds', context=describe_text(tagger_output['text'])):
+                entities = self.remove_entity_overlaps(entities)
+            metrics.observe('entities_per_paragraph', len(entities), COUNT_BUCKETS)
+            records = []
+            for entity in entities:
+                record = EntityRecord.from_tagger_entity(entity)
+                if record.kind == KIND_ENTITY:
+                    record.ref = self.to_ref_attribute(record.payload)
+                    if self.gazetteer_mode != 'off':
+                        self.learn_surface_form(record)
+                records.append(record)
+            output.append({'text': tagger_output['text'], 'entities': records})
+        metrics.increment('paragraphs_tagged', len(paragraphs))
         return output
 
+    def get_tagger_outputs(self, paragraphs):
+        """Gets the raw tagger output of each paragraph, tagging as little as possible with the
+        tagger: paragraphs the pre-filter rules out get no entities, and known surface forms are
+        found with the gazetteer (see gazetteer_mode in __init__)
+
+        paragraphs -- list of paragraph strings
+        """
+        tagger_outputs = [{'text': paragraph, 'entities': []} for paragraph in paragraphs]
+        # Looks like {paragraph index: text to send to the tagger}
+        to_tag = dict()
+        if self.gazetteer_mode != 'off':
+            self.gazetteer.refresh()
+        for index, paragraph in enumerate(paragraphs):
+            if self.prefilter:
+                self.prefilter_stats['paragraphs'] += 1
+                if not has_candidates(paragraph):
+                    self.prefilter_stats['skipped'] += 1
+                    continue
+            if self.gazetteer_mode == 'off':
+                to_tag[index] = paragraph
+                continue
+            self.gazetteer_stats['paragraphs'] += 1
+            entities = self.gazetteer.find_entities(paragraph)
+            residual = mask_entities(paragraph, entities)
+            if entities and not has_candidates(residual, ignore_sentence_starts=True):
+                tagger_outputs[index]['entities'] = entities
+                self.gazetteer_stats['resolved_paragraphs'] += 1
+                self.gazetteer_stats['gazetteer_entities'] += len(entities)
+            elif self.gazetteer_mode == 'residual':
+                tagger_outputs[index]['entities'] = entities
+                self.gazetteer_stats['gazetteer_entities'] += len(entities)
+                to_tag[index] = residual
+            else:
+                to_tag[index] = paragraph
+        if to_tag:
+            if self.deduplicator != None:
+                found = self.deduplicator.predict(list(to_tag.values()), self.predict)
+            else:
+                found = self.predict(list(to_tag.values()))
+            for index, entities in zip(to_tag, found):
+                tagger_outputs[index]['entities'] += entities
+                if self.gazetteer_mode != 'off':
+                    self.gazetteer_stats['tagger_entities'] += len(entities)
+        return tagger_outputs
+
+    def predict(self, texts):
+        """Gets the entities the tagger finds in each text, in work units made by the chunker if
+        there is one
+
+        texts -- list of texts to tag
+        """
+        if self.chunker == None:
+            outputs = self.tagger.predict_batch(texts, self.batch_bytes, entity_types=self.type_precedence)
+            return [output['entities'] for output in outputs]
+        units = self.chunker.plan(texts)
+        metrics.increment('chunker_texts', len(texts))
+        metrics.increment('chunker_units', len(units))
+        outputs = self.tagger.predict_batch([unit.text for unit in units], self.batch_bytes,
+                                            entity_types=self.type_precedence)
+        return self.chunker.reassemble(units, outputs, len(texts))
+
+    def learn_surface_form(self, record):
+        """Adds the surface form of a tagged entity to the gazetteer, if it's a Wolfram Entity
+
+        record -- EntityRecord of the entity
+        """
+        if record.kind == KIND_ENTITY:
+            self.gazetteer.add(record.text, record.payload.urn, record.type, record.payload,
+                               record.confidence)
+
+    def load_gazetteer(self, surface_forms):
+        """Seeds the gazetteer with surface forms of entities tagged before, e.g. from an EntityRegistry
+
+        surface_forms -- iterable of (text, Mathematica URN, entity type, interpretation, confidence)
+        """
+        for text, mathematica_ref, entity_type, interpretation, confidence in surface_forms:
+            self.gazetteer.add(text, mathematica_ref, entity_type, interpretation, confidence)
+
+    def get_gazetteer_stats(self):
+        """Gets how many paragraphs and entities the gazetteer resolved without the tagger. hit_rate
+        is the fraction of entities that came from the gazetteer.
+        """
+        stats = dict(self.gazetteer_stats)
+        entities = stats['gazetteer_entities'] + stats['tagger_entities']
+        stats['hit_rate'] = stats['gazetteer_entities'] / entities if entities else 0.0
+        stats['surface_forms'] = len(self.gazetteer)
+        return stats
+
+    def get_dedup_stats(self):
+        """Gets how many paragraphs were duplicates or boilerplate, see ParagraphDeduplicator.get_stats"""
+        if self.deduplicator == None:
+            return {'paragraphs': 0, 'duplicates': 0, 'boilerplate': 0, 'dedup_ratio': 0.0}
+        return self.deduplicator.get_stats()
+
+    def set_xml_id_registry(self, registry):
+        """Give new entities their xml:ids through an EntityRegistry, so every process tagging a
+        corpus gives an entity the same xml:id (see RefRegistry.set_claim_function)
+        """
+        self.refs.set_claim_function(registry.claim_xml_id)
+
     def get_seen_entities(self):
         """Gets the dictionary of entities tagged so far with this NamedEntityRecognizer"""
         return self.seen_entities
 
+    def get_entity_occurrences(self):
+        """Gets the number of times each entity in seen_entities was tagged"""
+        return self.entity_occurrences
+
+    def clear_seen_entities(self):
+        """Forgets the entities tagged so far, e.g. to collect the entities of each document separately"""
+        self.seen_entities = dict()
+        self.entity_occurrences = Counter()
+
+    def save_seen_entities(self, path):
+        """Saves the entities tagged so far, their occurrence counts and their gazetteer surface
+        forms to a WXF file, which load_seen_entities can read back
+        """
+        surface_forms = self.gazetteer.get_surface_forms(self.seen_entities)
+        shard = {mathematica_ref: [entity_id, interpretation, self.entity_occurrences[mathematica_ref],
+                                   surface_forms.get(mathematica_ref, [])]
+                 for mathematica_ref, (entity_id, interpretation) in self.seen_entities.items()}
+        with open(path, 'wb') as f:
+            f.write(export(shard, target_format='wxf'))
+
+    def get_kernel_stats(self):
+        """Gets the utilisation counters of each kernel used by this NamedEntityRecognizer"""
+        if isinstance(self.tagger, KernelPool):
+            return self.tagger.get_stats()
+        return []
+
+    def get_prefilter_stats(self):
+        """Gets the number of paragraphs seen and skipped by the pre-filter"""
+        return dict(self.prefilter_stats)
+
     def close(self):
         """Closes the Wolfram Kernel session"""
         self.tagger.close()
@@ -47,74 +276,51 @@ class NamedEntityRecognizer:
         this will be a TEI Index URN. Otherwise, it will be a Mathematica/Wolfram Language URN.
         Returns none if it's not a Mathematica entity.
 
-        interpretation -- Mathematica text content interpretation to turn into a @ref string
+        interpretation -- Mathematica text content interpretation (or WolframEntity) to turn into a @ref string
         """
-        if type(interpretation) is str or interpretation.head.name != 'Entity': return None
-
-        entity_type = interpretation.args[0]
-        canonical_name = interpretation.args[1]
-        canonical_name = json.dumps(canonical_name, separators=(',', ':'))
+        wolfram_entity = to_wolfram_entity(interpretation)
+        if wolfram_entity == None: return None
         # We always generate the mathematica_ref, since this is a unique identifier that we'll use
-        # a key for seen_entities, even if doesn't show up in the marked up text
-        mathematica_ref = f"urn:WolframEntity:{entity_type}:{canonical_name}"
-        
-        index_ref = None
-        if self.generate_index:
-            entity_id = re.sub("[^0-9a-zA-Z]+", "", canonical_name)
-            index_ref = (f"urn:teiindex:{self.index_name}:{entity_id}")
-
-        self.seen_entities[mathematica_ref] = (entity_id, interpretation)
-        return index_ref if self.generate_index else mathematica_ref
-
-    def is_overlapping(self, x1, x2, y1, y2):
-        """Determines if two ranges (x1, x2) and (y1, y2) overlap"""
-        return x1 <= y2 and y1 <= x2
-
-    def compare_entities(self, e1, e2):
-        """Compares two entities by their preference. An entity is more preferred if:
-            - its text is longer
-            - its entity type comes first in the type precedence
-            - its confidence value is higer
+        # a key for seen_entities, even if doesn't show up in the marked up text. The refs of each
+        # entity are only worked out once, see RefRegistry.
+        mathematica_ref, entity_id, ref = self.refs.get_refs(wolfram_entity)
+        with self.seen_entities_lock:
+            if mathematica_ref not in self.seen_entities:
+                self.seen_entities[mathematica_ref] = (entity_id, wolfram_entity)
+            self.entity_occurrences[mathematica_ref] += 1
+        return ref
+
+    def to_mathematica_urn(self, interpretation):
+        """Creates the Mathematica/Wolfram Language URN of an entity, or returns None if it's not a
+        Mathematica entity
+
+        interpretation -- Mathematica text content interpretation (or WolframEntity) to turn into a URN
         """
-        type_precedence = self.type_precedence
-        if len(e1['text']) > len(e2['text']):
-            return 1
-        elif len(e1['text']) < len(e2['text']):
-            return -1
-        elif type_precedence.index(e1['type']) < type_precedence.index(e2['type']):
-            return 1
-        elif type_precedence.index(e1['type']) > type_precedence.index(e2['type']):
-            return -1
-        elif e1['confidence'] > e2['confidence']:
-            return 1
-        elif e1['confidence'] < e2['confidence']:
-            return -1
-        else:
-            return 0
+        wolfram_entity = to_wolfram_entity(interpretation)
+        return wolfram_entity.urn if wolfram_entity != None else None
 
     def remove_entity_overlaps(self, entities_in):
-        """Removes overlapping entities from the input list. If 2 or more entities overlap in position,
-        only the entity ranked highest by the given comparison function is retained in the output list.
-        The list is then sorted by the entity's start_pos.
+        """Removes overlapping entities from the input list, keeping the most preferred entities.
+        See overlaps.resolve_overlaps for how entities are preferred.
 
         entities_in -- input list of entities
         """
-        entities_out = []
-        all_overlaps = set()
-        for entity in entities_in:
-            overlapping_entities = set()
-            for other_entity in entities_in:
-                if entity != other_entity and self.is_overlapping(
-                    entity['start_pos'], entity['end_pos'], other_entity['start_pos'], other_entity['end_pos']):
-                    #have to turn dicts into tuples since dicts aren't hashable and can't be put in sets
-                    overlapping_entities.add(tuple(other_entity.items()))
-            if len(overlapping_entities) > 0:
-                overlapping_entities.add(tuple(entity.items()))
-                all_overlaps.add(tuple(sorted(overlapping_entities))) #sorted so insertion order doesn't matter
-            else:
-                entities_out.append(entity)
+        return resolve_overlaps(entities_in, self.type_precedence)
 
-        for overlapping_set in all_overlaps:
-            entities = [dict(tup) for tup in overlapping_set]
-            entities_out.append(sorted(entities, key=functools.cmp_to_key(self.compare_entities))[-1])
-        return sorted(entities_out, key=lambda entity: entity['start_pos'])
\ No newline at end of file
+def load_seen_entities(path):
+    """Loads entities saved with NamedEntityRecognizer.save_seen_entities. Returns the entities in the
+    same format as NamedEntityRecognizer.get_seen_entities, their occurrence counts in the same
+    format as NamedEntityRecognizer.get_entity_occurrences, and their surface forms as
+    {'Mathematica URN': [[text, entity type, confidence], ...]}.
+    """
+    with open(path, 'rb') as f:
+        shard = binary_deserialize(f.read())
+    seen_entities = dict()
+    occurrences = Counter()
+    surface_forms = dict()
+    for mathematica_ref, (entity_id, interpretation, count, *forms) in shard.items():
+        seen_entities[mathematica_ref] = (entity_id, to_wolfram_entity(interpretation))
+        occurrences[mathematica_ref] = count
+        # Shards saved before surface forms were tracked don't have them
+        surface_forms[mathematica_ref] = [list(form) for form in forms[0]] if forms else []
+    return seen_entities, occurrences, surface_forms
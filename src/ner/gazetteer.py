@@ -0,0 +1,179 @@
+import threading
+from collections import deque
+
+class AhoCorasick:
+    def __init__(self):
+        """Aho-Corasick automaton that finds every occurrence of many strings in one pass over a
+        text. Add the strings, build it, then search with find_all.
+        """
+        # Node 0 is the root. Each node has its outgoing edges, its failure link, and the lengths
+        # and values of the strings that end there (including through failure links once built).
+        self.edges = [dict()]
+        self.failure = [0]
+        self.outputs = [[]]
+
+    def add(self, string, value):
+        """Add a string to look for. Call build after adding strings.
+
+        string -- string to look for
+        value -- what to give back when the string is found
+        """
+        node = 0
+        for char in string:
+            next_node = self.edges[node].get(char)
+            if next_node == None:
+                next_node = len(self.edges)
+                self.edges[node][char] = next_node
+                self.edges.append(dict())
+                self.failure.append(0)
+                self.outputs.append([])
+            node = next_node
+        self.outputs[node].append((len(string), value))
+
+    def build(self):
+        """Compute the failure links, breadth first from the root"""
+        # Children of the root fail back to the root
+        queue = deque(self.edges[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, next_node in self.edges[node].items():
+                queue.append(next_node)
+                fallback = self.failure[node]
+                while fallback and char not in self.edges[fallback]:
+                    fallback = self.failure[fallback]
+                self.failure[next_node] = self.edges[fallback].get(char, 0)
+                self.outputs[next_node] = self.outputs[next_node] + self.outputs[self.failure[next_node]]
+
+    def find_all(self, text):
+        """Yield (start, end, value) for every occurrence of every string in text, overlapping
+        occurrences included, in order of where they end
+
+        text -- text to search
+        """
+        node = 0
+        for index, char in enumerate(text):
+            while node and char not in self.edges[node]:
+                node = self.failure[node]
+            node = self.edges[node].get(char, 0)
+            for length, value in self.outputs[node]:
+                yield index + 1 - length, index + 1, value
+
+class Gazetteer:
+    def __init__(self, min_length=3, rebuild_ratio=0.1):
+        """Known surface forms of entities, e.g. "Cairo" for Entity["City", {"Cairo", "Cairo",
+        "Egypt"}], that can be found in text without asking the kernel. A surface form seen with
+        two different entities is ambiguous and is never matched.
+
+        min_length -- shortest surface form to match, shorter ones are too likely to be words
+        rebuild_ratio -- how much the gazetteer grows (as a fraction of its size) before the
+            automaton is rebuilt to include the new surface forms
+        """
+        self.min_length = min_length
+        self.rebuild_ratio = rebuild_ratio
+        # Looks like {'Cairo': (Mathematica URN, entity type, interpretation, confidence)}, or
+        # {'Cairo': None} if the surface form is ambiguous
+        self.entries = dict()
+        self.automaton = None
+        self.pending = 0
+        # Surface forms may be learned by several tagging threads at once
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, text, mathematica_urn, entity_type, interpretation, confidence):
+        """Learn a surface form of an entity
+
+        text -- surface form, as it appeared in the text
+        mathematica_urn -- Mathematica URN of the entity
+        entity_type -- TextContents type of the entity
+        interpretation -- Wolfram Language interpretation of the entity
+        confidence -- confidence to give matches of the surface form
+        """
+        if len(text) < self.min_length or text.strip() != text:
+            return
+        with self.lock:
+            entry = self.entries.get(text)
+            if text not in self.entries:
+                self.entries[text] = (mathematica_urn, entity_type, interpretation, confidence)
+                self.pending += 1
+            elif entry == None:
+                return
+            elif entry[0] != mathematica_urn:
+                self.entries[text] = None
+                self.pending += 1
+            elif confidence > entry[3]:
+                self.entries[text] = (mathematica_urn, entity_type, interpretation, confidence)
+
+    def get_surface_forms(self, mathematica_urns):
+        """Get the unambiguous surface forms of some entities as {urn: [[text, type, confidence]]}
+
+        mathematica_urns -- URNs of the entities
+        """
+        surface_forms = dict()
+        with self.lock:
+            entries = list(self.entries.items())
+        for text, entry in entries:
+            if entry != None and entry[0] in mathematica_urns:
+                surface_forms.setdefault(entry[0], []).append([text, entry[1], entry[3]])
+        return surface_forms
+
+    def refresh(self):
+        """Rebuild the automaton if enough surface forms were learned since it was last built"""
+        if self.automaton != None and (self.pending == 0 or self.pending < self.rebuild_ratio * len(self.entries)):
+            return
+        with self.lock:
+            automaton = AhoCorasick()
+            for text, entry in self.entries.items():
+                if entry != None:
+                    automaton.add(text, text)
+            automaton.build()
+            self.pending = 0
+        self.automaton = automaton
+
+    def find_entities(self, text):
+        """Find known surface forms in a text, as Flair-like entities. Only whole words are
+        matched, and overlapping matches are resolved leftmost-longest.
+
+        text -- text to search
+        """
+        if self.automaton == None:
+            self.refresh()
+        matches = []
+        # The automaton may be swapped for a rebuilt one by another thread while we search
+        automaton = self.automaton
+        for start, end, surface_form in automaton.find_all(text):
+            if start > 0 and text[start - 1].isalnum() or end < len(text) and text[end].isalnum():
+                continue
+            matches.append((start, -end, surface_form))
+        matches.sort()
+        entities = []
+        covered_until = 0
+        for start, negative_end, surface_form in matches:
+            if start < covered_until:
+                continue
+            entry = self.entries[surface_form]
+            if entry == None: # Became ambiguous since the automaton was built
+                continue
+            mathematica_urn, entity_type, interpretation, confidence = entry
+            entities.append({
+                "text": surface_form,
+                "start_pos": start,
+                "end_pos": -negative_end,
+                "type": entity_type,
+                "confidence": confidence,
+                "interpretation": interpretation
+            })
+            covered_until = -negative_end
+        return entities
+
+def mask_entities(text, entities):
+    """Blank out the entities in a text with spaces, keeping every other character where it was
+
+    text -- text the entities were found in
+    entities -- Flair-like entities
+    """
+    chars = list(text)
+    for entity in entities:
+        chars[entity['start_pos']:entity['end_pos']] = ' ' * (entity['end_pos'] - entity['start_pos'])
+    return ''.join(chars)
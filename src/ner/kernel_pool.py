@@ -0,0 +1,147 @@
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from wolframclient.exception import WolframKernelException, WolframEvaluationException, SocketException
+from .wlflairshim import SequenceTagger, DEFAULT_BATCH_BYTES
+
+# Errors that mean the kernel, or our connection to it, is broken. Anything else (e.g. the
+# RuntimeError for a text TextContents fails on) would fail again on a fresh kernel.
+KERNEL_ERRORS = (WolframKernelException, WolframEvaluationException, SocketException, OSError, EOFError)
+
+class KernelStats:
+    def __init__(self):
+        """Utilisation counters for a single kernel in a KernelPool"""
+        self.started = time.monotonic()
+        self.evaluations = 0
+        self.paragraphs = 0
+        self.busy_seconds = 0.0
+        self.errors = 0
+        self.restarts = 0
+
+    def as_dict(self):
+        """Get the counters as a dictionary, including the fraction of time the kernel was busy"""
+        uptime = time.monotonic() - self.started
+        return {
+            'evaluations': self.evaluations,
+            'paragraphs': self.paragraphs,
+            'busy_seconds': self.busy_seconds,
+            'utilisation': self.busy_seconds / uptime if uptime > 0 else 0.0,
+            'errors': self.errors,
+            'restarts': self.restarts
+        }
+
+class KernelPool:
+    def __init__(self, wl_kernel=None, size=1, licence_limit=None, max_retries=2, cache_dir=None,
+                 session_options=None):
+        """Start a pool of Wolfram kernels that tag paragraph batches concurrently. The pool can be
+        used anywhere a SequenceTagger is expected.
+
+        wl_kernel -- location of Wolfram kernel
+        size -- number of kernels to start
+        licence_limit -- maximum number of kernels our licence allows us to run at once
+        max_retries -- number of times a batch is retried on a fresh kernel if its kernel crashes
+        cache_dir -- directory of the persistent TextContents cache, or None to always ask the kernel
+        session_options -- keyword args of the session of each kernel, see SequenceTagger
+        """
+        if licence_limit is not None and size > licence_limit:
+            print(f"Kernel pool size {size} exceeds the licence limit, only starting {licence_limit} kernels")
+            size = licence_limit
+        self.wl_kernel = wl_kernel
+        self.cache_dir = cache_dir
+        self.session_options = session_options
+        self.max_retries = max_retries
+        self.taggers = [SequenceTagger(wl_kernel, cache_dir, session_options) for _ in range(max(size, 1))]
+        self.stats = [KernelStats() for _ in self.taggers]
+        self.idle_kernels = queue.Queue()
+        for kernel_index in range(len(self.taggers)):
+            self.idle_kernels.put(kernel_index)
+        self.restart_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=len(self.taggers))
+
+    @property
+    def session(self):
+        """Session of the first kernel in the pool, for things that need to evaluate directly"""
+        return self.taggers[0].session
+
+    @property
+    def cache(self):
+        """TextContents cache of the first kernel in the pool (they all share one cache_dir)"""
+        return self.taggers[0].cache
+
+    def close(self):
+        """Stop every Wolfram kernel in the pool"""
+        self.executor.shutdown()
+        for tagger in self.taggers:
+            tagger.close()
+
+    def predict(self, text: str, **kwargs) -> dict:
+        """Get text entities in text on whichever kernel is free. See SequenceTagger.predict"""
+        return self.predict_batch([text], **kwargs)[0]
+
+    def predict_batch(self, texts: list, batch_bytes=DEFAULT_BATCH_BYTES, **kwargs) -> list:
+        """Get text entities in many texts, spreading the chunks of texts across the kernels in the
+        pool. Outputs are returned in the same order as texts no matter which kernel finished
+        first. See SequenceTagger.predict_batch
+
+        texts -- list of texts to get entities from
+        batch_bytes -- maximum number of bytes of text to send to a kernel in one evaluation
+        """
+        # Make sure there are at least as many chunks as kernels so none of them sit idle
+        total_bytes = sum(len(text.encode('utf-8')) for text in texts)
+        batch_bytes = min(batch_bytes, total_bytes // len(self.taggers) + 1)
+        chunks = self.taggers[0].chunk_texts(texts, batch_bytes)
+        futures = [self.executor.submit(self.predict_chunk, chunk, batch_bytes, **kwargs)
+                   for chunk in chunks]
+        outputs = []
+        for future in futures:
+            outputs.extend(future.result())
+        return outputs
+
+    def predict_chunk(self, chunk, batch_bytes, **kwargs):
+        """Tag one chunk of texts on an idle kernel, restarting the kernel and retrying if it dies.
+        Other errors are raised without a restart.
+
+        chunk -- list of texts that fits in one evaluation
+        batch_bytes -- maximum number of bytes of text to send to a kernel in one evaluation
+        """
+        kernel_index = self.idle_kernels.get()
+        stats = self.stats[kernel_index]
+        try:
+            for attempt in range(self.max_retries + 1):
+                start = time.monotonic()
+                try:
+                    outputs = self.taggers[kernel_index].predict_batch(chunk, batch_bytes, **kwargs)
+                except KERNEL_ERRORS:
+                    stats.errors += 1
+                    if attempt == self.max_retries:
+                        raise
+                    self.restart(kernel_index)
+                    continue
+                except Exception:
+                    stats.errors += 1
+                    raise
+                finally:
+                    stats.busy_seconds += time.monotonic() - start
+                stats.evaluations += 1
+                stats.paragraphs += len(chunk)
+                return outputs
+        finally:
+            self.idle_kernels.put(kernel_index)
+
+    def restart(self, kernel_index):
+        """Replace a crashed kernel with a fresh one
+
+        kernel_index -- index of the kernel in the pool
+        """
+        with self.restart_lock:
+            try:
+                self.taggers[kernel_index].close()
+            except Exception:
+                pass # The kernel is probably already dead, which is why we're restarting it
+            self.taggers[kernel_index] = SequenceTagger(self.wl_kernel, self.cache_dir, self.session_options)
+            self.stats[kernel_index].restarts += 1
+
+    def get_stats(self):
+        """Get the utilisation counters of every kernel in the pool, in kernel order"""
+        return [stats.as_dict() for stats in self.stats]
@@ -0,0 +1,305 @@
+"""kernel_session.py - Wolfram kernel sessions that start ahead of time, stay healthy and can be shared
+
+Booting a kernel and loading the NLP paclets TextContents needs takes many seconds, which the first
+evaluation of a plain WolframLanguageSession pays for. A ManagedSession boots its kernel eagerly
+and warms it up with a throwaway TextContents evaluation, pings it while it's idle and replaces it
+after too many evaluations or too much memory growth. A KernelServer (see kernel_server.py) keeps
+one warm ManagedSession running for as long as it's needed, and short runs attach to it through a
+RemoteSession instead of booting a kernel of their own.
+
+Every session here can be used wherever a WolframLanguageSession is: evaluate(expr) and stop().
+"""
+import re
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+from wolframclient.deserializers import binary_deserialize
+from wolframclient.evaluation import WolframLanguageSession
+from wolframclient.language import wl, wlexpr
+from wolframclient.serializers import export
+from ..utils.metrics import metrics
+
+# Evaluated on every new kernel so the entity recognition models are loaded before real work arrives
+WARM_UP_TEXT = 'Charles Dickens sailed from Liverpool to Boston in January 1842.'
+# Keys a KernelServer or RemoteSession refuses, since anyone connecting with the key can evaluate
+# anything on the kernel
+PLACEHOLDER_AUTHKEYS = ['', 'change-me']
+# First byte of a KernelServer response, followed by the WXF of the result or the error message
+RESPONSE_OK = b'\x00'
+RESPONSE_ERROR = b'\x01'
+
+class ManagedSession:
+    def __init__(self, wl_kernel=None, warm_up=True, max_evaluations=None, max_memory_growth=None,
+                 memory_check_interval=100, health_interval=None, ping_timeout=30):
+        """Wolfram kernel session that manages the lifetime of its kernel. The kernel is started by
+        start, or by the first evaluation if start isn't called.
+
+        wl_kernel -- location of Wolfram kernel
+        warm_up -- evaluate TextContents once on every new kernel, to load its models
+        max_evaluations -- number of evaluations after which the kernel is replaced, or None
+        max_memory_growth -- number of bytes MemoryInUse[] can grow by (compared to just after
+            warming up) before the kernel is replaced, or None to never check
+        memory_check_interval -- number of evaluations between checks of MemoryInUse[], so most
+            evaluations don't pay for a second round trip to the kernel
+        health_interval -- number of idle seconds after which the kernel is pinged, and replaced if
+            it doesn't answer within ping_timeout seconds, or None to never ping it
+        ping_timeout -- number of seconds a kernel has to answer a ping
+        """
+        self.wl_kernel = wl_kernel
+        self.warm_up = warm_up
+        self.max_evaluations = max_evaluations
+        self.max_memory_growth = max_memory_growth
+        self.memory_check_interval = memory_check_interval
+        self.health_interval = health_interval
+        self.ping_timeout = ping_timeout
+        self.session = None
+        self.evaluations = 0
+        self.restarts = 0
+        self.base_memory = None
+        self.last_used = time.monotonic()
+        # Only one evaluation at a time, like a WolframLanguageSession
+        self.lock = threading.RLock()
+        self.stopping = threading.Event()
+        self.health_thread = None
+
+    @property
+    def started(self):
+        return self.session != None
+
+    def create_session(self):
+        return WolframLanguageSession() if self.wl_kernel == None else WolframLanguageSession(self.wl_kernel)
+
+    def start(self):
+        """Boot the kernel and warm it up, if that hasn't happened yet"""
+        with self.lock:
+            if self.session != None:
+                return
+            start = time.perf_counter()
+            session = self.create_session()
+            session.start()
+            boot_seconds = time.perf_counter() - start
+            metrics.observe('kernel_boot_seconds', boot_seconds)
+            warm_up_seconds = 0.0
+            if self.warm_up:
+                start = time.perf_counter()
+                session.evaluate(wl.System.TextContents(WARM_UP_TEXT, wl.System.Automatic, wl.System.All))
+                warm_up_seconds = time.perf_counter() - start
+                metrics.observe('kernel_warm_up_seconds', warm_up_seconds)
+            if self.max_memory_growth != None:
+                self.base_memory = session.evaluate(wlexpr('MemoryInUse[]'))
+            print(f"Kernel booted in {boot_seconds:.1f}s, warmed up in {warm_up_seconds:.1f}s")
+            self.session = session
+            self.evaluations = 0
+            self.last_used = time.monotonic()
+        if self.health_interval != None and self.health_thread == None:
+            self.stopping.clear()
+            self.health_thread = threading.Thread(target=self.check_health, name='KernelHealth', daemon=True)
+            self.health_thread.start()
+
+    def stop(self):
+        """Stop the kernel, and stop pinging it"""
+        self.stopping.set()
+        if self.health_thread != None:
+            self.health_thread.join()
+            self.health_thread = None
+        with self.lock:
+            if self.session != None:
+                self.session.stop()
+                self.session = None
+
+    def restart(self, reason):
+        """Replace the kernel with a fresh one
+
+        reason -- why the kernel is being replaced, for the logs
+        """
+        with self.lock:
+            print(f"Restarting kernel: {reason}")
+            metrics.increment('kernel_restarts', reason=reason.split(' ')[0])
+            if self.session != None:
+                try:
+                    self.session.terminate()
+                except Exception:
+                    pass # The kernel is probably dead already
+                self.session = None
+            self.restarts += 1
+            self.start()
+
+    def evaluate(self, expr, **kwargs):
+        """Evaluate an expression on the kernel, starting it first if needed"""
+        return self.run(self.session_evaluate, expr, **kwargs)
+
+    def evaluate_wxf(self, expr, **kwargs):
+        """Evaluate an expression on the kernel and return the result as WXF bytes"""
+        return self.run(self.session_evaluate_wxf, expr, **kwargs)
+
+    def session_evaluate(self, expr, **kwargs):
+        return self.session.evaluate(expr, **kwargs)
+
+    def session_evaluate_wxf(self, expr, **kwargs):
+        return self.session.evaluate_wxf(expr, **kwargs)
+
+    def run(self, evaluate, expr, **kwargs):
+        with self.lock:
+            self.start()
+            result = evaluate(expr, **kwargs)
+            self.evaluations += 1
+            self.last_used = time.monotonic()
+            self.recycle_if_needed()
+            return result
+
+    def recycle_if_needed(self):
+        """Replace the kernel if it has done max_evaluations evaluations or grown by more than
+        max_memory_growth bytes. Memory is only checked every memory_check_interval evaluations.
+        """
+        if self.max_evaluations != None and self.evaluations >= self.max_evaluations:
+            self.restart(f'evaluations reached {self.evaluations}')
+        elif self.max_memory_growth != None and self.evaluations % self.memory_check_interval == 0:
+            try:
+                memory = self.session.evaluate(wlexpr('MemoryInUse[]'))
+            except Exception as exception:
+                # The evaluation before it worked; a dead kernel is the health check's business
+                print(f"Kernel memory check failed: {exception}")
+                metrics.increment('kernel_memory_check_failures')
+                return
+            if not isinstance(memory, int):
+                print(f"Kernel memory check returned {memory}")
+                metrics.increment('kernel_memory_check_failures')
+                return
+            if memory - self.base_memory > self.max_memory_growth:
+                self.restart(f'memory grew by {memory - self.base_memory} bytes')
+
+    def ping(self):
+        """Check that the kernel answers, replacing it if it doesn't. Returns whether it answered."""
+        with self.lock:
+            if self.session == None:
+                return True
+            try:
+                answer = self.session.evaluate_future(wlexpr('1+1')).result(timeout=self.ping_timeout)
+            except Exception:
+                answer = None
+            self.last_used = time.monotonic()
+            metrics.increment('kernel_pings', healthy=answer == 2)
+            if answer != 2:
+                self.restart('no answer to ping')
+            return answer == 2
+
+    def check_health(self):
+        """Ping the kernel whenever it's been idle for health_interval seconds"""
+        while not self.stopping.wait(self.health_interval / 4):
+            if time.monotonic() - self.last_used < self.health_interval:
+                continue
+            # Don't queue up behind an evaluation; being busy is proof enough of life
+            if not self.lock.acquire(blocking=False):
+                continue
+            try:
+                self.ping()
+            except Exception as exception:
+                print(f"Kernel health check failed: {exception}")
+            finally:
+                self.lock.release()
+
+def check_authkey(authkey):
+    """Get an authkey as bytes, raising ValueError if it's empty or a placeholder"""
+    if authkey == None or authkey.strip() in PLACEHOLDER_AUTHKEYS:
+        raise ValueError('kernel_session.server_authkey must be set to a secret before a kernel '
+                         'server can be served or attached to')
+    return authkey.encode('utf-8')
+
+def parse_address(address):
+    """Turn "host:port" into a (host, port) tuple; anything else is the path of a Unix socket"""
+    match = re.fullmatch(r'(.+):(\d+)', address)
+    return (match.group(1), int(match.group(2))) if match != None else address
+
+class RemoteSession:
+    def __init__(self, address, authkey):
+        """Session that evaluates on the kernel of a KernelServer. Expressions and results are sent
+        as WXF.
+
+        address -- address the server listens on, "host:port" or the path of a Unix socket
+        authkey -- shared secret of the server, as a string
+        """
+        self.address = address
+        self.connection = Client(parse_address(address), authkey=check_authkey(authkey))
+        self.lock = threading.Lock()
+
+    def evaluate(self, expr, **kwargs):
+        return binary_deserialize(self.evaluate_wxf(expr))
+
+    def evaluate_wxf(self, expr, **kwargs):
+        with self.lock:
+            self.connection.send_bytes(export(expr, target_format='wxf'))
+            # Raw bytes rather than recv, which would unpickle whatever the server sent
+            response = self.connection.recv_bytes()
+        if response[:1] != RESPONSE_OK:
+            raise RuntimeError(f"Kernel server {self.address} failed to evaluate: "
+                               f"{response[1:].decode('utf-8', 'replace')}")
+        return response[1:]
+
+    def stop(self):
+        """Disconnect from the server, which keeps its kernel running"""
+        self.connection.close()
+
+class KernelServer:
+    def __init__(self, session, address, authkey):
+        """Serve evaluations on a session to RemoteSessions, one thread per connection. The session
+        evaluates one expression at a time, whoever it's from.
+
+        session -- ManagedSession to evaluate on
+        address -- address to listen on, "host:port" or the path of a Unix socket
+        authkey -- shared secret clients need to connect, as a string; empty or placeholder keys
+            are refused, see PLACEHOLDER_AUTHKEYS
+        """
+        self.session = session
+        self.listener = Listener(parse_address(address), authkey=check_authkey(authkey))
+
+    def serve_forever(self):
+        while True:
+            try:
+                connection = self.listener.accept()
+            except OSError:
+                break # The listener was closed
+            except Exception as exception:
+                print(f"Refused a connection: {exception}")
+                continue
+            threading.Thread(target=self.serve, args=(connection,), daemon=True).start()
+
+    def serve(self, connection):
+        with connection:
+            while True:
+                try:
+                    request = connection.recv_bytes()
+                except (EOFError, OSError):
+                    return
+                try:
+                    response = RESPONSE_OK + self.session.evaluate_wxf(binary_deserialize(request))
+                    status = 'ok'
+                except Exception as exception:
+                    response = RESPONSE_ERROR + repr(exception).encode('utf-8')
+                    status = 'error'
+                metrics.increment('kernel_server_requests', status=status)
+                connection.send_bytes(response)
+
+    def close(self):
+        self.listener.close()
+
+def open_session(wl_kernel=None, eager=True, server_address=None, server_authkey='', **options):
+    """Open a session on a KernelServer if one is configured and running, or else on a
+    ManagedSession of its own
+
+    wl_kernel -- location of Wolfram kernel
+    eager -- boot and warm up a ManagedSession right away instead of on its first evaluation
+    server_address -- address of a KernelServer to attach to, or None to always use a kernel of our own
+    server_authkey -- shared secret of the KernelServer
+    options -- keyword args of ManagedSession
+    """
+    if server_address != None:
+        try:
+            session = RemoteSession(server_address, server_authkey)
+            print(f"Attached to kernel server {server_address}")
+            return session
+        except (OSError, EOFError) as exception:
+            print(f"Kernel server {server_address} isn't available ({exception}), starting a kernel")
+    session = ManagedSession(wl_kernel, **options)
+    if eager:
+        session.start()
+    return session
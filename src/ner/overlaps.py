@@ -0,0 +1,71 @@
+from bisect import bisect_right
+
+def is_overlapping(x1, x2, y1, y2):
+    """Determines if two ranges (x1, x2) and (y1, y2) overlap"""
+    return x1 <= y2 and y1 <= x2
+
+def get_precedence_ranks(type_precedence):
+    """Map each entity type to its position in the type precedence, so ranks don't have to be
+    looked up with list.index for every comparison. Lower ranks are preferred.
+
+    type_precedence -- list of entity types, most preferred first
+    """
+    return {entity_type: rank for rank, entity_type in enumerate(type_precedence)}
+
+def resolve_overlaps(entities_in, type_precedence):
+    """Removes overlapping entities from the input list. Entities are swept in order of start_pos
+    and grouped into clusters of (possibly transitively) overlapping entities. Within a cluster the
+    most preferred entity is kept first, then the next most preferred entity that doesn't overlap
+    anything kept so far, and so on. An entity is more preferred if:
+        - its text is longer
+        - its entity type comes first in the type precedence
+        - its confidence value is higher
+    The output list is sorted by the entity's start_pos.
+
+    entities_in -- input list of entities
+    type_precedence -- list of entity types, most preferred first
+    """
+    ranks = get_precedence_ranks(type_precedence)
+    unranked = len(ranks)
+
+    def preference(entity):
+        return (len(entity['text']), -ranks.get(entity['type'], unranked), entity['confidence'])
+
+    entities_out = []
+    cluster = []
+    cluster_end = None
+    for entity in sorted(entities_in, key=lambda entity: (entity['start_pos'], entity['end_pos'])):
+        if cluster and entity['start_pos'] > cluster_end:
+            entities_out.extend(resolve_cluster(cluster, preference))
+            cluster = []
+        if not cluster:
+            cluster_end = entity['end_pos']
+        cluster.append(entity)
+        cluster_end = max(cluster_end, entity['end_pos'])
+    if cluster:
+        entities_out.extend(resolve_cluster(cluster, preference))
+    return entities_out
+
+def resolve_cluster(cluster, preference):
+    """Pick the non-overlapping entities to keep out of a cluster of overlapping entities, greedily
+    by preference. Returns the kept entities sorted by start_pos.
+
+    cluster -- list of entities sorted by start_pos, all transitively overlapping each other
+    preference -- key function that is larger for more preferred entities
+    """
+    if len(cluster) == 1:
+        return cluster
+    kept_starts = []
+    kept = []
+    # sorted() is stable, so equally preferred entities are decided by position
+    for entity in sorted(cluster, key=preference, reverse=True):
+        # Kept entities never overlap, so ordering them by start also orders them by end. Only the
+        # neighbours on either side of the insertion point can overlap the new entity.
+        position = bisect_right(kept_starts, entity['start_pos'])
+        if position > 0 and kept[position - 1]['end_pos'] >= entity['start_pos']:
+            continue
+        if position < len(kept) and kept[position]['start_pos'] <= entity['end_pos']:
+            continue
+        kept_starts.insert(position, entity['start_pos'])
+        kept.insert(position, entity)
+    return kept
@@ -0,0 +1,40 @@
+import re
+
+month_names = ['january', 'february', 'march', 'april', 'may', 'june', 'july', 'august',
+               'september', 'october', 'november', 'december']
+weekday_names = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+# Words that can start a Date, Quantity or CurrencyAmount without a capital letter or digit
+date_words = ['yesterday', 'tomorrow', 'century', 'centuries', 'decade', 'year', 'years', 'month',
+              'months', 'week', 'weeks', 'day', 'days', 'hour', 'hours', 'morning', 'evening', 'night']
+number_words = ['one', 'two', 'three', 'four', 'five', 'six', 'seven', 'eight', 'nine', 'ten',
+                'eleven', 'twelve', 'twenty', 'thirty', 'forty', 'fifty', 'sixty', 'seventy',
+                'eighty', 'ninety', 'hundred', 'thousand', 'million', 'dozen', 'half', 'score']
+
+# A capitalised word of at least two letters (so a lone "I" or "A" doesn't count)
+capitalised_word_pattern = re.compile(r'\b[A-Z][A-Za-z]')
+digit_pattern = re.compile(r'\d')
+letter_pattern = re.compile(r'[A-Za-z]')
+# What can come right before the first word of a sentence, ignoring whitespace
+sentence_start_pattern = re.compile(r'(?:^|[.!?:;"“‘(\[])[\s"“‘(\[]*$')
+candidate_word_pattern = re.compile(
+    r'\b(?:' + '|'.join(month_names + weekday_names + date_words + number_words) + r')\b',
+    re.IGNORECASE)
+
+def has_candidates(paragraph, ignore_sentence_starts=False):
+    """Check if a paragraph could contain an entity, without asking the tagger. Paragraphs with no
+    capitalised words, no date or number words, and no digits next to words (a page number on its
+    own doesn't count) can't hold anything TextContents would find, so they needn't be tagged.
+    That isn't quite true: a paragraph that is only a number, like "£5" or a bare year, loses the
+    Quantity or Date the tagger would have found in it, which is why pre-filtering is opt-in.
+
+    paragraph -- paragraph text
+    ignore_sentence_starts -- don't count capitalised words that start a sentence. Much stricter,
+        for text whose entities were mostly found some other way already.
+    """
+    for match in capitalised_word_pattern.finditer(paragraph):
+        if (not ignore_sentence_starts or
+                not sentence_start_pattern.search(paragraph, max(0, match.start() - 20), match.start())):
+            return True
+    if digit_pattern.search(paragraph) and letter_pattern.search(paragraph):
+        return True
+    return candidate_word_pattern.search(paragraph) != None
@@ -0,0 +1,99 @@
+import hashlib
+import re
+import sys
+import threading
+from collections import Counter, OrderedDict
+
+non_id_pattern = re.compile('[^0-9a-zA-Z]+')
+
+def get_xml_id_candidates(wolfram_entity):
+    """Get the xml:ids an entity can be given in the TEI index, most preferred first: its canonical
+    name stripped to letters and digits, then that with more and more of a hash of its URN added,
+    for when another entity's canonical name strips to the same id
+    """
+    base = non_id_pattern.sub('', wolfram_entity.canonical_name)
+    digest = hashlib.sha1(wolfram_entity.urn.encode('utf-8')).hexdigest()
+    if base == '':
+        # Nothing left of the canonical name, e.g. because it isn't in Latin script
+        return [f'entity_{digest[:8]}', f'entity_{digest[:16]}', f'entity_{digest}']
+    return [base, f'{base}_{digest[:8]}', f'{base}_{digest[:16]}', f'{base}_{digest}']
+
+class RefRegistry:
+    def __init__(self, index_name, generate_index=True, max_cached=65536):
+        """Works out the Mathematica URN, xml:id and @ref attribute of each entity once, and keeps
+        the most recently used ones in an LRU cache so repeat occurrences are cheap. Every entity
+        keeps the xml:id it was first given. Entities whose canonical names strip to the same
+        xml:id get a hash of their URN added (see get_xml_id_candidates), so they don't clobber
+        each other in the index.
+
+        index_name -- name of the TEI index, part of every TEI Index URN
+        generate_index -- whether entities get xml:ids and TEI Index URNs at all
+        max_cached -- number of entities to keep in the LRU cache
+        """
+        self.index_name = index_name
+        self.generate_index = generate_index
+        self.max_cached = max_cached
+        # Looks like {WolframEntity: (Mathematica URN, xml:id, @ref)}
+        self.cache = OrderedDict()
+        # Every xml:id given out, looks like {Mathematica URN: xml:id} and {xml:id: Mathematica URN}
+        self.xml_ids = dict()
+        self.xml_id_owners = dict()
+        # Function that gives out xml:ids instead, see set_claim_function
+        self.claim = None
+        # Looks like {'Mathematica URN': number of times the entity was looked up}
+        self.occurrences = Counter()
+        self.lock = threading.Lock()
+
+    def set_claim_function(self, claim):
+        """Give out xml:ids with a function shared with other processes, e.g.
+        EntityRegistry.claim_xml_id, so every process tagging a corpus gives an entity the same one
+
+        claim -- function taking (Mathematica URN, WolframEntity, xml:id candidates) that returns
+            the xml:id the entity has, or the first candidate no other entity has
+        """
+        self.claim = claim
+
+    def get_refs(self, wolfram_entity):
+        """Get the Mathematica URN, xml:id and @ref attribute of an entity, counting an occurrence
+        of it. The xml:id is None if no index is generated, and the @ref is then the Mathematica URN.
+
+        wolfram_entity -- WolframEntity of the entity
+        """
+        with self.lock:
+            refs = self.cache.get(wolfram_entity)
+            if refs != None:
+                self.cache.move_to_end(wolfram_entity)
+            else:
+                refs = self.make_refs(wolfram_entity)
+                self.cache[wolfram_entity] = refs
+                if len(self.cache) > self.max_cached:
+                    self.cache.popitem(last=False)
+            self.occurrences[refs[0]] += 1
+        return refs
+
+    def make_refs(self, wolfram_entity):
+        # The URNs are interned since each is held by many records and dict keys
+        mathematica_ref = sys.intern(wolfram_entity.urn)
+        if not self.generate_index:
+            return mathematica_ref, None, mathematica_ref
+        entity_id = self.xml_ids.get(mathematica_ref)
+        if entity_id == None:
+            entity_id = self.assign_xml_id(mathematica_ref, wolfram_entity)
+        return mathematica_ref, entity_id, sys.intern(f"urn:teiindex:{self.index_name}:{entity_id}")
+
+    def assign_xml_id(self, mathematica_ref, wolfram_entity):
+        """Give a new entity the first of its xml:id candidates no other entity has"""
+        candidates = get_xml_id_candidates(wolfram_entity)
+        if self.claim != None:
+            entity_id = self.claim(mathematica_ref, wolfram_entity, candidates)
+        else:
+            entity_id = next((candidate for candidate in candidates if candidate not in self.xml_id_owners),
+                             candidates[-1])
+        self.xml_ids[mathematica_ref] = entity_id
+        self.xml_id_owners.setdefault(entity_id, mathematica_ref)
+        return entity_id
+
+    def get_occurrences(self):
+        """Get the number of times each entity was looked up, over everything tagged so far"""
+        with self.lock:
+            return Counter(self.occurrences)
@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from wolframclient.serializers import export
+from wolframclient.deserializers import binary_deserialize
+
+class TaggerCache:
+    def __init__(self, cache_dir):
+        """Open (or create) a persistent cache of TextContents results in cache_dir. Results are
+        keyed by a hash of the paragraph text, the requested entity types and the kernel version,
+        and stored as WXF so interpretations come back as the same Wolfram Language expressions.
+
+        cache_dir -- directory to keep the cache database in
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, 'textcontents.sqlite')
+        # A KernelPool may use a tagger, and so its cache, from any of its threads
+        self.connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS predictions (key TEXT PRIMARY KEY, entities BLOB NOT NULL)')
+            # qid is NULL for entities that have no Wikidata ID
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS wikidata_ids (urn TEXT PRIMARY KEY, qid TEXT)')
+
+    def close(self):
+        """Close the cache database"""
+        self.connection.close()
+
+    def make_key(self, text, entity_types, kernel_version):
+        """Get the cache key of a paragraph
+
+        text -- paragraph text
+        entity_types -- list of entity types requested from TextContents, or None for Automatic
+        kernel_version -- version string of the kernel doing the tagging
+        """
+        key_data = json.dumps([text, entity_types, kernel_version], separators=(',', ':'))
+        return hashlib.sha256(key_data.encode('utf-8')).hexdigest()
+
+    def get_many(self, keys):
+        """Get the cached entity lists for the given keys. Keys that aren't cached map to None.
+
+        keys -- list of cache keys
+        """
+        found = dict()
+        with self.lock:
+            # Stay well under SQLite's limit on the number of query parameters
+            for start in range(0, len(keys), 500):
+                key_chunk = keys[start:start + 500]
+                placeholders = ','.join('?' * len(key_chunk))
+                rows = self.connection.execute(
+                    f'SELECT key, entities FROM predictions WHERE key IN ({placeholders})', key_chunk)
+                for key, entities in rows:
+                    found[key] = entities
+        return [self.deserialize(found[key]) if key in found else None for key in keys]
+
+    def set_many(self, items):
+        """Store entity lists in the cache
+
+        items -- list of (key, entities) tuples, where entities is the list of entities predict found
+        """
+        rows = [(key, self.serialize(entities)) for key, entities in items]
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO predictions (key, entities) VALUES (?, ?)', rows)
+
+    def get_wikidata_ids(self, urns):
+        """Get the cached Wikidata QIDs of Wolfram entities. Returns a dict mapping each cached URN to
+        its QID, or to None if the entity is known to have no Wikidata ID. URNs that aren't cached
+        are left out.
+
+        urns -- list of Wolfram entity URNs
+        """
+        found = dict()
+        with self.lock:
+            for start in range(0, len(urns), 500):
+                urn_chunk = urns[start:start + 500]
+                placeholders = ','.join('?' * len(urn_chunk))
+                rows = self.connection.execute(
+                    f'SELECT urn, qid FROM wikidata_ids WHERE urn IN ({placeholders})', urn_chunk)
+                found.update(rows)
+        return found
+
+    def set_wikidata_ids(self, wikidata_ids):
+        """Store the Wikidata QIDs of Wolfram entities
+
+        wikidata_ids -- dict mapping Wolfram entity URNs to QIDs, or to None if they have none
+        """
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO wikidata_ids (urn, qid) VALUES (?, ?)', wikidata_ids.items())
+
+    def serialize(self, entities):
+        """Serialize a list of entities (including their interpretations) to WXF"""
+        return export(entities, target_format='wxf')
+
+    def deserialize(self, data):
+        """Deserialize a WXF list of entities. The WXF deserializer gives back immutable dicts, but
+        NamedEntityRecognizer adds refs to the entities, so we copy them into regular dicts.
+        """
+        return [dict(entity) for entity in binary_deserialize(data)]
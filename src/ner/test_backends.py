@@ -0,0 +1,47 @@
+import pytest
+from wolframclient.language import wl
+from benchmarks.fixtures import make_synthetic_fixture
+from src.ner.backends import FakeTagger, GazetteerTagger, RecordingTagger, ReplayTagger, TaggerBackend
+
+def test_backends_must_implement_find_entities():
+    class IncompleteTagger(TaggerBackend):
+        pass
+
+    with pytest.raises(TypeError):
+        IncompleteTagger()
+
+def test_fake_tagger_tags_capitalised_words():
+    tagger = FakeTagger('City')
+    output = tagger.predict('we sailed from Old Cairo to Luxor')
+    assert [(entity['text'], entity['start_pos'], entity['end_pos']) for entity in output['entities']] == \
+        [('Old Cairo', 15, 24), ('Luxor', 28, 33)]
+    assert output['entities'][0]['interpretation'] == wl.Entity('City', 'Old Cairo')
+    assert tagger.predict_batch(['Cairo'], entity_types=['Person']) == [{'text': 'Cairo', 'entities': []}]
+    assert tagger.texts == ['we sailed from Old Cairo to Luxor', 'Cairo']
+
+def test_gazetteer_tagger_prefers_the_longest_name():
+    tagger = GazetteerTagger([
+        {'text': 'Nile', 'type': 'River', 'entity': ['River', 'Nile']},
+        {'text': 'Blue Nile', 'type': 'River', 'entity': ['River', 'BlueNile'], 'confidence': 0.9},
+        {'text': 'Philae', 'type': 'HistoricalSite'}
+    ])
+    entities = tagger.find_entities('From the Blue Nile to the Nile at Philae', None)
+    assert [(entity['text'], entity['interpretation']) for entity in entities] == [
+        ('Blue Nile', wl.Entity('River', 'BlueNile')), ('Nile', wl.Entity('River', 'Nile')), ('Philae', 'Philae')]
+    assert entities[0]['confidence'] == 0.9
+    assert [entity['text'] for entity in tagger.find_entities('Philae on the Nile', ['River'])] == ['Nile']
+    assert GazetteerTagger([]).find_entities('Nile', None) == []
+
+def test_recorded_responses_are_replayed(tmp_path):
+    paragraphs, recording = make_synthetic_fixture(20)
+    tagger = RecordingTagger(ReplayTagger(recording))
+    outputs = tagger.predict_batch(paragraphs)
+    assert tagger.find_entities(paragraphs[0], None) == outputs[0]['entities']
+    tagger.save(str(tmp_path / 'recording.wxf'))
+
+    replay = ReplayTagger.from_file(str(tmp_path / 'recording.wxf'))
+    assert replay.predict_batch(paragraphs) == outputs
+    with pytest.raises(KeyError):
+        replay.find_entities('Not recorded', None)
+    replay.fallback = FakeTagger()
+    assert [entity['text'] for entity in replay.find_entities('Not recorded', None)] == ['Not']
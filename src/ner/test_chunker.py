@@ -0,0 +1,74 @@
+import re
+from src.ner.chunker import Chunker
+from src.ner.flair_ner import NamedEntityRecognizer
+
+def find_names(text):
+    """Tagger output of every run of capitalised words, like FakeTagger's"""
+    return {'text': text, 'entities': [
+        {'text': match.group(), 'start_pos': match.start(), 'end_pos': match.end(), 'type': 'Person',
+         'confidence': 1.0, 'interpretation': match.group()}
+        for match in re.finditer(r'\b[A-Z][a-z]+(?: [A-Z][a-z]+)*\b', text)]}
+
+def tag(chunker, texts):
+    units = chunker.plan(texts)
+    return chunker.reassemble(units, [find_names(unit.text) for unit in units], len(texts))
+
+def spans(entities):
+    return [(entity['text'], entity['start_pos'], entity['end_pos']) for entity in entities]
+
+def test_short_texts_are_joined_into_units():
+    chunker = Chunker(100, 20)
+    texts = ['Amelia sailed.', 'Lucie wrote.', 'x' * 90, 'Philae at last.']
+    units = chunker.plan(texts)
+    assert [unit.text for unit in units] == ['Amelia sailed.\n\nLucie wrote.', 'x' * 90, 'Philae at last.']
+    assert [spans(entities) for entities in tag(chunker, texts)] == \
+        [[('Amelia', 0, 6)], [('Lucie', 0, 5)], [], [('Philae', 0, 6)]]
+
+def test_entities_across_the_separator_are_dropped():
+    chunker = Chunker(100, 20, separator=' ')
+    units = chunker.plan(['at Amelia', 'Edwards sailed'])
+    assert units[0].text == 'at Amelia Edwards sailed'
+    assert chunker.reassemble(units, [find_names(units[0].text)], 2) == [[], []]
+
+def test_long_texts_are_split_on_sentences_with_an_overlap():
+    chunker = Chunker(100, 40)
+    text = ' '.join(f'Sentence number {number} is here.' for number in range(20))
+    pieces = chunker.split(text)
+    assert len(pieces) > 1
+    for (start, end, next_start), (following_start, _, _) in zip(pieces, pieces[1:]):
+        assert next_start == following_start
+        assert end - 40 <= following_start < end
+        # Pieces end after a sentence, and start at a word
+        assert text[end - 2:end] == '. ' and text[following_start - 1] == ' '
+    assert pieces[0][0] == 0 and pieces[-1][1] == len(text) and pieces[-1][2] == None
+
+def test_entity_on_a_piece_boundary_comes_back_once():
+    chunker = Chunker(100, 25)
+    # No sentence ends, so the first piece ends at the last space before 100, between the names
+    text = 'nile ' * 18 + 'Amelia Edwards sailed ' + 'on the nile ' * 10
+    units = chunker.plan([text])
+    assert len(units) > 1 and units[0].text.endswith('Amelia ')
+    assert spans(tag(chunker, [text])[0]) == [('Amelia Edwards', 90, 104)]
+
+def test_entity_in_an_overlap_window_comes_back_once():
+    chunker = Chunker(100, 40)
+    text = 'the boat sailed on. ' * 4 + 'We saw Luxor. ' + 'the boat sailed on. ' * 6
+    units = chunker.plan([text])
+    luxor = text.index('Luxor')
+    # Both pieces see Luxor
+    assert sum(1 for unit in units if 'Luxor' in unit.text) == 2
+    assert spans(tag(chunker, [text])[0]) == [('We', luxor - 7, luxor - 5), ('Luxor', luxor, luxor + 5)]
+
+def test_chunked_tagging_finds_what_unchunked_tagging_does():
+    words = ['the', 'river', 'boat', 'sailed', 'and', 'we', 'saw', 'Amelia Edwards', 'Karnak.']
+    text = ' '.join(words[(number * 7) % len(words)] for number in range(600))
+
+    def create_ner(**options):
+        return NamedEntityRecognizer(None, ['Person'], 0.5, False, 'nile', tagger_backend='fake', **options)
+
+    unchunked = create_ner().tag_entities(text)[0]['entities']
+    ner = create_ner(chunk_chars=300, chunk_overlap=60)
+    chunked = ner.tag_entities(text)[0]['entities']
+    assert len(ner.tagger.texts) > 5
+    assert [(entity.text, entity.start_pos, entity.end_pos) for entity in chunked] == \
+        [(entity.text, entity.start_pos, entity.end_pos) for entity in unchunked]
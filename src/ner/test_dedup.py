@@ -0,0 +1,89 @@
+from src.ner.dedup import ParagraphDeduplicator, normalize
+
+def find_capitalised(text):
+    """Entities of every capitalised word, like a tagger would return them"""
+    entities = []
+    start = None
+    for index, character in enumerate(text + ' '):
+        if start == None and character.isupper():
+            start = index
+        elif start != None and not character.isalpha():
+            entities.append({'text': text[start:index], 'start_pos': start, 'end_pos': index,
+                             'type': 'Person', 'confidence': 1.0, 'interpretation': text[start:index]})
+            start = None
+    return entities
+
+class CountingTagger:
+    def __init__(self):
+        self.texts = []
+
+    def predict(self, texts):
+        self.texts += texts
+        return [find_capitalised(text) for text in texts]
+
+NOTICE = ('This book was digitized by the Internet Archive in 2008 with funding from Microsoft '
+          'Corporation, and may be used freely for any purpose as long as this notice is kept with '
+          'every copy of the')
+OCR_ENDINGS = [' book.', ' b0ok.', ' bo0k.', ' hook.']
+
+def test_normalize_folds_case_and_whitespace():
+    normalized, positions = normalize('  Amelia\n  EDWARDS  sailed ')
+    assert normalized == 'amelia edwards sailed'
+    assert [positions[index] for index in range(len('amelia'))] == [2, 3, 4, 5, 6, 7]
+    # The space stands for the whitespace right before the next word
+    assert positions[len('amelia')] == 10
+    assert positions[len('amelia edwards ')] == 20
+
+def test_normalize_strips_page_numbers_of_running_headers():
+    assert normalize('12 THE NILE')[0] == 'the nile'
+    assert normalize('THE NILE. Page 13')[0] == 'the nile'
+    # Years aren't page numbers, and prose keeps its numbers
+    assert normalize('1873 THE NILE')[0] == '1873 the nile'
+    assert normalize('12 ' + 'words ' * 30)[0].startswith('12 words')
+
+def test_duplicates_get_the_entities_of_the_first_at_their_own_offsets():
+    tagger = CountingTagger()
+    deduplicator = ParagraphDeduplicator()
+    texts = ['Amelia Edwards sailed to Luxor.', 'Amelia   Edwards sailed\nto Luxor.']
+    results = deduplicator.predict(texts, tagger.predict)
+    assert tagger.texts == texts[:1]
+    assert [(entity['text'], entity['start_pos'], entity['end_pos']) for entity in results[1]] == \
+        [('Amelia', 0, 6), ('Edwards', 9, 16), ('Luxor', 27, 32)]
+    # Later batches are looked up too
+    assert deduplicator.predict(['AMELIA EDWARDS SAILED TO LUXOR.'], tagger.predict)[0][2]['text'] == 'LUXOR'
+    assert tagger.texts == texts[:1]
+    assert deduplicator.get_stats()['duplicates'] == 2
+
+def test_fan_out_maps_entities_back_onto_each_text():
+    deduplicator = ParagraphDeduplicator()
+    entity = {'text': 'Luxor', 'start_pos': 3, 'end_pos': 8, 'type': 'City'}
+    first, first_positions = normalize('to Luxor')
+    normalized_entities = deduplicator.to_normalized(first_positions, [entity])
+    assert normalized_entities == [(3, 8, entity)]
+    text = ' TO   LUXOR '
+    assert deduplicator.fan_out(text, normalize(text)[1], normalized_entities) == \
+        [{'text': 'LUXOR', 'start_pos': 6, 'end_pos': 11, 'type': 'City'}]
+
+def test_entities_in_stripped_page_numbers_are_dropped():
+    deduplicator = ParagraphDeduplicator()
+    page_number = {'text': '12', 'start_pos': 0, 'end_pos': 2, 'type': 'Quantity'}
+    assert deduplicator.to_normalized(normalize('12 THE NILE')[1], [page_number]) == []
+
+def test_frequent_near_duplicates_are_skipped_as_boilerplate():
+    tagger = CountingTagger()
+    deduplicator = ParagraphDeduplicator(boilerplate=True, boilerplate_occurrences=2)
+    texts = [NOTICE + ending for ending in OCR_ENDINGS]
+    results = deduplicator.predict(texts, tagger.predict)
+    # OCR errors keep the copies apart, but they're near-duplicates
+    assert tagger.texts == texts[:2]
+    assert results[2:] == [[], []]
+    assert deduplicator.get_stats()['boilerplate'] == 2
+    # Unrelated paragraphs are still tagged
+    deduplicator.predict(['Lucie Duff Gordon wrote letters from Egypt to her family in England'],
+                         tagger.predict)
+    assert len(tagger.texts) == 3
+
+def test_boilerplate_is_only_skipped_when_asked():
+    tagger = CountingTagger()
+    ParagraphDeduplicator().predict([NOTICE + ending for ending in OCR_ENDINGS], tagger.predict)
+    assert len(tagger.texts) == 4
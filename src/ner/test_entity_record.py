@@ -0,0 +1,16 @@
+from wolframclient.language import wl
+from src.ner.entity_record import (WOLFRAM_ENTITY_CACHE_SIZE, WolframEntity, interned_wolfram_entity,
+                                   to_wolfram_entity)
+
+def test_wolfram_entities_are_shared():
+    entity = WolframEntity.intern('City', '["Luxor","Luxor","Egypt"]')
+    assert to_wolfram_entity(['City', '["Luxor","Luxor","Egypt"]']) is entity
+    assert to_wolfram_entity(wl.Entity('City', ['Luxor', 'Luxor', 'Egypt'])) is entity
+    assert entity.urn == 'urn:WolframEntity:City:["Luxor","Luxor","Egypt"]'
+
+def test_shared_wolfram_entities_are_bounded():
+    for number in range(WOLFRAM_ENTITY_CACHE_SIZE + 100):
+        WolframEntity.intern('Person', f'"Person {number}"')
+    assert interned_wolfram_entity.cache_info().currsize == WOLFRAM_ENTITY_CACHE_SIZE
+    # Entities that fell out are still equal to the ones made again
+    assert WolframEntity.intern('Person', '"Person 0"') == WolframEntity('Person', '"Person 0"')
@@ -0,0 +1,36 @@
+import pytest
+from src.ner.flair_ner import NamedEntityRecognizer
+
+PARAGRAPHS = ['Amelia Edwards sailed to Luxor.', 'From Luxor, Amelia Edwards went on.',
+              'We met Amelia Edwards at Philae.']
+
+def create_ner(**options):
+    return NamedEntityRecognizer(None, ['Person'], 0.5, True, 'nile', tagger_backend='fake', **options)
+
+def test_gazetteer_is_off_by_default():
+    ner = create_ner()
+    output = ner.tag_entities('\n\n'.join(PARAGRAPHS))
+    # Every paragraph went to the tagger, and nothing was learnt
+    assert ner.tagger.texts == PARAGRAPHS
+    assert [[entity.text for entity in paragraph['entities']] for paragraph in output] == \
+        [['Amelia Edwards', 'Luxor'], ['From Luxor', 'Amelia Edwards'], ['We', 'Amelia Edwards', 'Philae']]
+    assert ner.get_gazetteer_stats()['surface_forms'] == 0
+
+def test_paragraph_mode_skips_the_tagger_for_known_paragraphs():
+    ner = create_ner(gazetteer_mode='paragraph', batch_bytes=1)
+    output = ner.tag_entities('\n\n'.join(PARAGRAPHS))
+    # Only known surface forms are left in the second paragraph once "From" at the start of the
+    # sentence is ignored, so the tagger doesn't see it
+    assert ner.tagger.texts == [PARAGRAPHS[0], PARAGRAPHS[2]]
+    assert [entity.text for entity in output[1]['entities']] == ['Luxor', 'Amelia Edwards']
+    assert ner.get_gazetteer_stats()['resolved_paragraphs'] == 1
+
+def test_residual_mode_only_tags_what_isnt_known():
+    ner = create_ner(gazetteer_mode='residual', batch_bytes=1)
+    output = ner.tag_entities('Amelia Edwards sailed to Luxor.\n\nAt Luxor we met Lucie Gordon.')
+    assert ner.tagger.texts[1] == 'At ' + ' ' * len('Luxor') + ' we met Lucie Gordon.'
+    assert sorted(entity.text for entity in output[1]['entities']) == ['At', 'Lucie Gordon', 'Luxor']
+
+def test_unknown_gazetteer_modes_are_refused():
+    with pytest.raises(ValueError):
+        create_ner(gazetteer_mode='always')
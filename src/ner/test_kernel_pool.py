@@ -0,0 +1,55 @@
+import pytest
+from wolframclient.exception import WolframKernelException
+from wolframclient.language import wl
+from src.ner import kernel_pool
+from src.ner.kernel_pool import KernelPool
+from src.ner.test_wlflairshim import StandInKernel
+from src.ner.wlflairshim import SequenceTagger
+
+TEXTS = ['Amelia Edwards sailed to Luxor.', 'nothing here']
+
+class CrashingKernel(StandInKernel):
+    def __init__(self, crashes, **options):
+        """Stand-in kernel whose first few evaluations fail as if the kernel died
+
+        crashes -- number of evaluations to fail
+        """
+        super().__init__(**options)
+        self.crashes = crashes
+
+    def evaluate(self, expr, **kwargs):
+        if self.crashes > 0:
+            self.crashes -= 1
+            raise WolframKernelException('Failed to communicate with kernel')
+        return super().evaluate(expr, **kwargs)
+
+def create_pool(monkeypatch, kernels):
+    """Create a pool of one kernel, which is replaced by the next of kernels on every restart"""
+    kernels = iter(kernels)
+
+    def create_tagger(wl_kernel, cache_dir, session_options):
+        tagger = SequenceTagger(wl_kernel, cache_dir, session_options)
+        tagger.session = next(kernels)
+        return tagger
+
+    monkeypatch.setattr(kernel_pool, 'SequenceTagger', create_tagger)
+    return KernelPool(size=1, max_retries=2, session_options={'eager': False, 'warm_up': False})
+
+def test_crashed_kernels_are_restarted(monkeypatch):
+    pool = create_pool(monkeypatch, [CrashingKernel(1), CrashingKernel(1), StandInKernel()])
+    outputs = pool.predict_batch(TEXTS)
+    assert [output['text'] for output in outputs] == TEXTS
+    assert [entity['text'] for entity in outputs[0]['entities']] == ['Amelia Edwards', 'Luxor']
+    stats = pool.get_stats()[0]
+    assert (stats['errors'], stats['restarts'], stats['evaluations']) == (2, 2, 1)
+    pool.close()
+
+def test_texts_that_fail_are_raised_without_a_restart(monkeypatch):
+    kernel = StandInKernel(wl.Failed, TEXTS[1])
+    pool = create_pool(monkeypatch, [kernel, StandInKernel()])
+    with pytest.raises(RuntimeError, match='nothing here'):
+        pool.predict_batch(TEXTS)
+    stats = pool.get_stats()[0]
+    assert (stats['errors'], stats['restarts']) == (1, 0)
+    assert pool.taggers[0].session is kernel
+    pool.close()
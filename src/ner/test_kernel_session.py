@@ -0,0 +1,106 @@
+import threading
+import pytest
+from wolframclient.language import wl
+from wolframclient.serializers import export
+from src.ner.kernel_session import KernelServer, ManagedSession, RemoteSession, check_authkey
+
+class StandInKernel:
+    def __init__(self, memory):
+        """Stand-in for a WolframLanguageSession, whose MemoryInUse[] answers come from a list
+
+        memory -- list of MemoryInUse[] answers, or exceptions to raise, in order
+        """
+        self.memory = memory
+        self.evaluated = []
+        self.stopped = False
+
+    def start(self):
+        pass
+
+    def stop(self):
+        self.stopped = True
+
+    def terminate(self):
+        self.stopped = True
+
+    def evaluate(self, expr, **kwargs):
+        if getattr(expr, 'input', None) == 'MemoryInUse[]':
+            memory = self.memory.pop(0) if len(self.memory) > 1 else self.memory[0]
+            if isinstance(memory, Exception):
+                raise memory
+            return memory
+        self.evaluated.append(expr)
+        if expr == wl.Fail():
+            raise RuntimeError('Evaluation failed')
+        return len(self.evaluated)
+
+    def evaluate_wxf(self, expr, **kwargs):
+        return export(self.evaluate(expr, **kwargs), target_format='wxf')
+
+class StandInSession(ManagedSession):
+    def __init__(self, memory=[0], **options):
+        super().__init__(warm_up=False, **options)
+        self.memory = memory
+        self.kernels = []
+
+    def create_session(self):
+        self.kernels.append(StandInKernel(list(self.memory)))
+        return self.kernels[-1]
+
+def test_kernel_is_replaced_after_max_evaluations():
+    session = StandInSession(max_evaluations=3)
+    for _ in range(7):
+        session.evaluate(wl.Plus(1, 1))
+    assert session.restarts == 2
+    assert [len(kernel.evaluated) for kernel in session.kernels] == [3, 3, 1]
+    assert session.kernels[0].stopped and not session.kernels[-1].stopped
+
+def test_memory_is_only_checked_every_interval():
+    # Base memory, then the answers of the checks after evaluations 5 and 10
+    session = StandInSession([100, 150, 1000, 100], max_memory_growth=500, memory_check_interval=5)
+    for _ in range(9):
+        session.evaluate(wl.Plus(1, 1))
+    assert session.restarts == 0 and session.kernels[0].memory == [1000, 100]
+    session.evaluate(wl.Plus(1, 1))
+    assert session.restarts == 1
+
+def test_failed_memory_checks_dont_replace_the_kernel():
+    session = StandInSession([100, RuntimeError('Kernel busy'), wl.Failed], max_memory_growth=500,
+                             memory_check_interval=1)
+    for _ in range(3):
+        assert session.evaluate(wl.Plus(1, 1)) != None
+    assert session.restarts == 0
+
+@pytest.mark.parametrize('authkey', [None, '', '  ', 'change-me'])
+def test_placeholder_authkeys_are_refused(tmp_path, authkey):
+    with pytest.raises(ValueError):
+        check_authkey(authkey)
+    with pytest.raises(ValueError):
+        KernelServer(StandInSession(), str(tmp_path / 'kernel.sock'), authkey)
+    with pytest.raises(ValueError):
+        RemoteSession(str(tmp_path / 'kernel.sock'), authkey)
+
+def test_remote_sessions_evaluate_on_the_server_kernel(tmp_path):
+    address = str(tmp_path / 'kernel.sock')
+    session = StandInSession()
+    server = KernelServer(session, address, 's3cret')
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        first = RemoteSession(address, 's3cret')
+        second = RemoteSession(address, 's3cret')
+        assert first.evaluate(wl.Plus(1, 1)) == 1
+        assert second.evaluate(wl.Plus(1, 1)) == 2
+        with pytest.raises(RuntimeError, match='Evaluation failed'):
+            first.evaluate(wl.Fail())
+        # The connection still works after an error
+        assert first.evaluate(wl.Plus(1, 1)) == 4
+        first.stop()
+        second.stop()
+        # Clients with the wrong key are turned away
+        with pytest.raises(Exception):
+            RemoteSession(address, 'wrong').evaluate(wl.Plus(1, 1))
+    finally:
+        # Closing the listener doesn't wake up the accept of the daemon thread, so it's left behind
+        server.close()
+        session.stop()
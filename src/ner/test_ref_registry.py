@@ -0,0 +1,86 @@
+from wolframclient.language import wl
+from src.ner.entity_record import to_wolfram_entity
+from src.ner.entity_registry import EntityRegistry
+from src.ner.ref_registry import RefRegistry, get_xml_id_candidates
+
+def make_entity(entity_type, name):
+    return to_wolfram_entity(wl.Entity(entity_type, name))
+
+def test_candidates_add_more_and_more_of_the_hash():
+    entity = make_entity('Person', 'AmeliaEdwards::x7k3')
+    candidates = get_xml_id_candidates(entity)
+    assert candidates[0] == 'AmeliaEdwardsx7k3'
+    assert [len(candidate) - len(candidates[0]) for candidate in candidates[1:]] == [9, 17, 41]
+    assert all(candidate.startswith(candidates[0] + '_') for candidate in candidates[1:])
+
+def test_candidates_of_names_without_letters_or_digits():
+    candidates = get_xml_id_candidates(make_entity('City', '--'))
+    assert candidates[0].startswith('entity_') and len(candidates[0]) == len('entity_') + 8
+
+def test_refs_of_an_entity():
+    registry = RefRegistry('nile')
+    entity = make_entity('City', 'Cairo::8z3f7')
+    urn, xml_id, ref = registry.get_refs(entity)
+    assert urn == entity.urn
+    assert xml_id == 'Cairo8z3f7'
+    assert ref == 'urn:teiindex:nile:Cairo8z3f7'
+    assert registry.get_refs(entity) == (urn, xml_id, ref)
+    assert registry.get_occurrences()[urn] == 2
+
+def test_refs_without_an_index():
+    registry = RefRegistry('nile', generate_index=False)
+    entity = make_entity('City', 'Cairo::8z3f7')
+    assert registry.get_refs(entity) == (entity.urn, None, entity.urn)
+
+def test_colliding_xml_ids_get_hash_suffixes():
+    registry = RefRegistry('nile')
+    # Both canonical names strip to the same letters and digits
+    first = make_entity('Person', 'John-Lane')
+    second = make_entity('Person', 'John Lane')
+    first_id = registry.get_refs(first)[1]
+    second_id = registry.get_refs(second)[1]
+    assert first_id == 'JohnLane'
+    assert second_id == get_xml_id_candidates(second)[1]
+    assert second_id != first_id
+
+def test_entities_keep_their_xml_id_after_leaving_the_cache():
+    registry = RefRegistry('nile', max_cached=1)
+    first = make_entity('Person', 'John-Lane')
+    second = make_entity('Person', 'John Lane')
+    first_id = registry.get_refs(first)[1]
+    second_id = registry.get_refs(second)[1]
+    # first was evicted from the LRU cache by second, but its xml:id is remembered
+    assert registry.get_refs(first)[1] == first_id
+    assert registry.get_refs(second)[1] == second_id
+
+def test_claimed_xml_ids_are_shared_between_registries(tmp_path):
+    # Like two batch_tag.py workers meeting colliding entities in opposite orders
+    entity_registry = EntityRegistry(str(tmp_path / 'entities.sqlite'))
+    other_entity_registry = EntityRegistry(str(tmp_path / 'entities.sqlite'))
+    first_worker = RefRegistry('nile')
+    first_worker.set_claim_function(entity_registry.claim_xml_id)
+    second_worker = RefRegistry('nile')
+    second_worker.set_claim_function(other_entity_registry.claim_xml_id)
+    first = make_entity('Person', 'John-Lane')
+    second = make_entity('Person', 'John Lane')
+
+    assert first_worker.get_refs(first)[1] == 'JohnLane'
+    second_id = second_worker.get_refs(second)[1]
+    assert second_id == get_xml_id_candidates(second)[1]
+    # Each worker gets the xml:id the other one claimed
+    assert second_worker.get_refs(first)[1] == 'JohnLane'
+    assert first_worker.get_refs(second)[1] == second_id
+    entity_registry.close()
+    other_entity_registry.close()
+
+def test_claim_xml_id_falls_back_to_the_full_hash(tmp_path):
+    registry = EntityRegistry(str(tmp_path / 'entities.sqlite'))
+    entity = make_entity('Person', 'John Lane')
+    candidates = get_xml_id_candidates(entity)
+    for number, candidate in enumerate(candidates[:-1]):
+        other = make_entity('Person', f'Other{number}')
+        assert registry.claim_xml_id(other.urn, other, [candidate]) == candidate
+    assert registry.claim_xml_id(entity.urn, entity, candidates) == candidates[-1]
+    # Claiming again gives back the same xml:id
+    assert registry.claim_xml_id(entity.urn, entity, candidates) == candidates[-1]
+    registry.close()
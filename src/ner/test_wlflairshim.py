@@ -0,0 +1,80 @@
+import re
+import pytest
+from wolframclient.language import wl
+from src.ner.wlflairshim import SequenceTagger
+
+class StandInKernel:
+    def __init__(self, batch_failure=None, failing_text=None):
+        """Stand-in for a kernel session that answers Map[TextContents[...]] with every run of
+        capitalised words as a Person
+
+        batch_failure -- what to answer instead when given more than one text, or None
+        failing_text -- text to answer $Failed for, even on its own
+        """
+        self.batch_failure = batch_failure
+        self.failing_text = failing_text
+        # Texts of every evaluation
+        self.evaluations = []
+
+    def evaluate(self, expr, **kwargs):
+        if getattr(expr, 'input', None) == '$Version':
+            return '14.0.0 for Linux x86 (64-bit)'
+        texts = list(expr.args[1].args)
+        self.evaluations.append(texts)
+        if self.batch_failure != None and len(texts) > 1:
+            return self.batch_failure
+        if self.failing_text in texts:
+            return wl.Failed
+        return [(self.text_contents(text),) for text in texts]
+
+    def text_contents(self, text):
+        return [{
+            'String': match.group(),
+            'Position': (match.start() + 1, match.end()),
+            'Type': 'Person',
+            'Probability': 0.9,
+            'Interpretation': wl.Entity('Person', match.group())
+        } for match in re.finditer(r'\b[A-Z][a-z]+(?: [A-Z][a-z]+)*\b', text)]
+
+    def stop(self):
+        pass
+
+def create_tagger(kernel, cache_dir=None):
+    tagger = SequenceTagger(cache_dir=cache_dir, session_options={'eager': False, 'warm_up': False})
+    tagger.session = kernel
+    return tagger
+
+TEXTS = ['Amelia Edwards sailed to Luxor.', 'nothing here', 'Lucie Duff Gordon wrote from Thebes.']
+
+def test_texts_are_tagged_in_chunks():
+    kernel = StandInKernel()
+    outputs = create_tagger(kernel).predict_batch(TEXTS, batch_bytes=50)
+    assert kernel.evaluations == [TEXTS[:2], TEXTS[2:]]
+    assert [output['text'] for output in outputs] == TEXTS
+    assert [(entity['text'], entity['start_pos'], entity['end_pos']) for entity in outputs[0]['entities']] == \
+        [('Amelia Edwards', 0, 14), ('Luxor', 25, 30)]
+    assert outputs[1]['entities'] == []
+
+@pytest.mark.parametrize('batch_failure', [wl.Failed, [], [((),)]])
+def test_failed_batches_are_tagged_one_text_at_a_time(batch_failure):
+    kernel = StandInKernel(batch_failure)
+    outputs = create_tagger(kernel).predict_batch(TEXTS)
+    assert kernel.evaluations == [TEXTS] + [[text] for text in TEXTS]
+    assert outputs == create_tagger(StandInKernel()).predict_batch(TEXTS)
+
+def test_text_that_fails_on_its_own_raises():
+    tagger = create_tagger(StandInKernel(wl.Failed, TEXTS[1]))
+    with pytest.raises(RuntimeError, match='nothing here'):
+        tagger.predict_batch(TEXTS)
+
+def test_cached_texts_arent_sent_to_the_kernel(tmp_path):
+    kernel = StandInKernel()
+    tagger = create_tagger(kernel, str(tmp_path / 'cache'))
+    outputs = tagger.predict_batch(TEXTS[:2])
+    assert tagger.predict_batch(TEXTS, entity_types=['Person']) == create_tagger(StandInKernel()).predict_batch(
+        TEXTS, entity_types=['Person'])
+    # Asking for other entity types is another cache key
+    assert kernel.evaluations == [TEXTS[:2], TEXTS]
+    assert tagger.predict_batch(list(reversed(TEXTS[:2]))) == list(reversed(outputs))
+    assert len(kernel.evaluations) == 2
+    tagger.close()
@@ -1,29 +1,140 @@
-from wolframclient.evaluation import WolframLanguageSession
 from wolframclient.language import wl, wlexpr
+from .kernel_session import open_session
+from .tagger_cache import TaggerCache
+from ..utils.metrics import metrics, describe_text
+
+# Default upper bound on the number of UTF-8 bytes of text shipped to the kernel in one evaluation
+DEFAULT_BATCH_BYTES = 256 * 1024
 
 class SequenceTagger:
-    def __init__(self, wl_kernel=None):
+    def __init__(self, wl_kernel=None, cache_dir=None, session_options=None):
         """Initialize the SentenceTagger
         wl_kernel -- location of Wolfram kernel
+        cache_dir -- directory of the persistent TextContents cache, or None to always ask the kernel
+        session_options -- keyword args of kernel_session.open_session, e.g. to attach to a kernel
+            server or recycle the kernel every so many evaluations. By default the kernel is
+            booted and warmed up right away.
         """
-        self.session = WolframLanguageSession() if wl_kernel == None else WolframLanguageSession(wl_kernel)
+        self.session = open_session(wl_kernel, **(session_options or dict()))
+        self.cache = TaggerCache(cache_dir) if cache_dir != None else None
+        self.kernel_version = None
 
     def close(self):
         """Stop the Wolfram Kernel associated with this tagger"""
         self.session.stop()
+        if self.cache != None:
+            self.cache.close()
+
+    def get_kernel_version(self):
+        """Get the version string of the Wolfram kernel, which is part of every cache key"""
+        if self.kernel_version == None:
+            self.kernel_version = self.session.evaluate(wlexpr('$Version'))
+        return self.kernel_version
 
     def predict(self, text: str, **kwargs) -> dict:
         """Get text entities in text
         text -- text to get entities from
-        
+
         Keyword arguments:
         entity_types -- list of entity types to include
         """
-        forms = wl.System.Automatic
+        return self.predict_batch([text], **kwargs)[0]
+
+    def predict_batch(self, texts: list, batch_bytes=DEFAULT_BATCH_BYTES, **kwargs) -> list:
+        """Get text entities in many texts at once. The texts are split into chunks of at most
+        batch_bytes UTF-8 bytes (a single text larger than that gets a chunk of its own), and each
+        chunk is sent to the kernel in a single Map[TextContents[...]] evaluation. Texts that are
+        in the TextContents cache aren't sent to the kernel at all. Returns one output per text, in
+        the same order and in the same format as predict.
+
+        texts -- list of texts to get entities from
+        batch_bytes -- maximum number of bytes of text to send to the kernel in one evaluation
+
+        Keyword arguments:
+        entity_types -- list of entity types to include
+        """
+        outputs = [None] * len(texts)
+        if self.cache != None:
+            kernel_version = self.get_kernel_version()
+            keys = [self.cache.make_key(text, kwargs.get("entity_types"), kernel_version) for text in texts]
+            for index, entities in enumerate(self.cache.get_many(keys)):
+                if entities != None:
+                    outputs[index] = {"text": texts[index], "entities": entities}
+
+        uncached = [index for index, output in enumerate(outputs) if output == None]
+        if self.cache != None:
+            metrics.increment('tagger_cache_hits', len(texts) - len(uncached))
+            metrics.increment('tagger_cache_misses', len(uncached))
+        forms = self.get_forms(**kwargs)
+        tagged = []
+        for chunk in self.chunk_texts([texts[index] for index in uncached], batch_bytes):
+            tagged += self.evaluate_chunk(chunk, forms)
+        for index, output in zip(uncached, tagged):
+            outputs[index] = output
+
+        if self.cache != None and uncached:
+            self.cache.set_many([(keys[index], outputs[index]["entities"]) for index in uncached])
+        return outputs
+
+    def evaluate_chunk(self, chunk, forms):
+        """Tag a chunk of texts in a single Map[TextContents[...]] evaluation. If the kernel doesn't
+        return one response per text (e.g. $Failed, or a message instead of a result), each text is
+        tagged on its own instead. Raises RuntimeError if a text on its own fails too.
+
+        chunk -- list of texts to tag
+        forms -- TextContents forms argument, see get_forms
+        """
+        expr = wl.System.Map(
+            wl.System.Function(wl.System.TextContents(wl.System.Slot(1), forms, wl.System.All)),
+            wl.System.List(*chunk)
+        )
+        metrics.increment('kernel_evaluations')
+        metrics.increment('kernel_texts', len(chunk))
+        metrics.increment('kernel_bytes_sent', sum(len(text.encode('utf-8')) for text in chunk))
+        with metrics.time('kernel_evaluate_seconds',
+                          context=f'{describe_text(chunk[0])} and {len(chunk) - 1} more texts'):
+            responses = self.session.evaluate(expr)
+        if isinstance(responses, (list, tuple)) and len(responses) == len(chunk):
+            return [self.to_tagger_output(text, response) for text, response in zip(chunk, responses)]
+        if len(chunk) == 1:
+            raise RuntimeError(f'TextContents failed on {describe_text(chunk[0])}: kernel returned '
+                               f'{describe_text(str(responses))}')
+        print(f"Kernel returned {describe_text(str(responses))} for a batch of {len(chunk)} texts, "
+              "tagging them one at a time")
+        metrics.increment('kernel_batch_fallbacks')
+        return [output for text in chunk for output in self.evaluate_chunk([text], forms)]
+
+    def chunk_texts(self, texts, batch_bytes):
+        """Split a list of texts into consecutive chunks holding at most batch_bytes UTF-8 bytes
+
+        texts -- list of texts to split up
+        batch_bytes -- maximum number of bytes in a chunk
+        """
+        chunk = []
+        chunk_bytes = 0
+        for text in texts:
+            text_bytes = len(text.encode('utf-8'))
+            if chunk and chunk_bytes + text_bytes > batch_bytes:
+                yield chunk
+                chunk = []
+                chunk_bytes = 0
+            chunk.append(text)
+            chunk_bytes += text_bytes
+        if chunk:
+            yield chunk
+
+    def get_forms(self, **kwargs):
+        """Get the TextContents forms argument for the given predict keyword arguments"""
         if "entity_types" in kwargs:
-            forms = wl.System.List(*kwargs["entity_types"])
-        expr = wl.System.TextContents(text, forms, wl.System.All)
-        response = self.session.evaluate(expr)
+            return wl.System.List(*kwargs["entity_types"])
+        return wl.System.Automatic
+
+    def to_tagger_output(self, text, response):
+        """Convert the Dataset returned by TextContents into a Flair-like tagger output
+
+        text -- text that was given to TextContents
+        response -- what the kernel returned for TextContents[text, ...]
+        """
         entities = []
         for entity in response[0]:
             entities.append({
@@ -37,4 +148,4 @@ class SequenceTagger:
         return {
             "text": text,
             "entities": entities
-        }
\ No newline at end of file
+        }
@@ -0,0 +1,281 @@
+import asyncio
+import hashlib
+import json
+import re
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from src.tei.assemble_document import create_document_header
+from src.tei.assemble_tei import create_body, create_xml
+
+# create_document keyword args a submission may set in the TEI header. The descriptions are tagged
+# with the service's NamedEntityRecognizer, like the text.
+HEADER_FIELDS = ['title', 'author', 'editor', 'publisher', 'publisher_address', 'publisher_date',
+                 'license_desc', 'project_description', 'source_description']
+
+class QueueFullError(Exception):
+    """Raised when a job is submitted while the tagging queue is full"""
+
+class TaggingJob:
+    def __init__(self, job_id, key, text, header):
+        """A submitted text waiting to be, being, or done being tagged
+
+        job_id -- unique ID of the job
+        key -- cache key of the submission, see TaggingService.make_key
+        text -- raw text to tag
+        header -- dict of TEI header fields (see HEADER_FIELDS)
+        """
+        self.job_id = job_id
+        self.key = key
+        self.text = text
+        self.header = header
+        # 'queued', 'running', 'done', 'failed' or 'timeout'
+        self.status = 'queued'
+        # JSON-friendly output of each paragraph tagged so far, in document order
+        self.paragraphs = []
+        self.tei = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        # Set from the event loop to ask the tagging thread to stop between batches
+        self.cancelled = False
+        # Set and replaced whenever the job changes. Grab it before checking the job, then wait on it.
+        self.update_event = asyncio.Event()
+
+    @property
+    def finished(self):
+        return self.status in ['done', 'failed', 'timeout']
+
+    def notify(self):
+        """Wake up everything waiting for this job to change"""
+        self.update_event.set()
+        self.update_event = asyncio.Event()
+
+    def add_paragraph(self, paragraph):
+        """Record the output of the next tagged paragraph. Must be called on the event loop."""
+        self.paragraphs.append(paragraph)
+        self.notify()
+
+    def set_status(self, status, tei=None, error=None):
+        """Move the job to another status. Must be called on the event loop."""
+        self.status = status
+        if status == 'running':
+            self.started_at = time.time()
+        if self.finished:
+            self.finished_at = time.time()
+            self.tei = tei
+            self.error = error
+            self.text = None # Not needed any more, and it may be big
+        self.notify()
+
+    def to_dict(self, include_results=True):
+        """Get the job as a dict that can be sent as JSON
+
+        include_results -- include the tagged paragraphs and TEI document
+        """
+        job = {
+            'job_id': self.job_id,
+            'status': self.status,
+            'paragraphs_tagged': len(self.paragraphs),
+            'submitted_at': self.submitted_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at
+        }
+        if self.error != None:
+            job['error'] = self.error
+        if include_results and self.status == 'done':
+            job['paragraphs'] = self.paragraphs
+            job['tei'] = self.tei
+        return job
+
+def to_json_paragraph(tagger_output):
+    """Turn the Flair-like output of a paragraph into something that can be sent as JSON. Wolfram
+    Language interpretations are left out; the ref attribute identifies the entity instead.
+
+    tagger_output -- output of NamedEntityRecognizer.tag_paragraphs for one paragraph
+    """
+    return {
+        'text': tagger_output['text'],
+        'entities': [entity.to_dict() for entity in tagger_output['entities']]
+    }
+
+class TaggingService:
+    def __init__(self, ner, workers=1, max_queued_jobs=100, job_timeout=300, max_finished_jobs=1000,
+                 use_lxml=False):
+        """Tag submitted texts in the background on an asyncio job queue. Texts are tagged by
+        worker threads, so the event loop never blocks on the kernel. Finished jobs are kept as a
+        result cache, so submitting the same text and header again gives back the same job.
+
+        ner -- NamedEntityRecognizer (or anything with the same tag_paragraphs and tag_entities)
+        workers -- number of jobs to tag at once. Only use more than 1 if ner tags on a KernelPool,
+            a single SequenceTagger can't be used from several threads.
+        max_queued_jobs -- number of jobs that can wait in the queue before submissions are refused
+        job_timeout -- number of seconds a job may take to tag before it's given up on
+        max_finished_jobs -- number of finished jobs to keep around, least recently used are dropped
+        use_lxml -- build TEI documents with lxml instead of BeautifulSoup
+        """
+        self.ner = ner
+        self.worker_count = max(workers, 1)
+        self.max_queued_jobs = max_queued_jobs
+        self.job_timeout = job_timeout
+        self.max_finished_jobs = max_finished_jobs
+        self.use_lxml = use_lxml
+        # Every job by ID, in least to most recently used order
+        self.jobs = OrderedDict()
+        # The latest job of each submission, for finding cached results
+        self.jobs_by_key = dict()
+        self.stats = {'submitted': 0, 'cache_hits': 0, 'rejected': 0, 'done': 0, 'failed': 0,
+                      'timeout': 0}
+        self.queue = None
+        self.executor = None
+        self.worker_tasks = []
+
+    async def start(self):
+        """Start the workers. Must be called on the event loop the service will be used from."""
+        self.queue = asyncio.Queue(self.max_queued_jobs)
+        self.executor = ThreadPoolExecutor(max_workers=self.worker_count)
+        self.worker_tasks = [asyncio.create_task(self.run_worker()) for _ in range(self.worker_count)]
+
+    async def stop(self):
+        """Stop the workers, giving up on any queued or running jobs"""
+        for job in self.jobs.values():
+            job.cancelled = True
+        for task in self.worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self.worker_tasks, return_exceptions=True)
+        self.worker_tasks = []
+        self.executor.shutdown(wait=True)
+
+    @staticmethod
+    def make_key(text, header):
+        """Get the cache key of a submission
+
+        text -- raw text to tag
+        header -- dict of TEI header fields
+        """
+        submission = json.dumps([text, header], sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(submission.encode('utf-8')).hexdigest()
+
+    def submit(self, text, header=None):
+        """Queue a text to be tagged. Returns the job, and whether it was already submitted before
+        (in which case the job may already be done). Raises QueueFullError if the queue is full.
+
+        text -- raw text to tag
+        header -- dict of TEI header fields (see HEADER_FIELDS)
+        """
+        header = {field: value for field, value in (header or dict()).items() if field in HEADER_FIELDS}
+        key = self.make_key(text, header)
+        self.stats['submitted'] += 1
+        job = self.jobs_by_key.get(key)
+        if job != None and job.status not in ['failed', 'timeout']:
+            self.stats['cache_hits'] += 1
+            self.jobs.move_to_end(job.job_id)
+            return job, True
+
+        job = TaggingJob(uuid.uuid4().hex, key, text, header)
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.stats['rejected'] += 1
+            raise QueueFullError(f'{self.queue.qsize()} jobs are already queued')
+        self.jobs[job.job_id] = job
+        self.jobs_by_key[key] = job
+        self.evict()
+        return job, False
+
+    def get_job(self, job_id):
+        """Get a job by ID, or None if there is no such job (any more)"""
+        job = self.jobs.get(job_id)
+        if job != None:
+            self.jobs.move_to_end(job_id)
+        return job
+
+    def evict(self):
+        """Forget the least recently used finished jobs until at most max_finished_jobs are kept"""
+        finished_jobs = sum(1 for job in self.jobs.values() if job.finished)
+        for job in list(self.jobs.values()):
+            if finished_jobs <= self.max_finished_jobs:
+                break
+            if not job.finished:
+                continue
+            del self.jobs[job.job_id]
+            if self.jobs_by_key.get(job.key) is job:
+                del self.jobs_by_key[job.key]
+            finished_jobs -= 1
+
+    async def wait(self, job, timeout=None):
+        """Wait until a job is finished. Returns whether it finished within the timeout.
+
+        job -- job to wait for
+        timeout -- maximum number of seconds to wait, or None to wait as long as it takes
+        """
+        deadline = time.monotonic() + timeout if timeout != None else None
+        while not job.finished:
+            update_event = job.update_event
+            remaining = deadline - time.monotonic() if deadline != None else None
+            if remaining != None and remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(update_event.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    async def run_worker(self):
+        """Take jobs off the queue and tag them one at a time, until cancelled"""
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self.queue.get()
+            try:
+                if job.cancelled:
+                    continue
+                job.set_status('running')
+                future = loop.run_in_executor(self.executor, self.run_job, job, loop)
+                # Not wait_for, which can swallow the cancellation of stop if the job finishes at
+                # the same moment, leaving the worker waiting on the queue forever
+                done, _ = await asyncio.wait([future], timeout=self.job_timeout)
+                if not done:
+                    job.cancelled = True
+                    job.set_status('timeout', error=f'Tagging took longer than {self.job_timeout} seconds')
+                    self.stats['timeout'] += 1
+                    # The thread stops after its current batch; wait for it so we don't start
+                    # another job on a kernel that is still busy
+                    await asyncio.gather(future, return_exceptions=True)
+                elif future.exception() != None:
+                    job.set_status('failed', error=repr(future.exception()))
+                    self.stats['failed'] += 1
+                else:
+                    job.set_status('done', tei=future.result())
+                    self.stats['done'] += 1
+                self.evict()
+            finally:
+                self.queue.task_done()
+
+    def run_job(self, job, loop):
+        """Tag a job's text and build its TEI document. Runs on a worker thread; each paragraph is
+        handed to the event loop as soon as its batch is tagged, so it can be streamed.
+
+        job -- job to run
+        loop -- event loop of the service
+        """
+        text = re.sub('\r', '', job.text)
+        flair_output = []
+        for paragraph in self.ner.tag_paragraphs(re.split(r'\n{2,}', text)):
+            if job.cancelled:
+                return None
+            flair_output.append(paragraph)
+            loop.call_soon_threadsafe(job.add_paragraph, to_json_paragraph(paragraph))
+        tei_header = create_document_header(self.ner, **job.header)
+        tei_body = create_body(flair_output, self.use_lxml)
+        return create_xml(tei_header, tei_body).decode('unicode-escape')
+
+    def get_stats(self):
+        """Get counters of what the service has done so far"""
+        return {
+            **self.stats,
+            'queued': self.queue.qsize() if self.queue != None else 0,
+            'running': sum(1 for job in self.jobs.values() if job.status == 'running'),
+            'cached_jobs': len(self.jobs)
+        }
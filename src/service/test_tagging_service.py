@@ -0,0 +1,137 @@
+import asyncio
+import threading
+from aiohttp.test_utils import TestClient, TestServer
+from src.app import create_app
+from src.ner.backends import FakeTagger
+from src.ner.flair_ner import NamedEntityRecognizer
+from src.service.tagging_service import TaggingService
+
+class BlockingTagger(FakeTagger):
+    """FakeTagger that doesn't tag anything until it's released, so jobs pile up in the queue"""
+    def __init__(self):
+        super().__init__()
+        self.released = threading.Event()
+
+    def find_entities(self, text, entity_types):
+        self.released.wait(10)
+        return super().find_entities(text, entity_types)
+
+def create_ner():
+    return NamedEntityRecognizer(None, ['Person'], 0.5, False, 'test', tagger_backend='fake')
+
+def run_with_client(service, test, **app_options):
+    """Run test(client) against the service's app, on a fresh event loop"""
+    async def run():
+        async with TestClient(TestServer(create_app(service, **app_options))) as client:
+            await test(client)
+    asyncio.run(run())
+
+def test_tag_returns_a_tei_document():
+    ner = create_ner()
+
+    async def test(client):
+        response = await client.post('/tag', json={'text': 'Amelia Edwards sailed.\n\nTo Luxor.',
+                                                   'title': 'A Thousand Miles'})
+        assert response.status == 200
+        tei = await response.text()
+        assert '<title>A Thousand Miles</title>' in tei
+        assert '<persName ref="urn:WolframEntity:Person:' in tei
+        assert tei.count('<p>') == 2
+
+    run_with_client(TaggingService(ner), test)
+
+def test_descriptions_are_tagged_into_the_header():
+    ner = create_ner()
+
+    async def test(client):
+        response = await client.post('/tag', json={'text': 'Nothing here.',
+                                                   'project_description': 'Edited by Lucie Duff',
+                                                   'source_description': 'Printed in London'})
+        assert response.status == 200
+        tei = await response.text()
+        assert 'Lucie Duff</persName>' in tei
+        assert 'London</persName>' in tei
+
+    run_with_client(TaggingService(ner), test)
+
+def test_header_fields_must_be_strings():
+    async def test(client):
+        response = await client.post('/jobs', json={'text': 'Cairo', 'title': ['not', 'a', 'string']})
+        assert response.status == 400
+        response = await client.post('/jobs', json={'title': 'No text'})
+        assert response.status == 400
+
+    run_with_client(TaggingService(create_ner()), test)
+
+def test_same_submission_gives_back_the_same_job():
+    ner = create_ner()
+
+    async def test(client):
+        submission = {'text': 'Amelia Edwards sailed to Philae.', 'title': 'Nile'}
+        first = await (await client.post('/jobs', json=submission)).json()
+        response = await client.post('/jobs', json=submission)
+        assert response.status == 202
+        second = await response.json()
+        assert second['job_id'] == first['job_id'] and second['cached'] and not first['cached']
+        # A different header is a different submission
+        third = await (await client.post('/jobs', json={**submission, 'title': 'Other'})).json()
+        assert third['job_id'] != first['job_id']
+
+        response = await client.get(f"/jobs/{first['job_id']}/tei")
+        while response.status == 202:
+            await asyncio.sleep(0.01)
+            response = await client.get(f"/jobs/{first['job_id']}/tei")
+        assert response.status == 200
+        stats = await (await client.get('/stats')).json()
+        assert stats['service']['cache_hits'] == 1
+        # Each text was tagged once
+        assert ner.tagger.texts.count('Amelia Edwards sailed to Philae.') <= 2
+
+    run_with_client(TaggingService(ner), test)
+
+def test_full_queue_is_refused_with_503():
+    ner = create_ner()
+    ner.tagger = BlockingTagger()
+    service = TaggingService(ner, workers=1, max_queued_jobs=1)
+
+    async def test(client):
+        try:
+            running = await (await client.post('/jobs', json={'text': 'First Text'})).json()
+            # Wait for the worker to take the first job off the queue
+            while (await (await client.get(f"/jobs/{running['job_id']}")).json())['status'] != 'running':
+                await asyncio.sleep(0.01)
+            response = await client.post('/jobs', json={'text': 'Second Text'})
+            assert response.status == 202
+            response = await client.post('/jobs', json={'text': 'Third Text'})
+            assert response.status == 503
+            assert response.headers['Retry-After'] == '7'
+            # Resubmitting a queued text isn't refused, it's the same job
+            response = await client.post('/jobs', json={'text': 'Second Text'})
+            assert response.status == 202 and (await response.json())['cached']
+            assert service.get_stats()['rejected'] == 1
+        finally:
+            ner.tagger.released.set()
+
+    run_with_client(service, test, retry_after=7)
+
+def test_slow_jobs_time_out():
+    ner = create_ner()
+    ner.tagger = BlockingTagger()
+    service = TaggingService(ner, job_timeout=0.1)
+
+    async def test(client):
+        try:
+            job = await (await client.post('/jobs', json={'text': 'Slow Text'})).json()
+            assert await service.wait(service.get_job(job['job_id']), 5)
+            response = await client.get(f"/jobs/{job['job_id']}/tei")
+            assert response.status == 409
+            assert (await response.json())['status'] == 'timeout'
+        finally:
+            ner.tagger.released.set()
+        # The next job runs once the timed out one lets go of the tagger
+        job = await (await client.post('/jobs', json={'text': 'Fast Text'})).json()
+        assert await service.wait(service.get_job(job['job_id']), 5)
+        assert service.get_job(job['job_id']).status == 'done'
+        assert service.get_stats()['timeout'] == 1
+
+    run_with_client(service, test)
@@ -1,10 +1,202 @@
 import re
-from src.tei.assemble_tei import create_header, create_xml, create_body
+from collections import deque
+from lxml import etree
+from src.ner.entity_record import AnnotationWriter, read_annotation_metadata, read_annotations
+from src.tei.assemble_tei import (create_header, create_xml, create_body, create_paragraph_element,
+    to_tei_element, TEI_NAMESPACE)
+from src.utils.job_manifest import hash_file
 
-def create_document(ner, text, **kwargs):
+def create_document(ner, text, use_lxml=False, **kwargs):
     """Turns raw text into a tagged TEI document. Can be given keyword args to add TEI meta tags.
     ner -- NamedEntityRecognizer object that will be used to recognize entities
     text -- raw text to tag
+    use_lxml -- build the TEI body with lxml instead of BeautifulSoup
+    """
+    tei_header = create_document_header(ner, **kwargs)
+
+    # Create body
+    text = text
+    text = re.sub('\r', '', text)
+    #text = re.sub('\n|\t\r|\r\n', ' ', text)
+    #text = re.sub(' +', ' ', text)
+
+    flair_output = ner.tag_entities(text)
+    return render_document(tei_header, flair_output, use_lxml)
+
+def render_document(tei_header, flair_output, use_lxml=False):
+    """Assembles a TEI document out of its header and its tagged paragraphs
+    tei_header -- BeautifulSoup TEI header, see create_document_header
+    flair_output -- list of Flair-like annotated paragraphs
+    use_lxml -- build the TEI body with lxml instead of BeautifulSoup
+    """
+    tei_body = create_body(flair_output, use_lxml)
+    return create_xml(tei_header, tei_body).decode('unicode-escape')
+
+def stream_document(ner, book, output_file, use_lxml=False, **kwargs):
+    """Tags raw text read from a file and writes the TEI document to another file as it goes, so
+    only one batch of paragraphs is ever held in memory. Takes the same keyword args as
+    create_document.
+    ner -- NamedEntityRecognizer object that will be used to recognize entities
+    book -- text file to read raw text from
+    output_file -- binary file or file name to write the TEI document to
+    use_lxml -- build the paragraphs with lxml instead of BeautifulSoup
+    """
+    tei_header = create_document_header(ner, **kwargs)
+    write_tei_document(tei_header, ner.tag_paragraphs(read_paragraphs(book)), output_file, use_lxml)
+
+def write_tei_document(tei_header, paragraphs, output_file, use_lxml=False):
+    """Writes a TEI document to a file one paragraph at a time. The document is the same as the
+    one render_document makes out of the same header and paragraphs.
+    tei_header -- BeautifulSoup TEI header, see create_document_header
+    paragraphs -- iterable of Flair-like annotated paragraphs
+    output_file -- binary file or file name to write the TEI document to
+    use_lxml -- build the paragraphs with lxml instead of BeautifulSoup
+    """
+    if isinstance(output_file, str):
+        with open(output_file, 'wb') as file:
+            write_tei_document(tei_header, paragraphs, file, use_lxml)
+        return
+    tei_header = to_local_element(to_tei_element(tei_header.find('teiHeader')))
+    indent_element(tei_header, 1)
+    # ASCII with character references, like the etree.tostring output of render_document
+    with etree.xmlfile(output_file, encoding='ascii') as xf:
+        # Everything below TEI is written without a namespace of its own, so it's in the default
+        # namespace declared here rather than declaring it again on every element
+        with xf.element(f'{{{TEI_NAMESPACE}}}TEI', nsmap={None: TEI_NAMESPACE}):
+            xf.write('\n  ')
+            xf.write(tei_header)
+            xf.write('\n  ')
+            with xf.element(f'{{{TEI_NAMESPACE}}}text'):
+                xf.write('\n    ')
+                with xf.element(f'{{{TEI_NAMESPACE}}}body'):
+                    xf.write('\n      ')
+                    with xf.element(f'{{{TEI_NAMESPACE}}}div'):
+                        for paragraph in paragraphs:
+                            paragraph_element = to_local_element(create_paragraph_element(paragraph, use_lxml))
+                            indent_element(paragraph_element, 4)
+                            xf.write('\n        ')
+                            xf.write(paragraph_element)
+                        xf.write('\n      ')
+                    xf.write('\n    ')
+                xf.write('\n  ')
+            xf.write('\n')
+    output_file.write(b'\n')
+
+def to_local_element(element):
+    """Takes an lxml element and its descendants out of their namespace, so the element can be
+    written into a document that declares it as the default namespace
+    """
+    for descendant in element.iter(tag=etree.Element):
+        descendant.tag = etree.QName(descendant).localname
+    etree.cleanup_namespaces(element)
+    return element
+
+def indent_element(element, level):
+    """Puts the whitespace etree.tostring(pretty_print=True) would put inside an element at the
+    given depth of a document, so the element can be written on its own and look the same. Like
+    libxml2, elements with text of their own (mixed content, even an empty text node) aren't
+    indented inside.
+    """
+    if len(element) == 0 or element.text != None or any(child.tail != None for child in element):
+        return
+    element.text = '\n' + '  ' * (level + 1)
+    for child in element:
+        indent_element(child, level + 1)
+        child.tail = '\n' + '  ' * (level + 1)
+    element[-1].tail = '\n' + '  ' * level
+
+def annotate_document(ner, book, annotation_file, input_hash=None, **kwargs):
+    """Tags raw text read from a file and writes its entities to a standoff annotation file, so
+    the TEI document can be rendered later (see render_annotated_file) without tagging it again.
+    Takes the same keyword args as create_document, except for the project and source
+    descriptions (which would have to be tagged too); they're recorded as the default TEI header.
+    ner -- NamedEntityRecognizer object that will be used to recognize entities
+    book -- text file to read raw text from
+    annotation_file -- binary file to write the annotations to
+    input_hash -- hash of the text file (see hash_file), checked before rendering
+    """
+    for description in ['project_description', 'source_description']:
+        if kwargs.get(description, '') != '':
+            raise ValueError(f'Annotation files can\'t hold a {description.replace("_", " ")}, '
+                             'use create_document or stream_document for documents with one')
+    writer = AnnotationWriter(annotation_file, {'input_hash': input_hash, 'header': kwargs})
+    # Offsets of the paragraphs handed to the tagger but not tagged yet
+    offsets = deque()
+
+    def paragraphs():
+        for offset, paragraph in read_paragraph_spans(book):
+            offsets.append(offset)
+            yield paragraph
+
+    for paragraph in ner.tag_paragraphs(paragraphs()):
+        writer.write_paragraph(paragraph, offsets.popleft())
+
+def render_annotated_file(text_path, annotation_path, output_path, use_lxml=False, stream=False,
+                          **kwargs):
+    """Renders the TEI document of a text file out of its annotation file, without a kernel.
+    Keyword args override the TEI header fields recorded by annotate_document.
+    text_path -- text file the annotations were made from
+    annotation_path -- annotation file written by annotate_document
+    output_path -- file to write the TEI document to
+    use_lxml -- build the TEI body with lxml instead of BeautifulSoup
+    stream -- write the document one paragraph at a time, like stream_document
+    """
+    with open(annotation_path, 'rb') as annotation_file:
+        metadata = read_annotation_metadata(annotation_file) or dict()
+    input_hash = metadata.get('input_hash')
+    if input_hash != None and input_hash != hash_file(text_path):
+        raise ValueError(f'{text_path} changed since it was tagged, it needs to be tagged again')
+    with open(text_path, 'r') as book:
+        text = re.sub('\r', '', book.read())
+    tei_header = create_document_header(None, **{**metadata.get('header', dict()), **kwargs})
+
+    with open(annotation_path, 'rb') as annotation_file:
+        paragraphs = read_annotations(annotation_file, text)
+        if stream:
+            with open(output_path, 'wb') as output_file:
+                write_tei_document(tei_header, paragraphs, output_file, use_lxml)
+            return
+        tei_document = render_document(tei_header, list(paragraphs), use_lxml)
+    with open(output_path, 'w') as output_file:
+        output_file.write(tei_document)
+
+def read_paragraphs(book, chunk_size=64 * 1024):
+    """Reads paragraphs from a text file one at a time. Paragraphs are split the same way as
+    NamedEntityRecognizer.tag_entities splits them (on runs of 2 or more newlines).
+    book -- text file to read raw text from
+    chunk_size -- number of characters to read from the file at a time
+    """
+    for offset, paragraph in read_paragraph_spans(book, chunk_size):
+        yield paragraph
+
+def read_paragraph_spans(book, chunk_size=64 * 1024):
+    """Reads paragraphs from a text file one at a time, like read_paragraphs, yielding each one
+    with its offset in the text (after carriage returns are removed)
+    book -- text file to read raw text from
+    chunk_size -- number of characters to read from the file at a time
+    """
+    buffer = ''
+    # Offset of the start of buffer in the text
+    buffer_offset = 0
+    while True:
+        chunk = book.read(chunk_size)
+        buffer += re.sub('\r', '', chunk)
+        start = 0
+        for separator in re.finditer(r'\n{2,}', buffer):
+            if chunk and separator.end() == len(buffer):
+                break # The run of newlines might continue into the next chunk
+            yield buffer_offset + start, buffer[start:separator.start()]
+            start = separator.end()
+        buffer = buffer[start:]
+        buffer_offset += start
+        if not chunk:
+            yield buffer_offset, buffer
+            return
+
+def create_document_header(ner, **kwargs):
+    """Creates the TEI header of a document out of create_document's keyword args
+    ner -- NamedEntityRecognizer object that will be used to recognize entities in descriptions,
+        or None to render a header without a kernel (which can't have descriptions)
     """
     title = kwargs.get('title', '')
     author = kwargs.get('author', '')
@@ -16,6 +208,9 @@ def create_document(ner, text, **kwargs):
     project_description = kwargs.get('project_description', '')
     source_description = kwargs.get('source_description', '')
 
+    if ner == None and (project_description != '' or source_description != ''):
+        raise ValueError('Project and source descriptions need a NamedEntityRecognizer to tag them')
+
     project_description = re.sub('\n|\t\r|\r\n', ' ', project_description)
     project_description = re.sub(' +', ' ', project_description)
     if project_description != '':
@@ -26,19 +221,5 @@ def create_document(ner, text, **kwargs):
     if source_description != '':
         source_description = ner.tag_entities(source_description
                                           )
-    # Create header
-    tei_header = create_header(title, author, editor, publisher, publisher_address,
-                               publication_date, license_desc, project_description, source_description)
-
-    # Create body
-    text = text
-    text = re.sub('\r', '', text)
-    #text = re.sub('\n|\t\r|\r\n', ' ', text)
-    #text = re.sub(' +', ' ', text)
-
-    flair_output = ner.tag_entities(text)
-    tei_body = create_body(flair_output)
-
-    # Assemble document
-    tei_document = create_xml(tei_header, tei_body).decode('unicode-escape')
-    return tei_document
\ No newline at end of file
+    return create_header(title, author, editor, publisher, publisher_address,
+                         publication_date, license_desc, project_description, source_description)
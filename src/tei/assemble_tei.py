@@ -1,9 +1,12 @@
 import re
 from bs4 import BeautifulSoup
 from lxml import etree
+from src.ner.entity_record import KIND_QUANTITY, KIND_DATE, KIND_GEO
 from src.utils.license_utils import license_dict
+from src.utils.metrics import metrics, describe_text
 from src.utils.ref_utils import create_initials_ref, create_name_ref, create_ref
 
+TEI_NAMESPACE = 'http://www.tei-c.org/ns/1.0'
 
 # tag_dict = {'PER': 'persName',
 #             'LOC': 'placeName',
@@ -25,11 +28,23 @@ tag_dict = {
     'HistoricalSite': 'placeName',
 }
 
+# Entity texts that are never tagged. Mathematica thinks instances of "today" refers to runtime
+ignored_entity_texts = ["I’ve", "I’ll", "I", "I’m", "I've", "I'll", "I'm", "I,", "Today", "today"]
+
+def date_when(date_tuple):
+    '''Get the when attribute of a date tag, e.g. "1873-11-29", "1873-11" or "1873"
+
+    date_tuple: tuple of 1 to 3 date part strings (year, month, day), the payload of a date entity
+    '''
+    if len(date_tuple) > 3:
+        return ''
+    return '-'.join(f'{part}' for part in date_tuple)
+
 def create_markup_with_entities(annotated_text, paragraph_tag, soup):
     '''Given some source text and Flair-like annotated text, create TEI markup with
     the entities wrapped in the appropriate tag names. Then put them in the given paragraph tag.
     
-    annotated_text: text that we've run through a Flair-like tagger
+    annotated_text: text that we've run through a Flair-like tagger, with EntityRecord entities
     paragraph_tag: the paragraph to add text and entity tags to
     soup: BeautifulSoup object of the paragraph_tag
     '''
@@ -37,49 +52,33 @@ def create_markup_with_entities(annotated_text, paragraph_tag, soup):
     entities = annotated_text['entities']
     index = 0
     for entity in entities:
-        entity_type = entity["type"]
-        entity_text = entity["text"]
-        entity_ref = entity["ref"]
-        tagname = tag_dict.get(entity['type'], "name")
-        if entity_text not in ["I’ve", "I’ll", "I", "I’m", "I've", "I'll", "I'm", "I,", "Today", "today"]: # Mathematica thinks instances of "today" refers to runtime
-            paragraph_tag.append(text[index:entity['start_pos']])
-            if ('interpretation' in entity and 
-                    type(entity['interpretation']) is not str and
-                    entity['interpretation'].head.name in ['Quantity', 'DateObject', 'GeoPosition']):
-                interpretation_type = entity['interpretation'].head.name
-                if interpretation_type == 'Quantity':
-                    quantity = entity['interpretation'].args[0]
-                    unit = entity['interpretation'].args[1]
+        entity_type = entity.type
+        entity_text = entity.text
+        entity_ref = entity.ref
+        tagname = tag_dict.get(entity_type, "name")
+        if entity_text not in ignored_entity_texts:
+            paragraph_tag.append(text[index:entity.start_pos])
+            if entity.kind in [KIND_QUANTITY, KIND_DATE, KIND_GEO]:
+                if entity.kind == KIND_QUANTITY:
+                    quantity, unit = entity.payload
 
                     quantity_tag = soup.new_tag(tagname, type=entity_type, quantity=quantity, unit=unit)
                     quantity_tag.string = entity_text
 
                     paragraph_tag.append(quantity_tag)
-                elif interpretation_type == 'DateObject':
-                    date_tuple = entity['interpretation'].args[0]
-                    when = ""
-                    if len(date_tuple) == 3:
-                        year, month, day = date_tuple
-                        when = f'{year}-{month}-{day}'
-                    elif len(date_tuple) == 2:
-                        year, month = date_tuple
-                        when = f'{year}-{month}'
-                    elif len(date_tuple) == 1:
-                        year = date_tuple[0]
-                        when = f'{year}'
-
-                    dateobject_tag = soup.new_tag(tagname, type=entity_type, when=when)
+                elif entity.kind == KIND_DATE:
+                    dateobject_tag = soup.new_tag(tagname, type=entity_type, when=date_when(entity.payload))
                     dateobject_tag.string = entity_text
 
                     paragraph_tag.append(dateobject_tag)
-                elif interpretation_type == 'GeoPosition':
+                elif entity.kind == KIND_GEO:
                     """ RESULTING XML LOOKS LIKE:
                     <place>
                        <placeName>{entity_text}</placeName>
                        <location><geo decls="#ITRF00">{latitude}, {longitude}</geo></location>
                     </place>
                     """
-                    latitude, longitude = entity['interpretation'].args[0]
+                    latitude, longitude = entity.payload
                     place_tag = soup.new_tag("place")
                     
                     placename_tag = soup.new_tag("placeName")
@@ -100,9 +99,72 @@ def create_markup_with_entities(annotated_text, paragraph_tag, soup):
                     entity_tag = soup.new_tag(tagname, type=entity_type)
                     entity_tag.string = entity_text
                     paragraph_tag.append(entity_tag)
-            index = entity['end_pos']
+            index = entity.end_pos
     paragraph_tag.append(text[index:])
 
+def tei_tag(tag_name):
+    """Gets the lxml name of a tag in the TEI namespace"""
+    return f'{{{TEI_NAMESPACE}}}{tag_name}'
+
+
+def append_text(element, text):
+    """Appends text to the end of an lxml element's content, after any child elements"""
+    if text == '':
+        return # Setting text to '' would write an empty paragraph as <p></p> instead of <p/>
+    if len(element) > 0:
+        element[-1].tail = (element[-1].tail or '') + text
+    else:
+        element.text = (element.text or '') + text
+
+
+def append_entity_element(paragraph_element, tag_name, entity_text, **attributes):
+    """Appends an entity tag to an lxml paragraph element. Attributes are added in alphabetical
+    order, the same order BeautifulSoup writes them in, so both builders give the same output.
+    """
+    entity_element = etree.SubElement(paragraph_element, tei_tag(tag_name))
+    for name, value in sorted(attributes.items()):
+        entity_element.set(name, str(value))
+    entity_element.text = entity_text
+    return entity_element
+
+
+def create_markup_with_entities_lxml(annotated_text, paragraph_element):
+    '''Same as create_markup_with_entities, but builds the paragraph with lxml directly instead
+    of with BeautifulSoup.
+
+    annotated_text: text that we've run through a Flair-like tagger, with EntityRecord entities
+    paragraph_element: the lxml paragraph element to add text and entity tags to
+    '''
+    text = annotated_text['text']
+    entities = annotated_text['entities']
+    index = 0
+    for entity in entities:
+        entity_type = entity.type
+        entity_text = entity.text
+        entity_ref = entity.ref
+        tagname = tag_dict.get(entity_type, "name")
+        if entity_text not in ignored_entity_texts:
+            append_text(paragraph_element, text[index:entity.start_pos])
+            if entity.kind in [KIND_QUANTITY, KIND_DATE, KIND_GEO]:
+                if entity.kind == KIND_QUANTITY:
+                    quantity, unit = entity.payload
+                    append_entity_element(paragraph_element, tagname, entity_text,
+                                          type=entity_type, quantity=quantity, unit=unit)
+                elif entity.kind == KIND_DATE:
+                    append_entity_element(paragraph_element, tagname, entity_text,
+                                          type=entity_type, when=date_when(entity.payload))
+                elif entity.kind == KIND_GEO:
+                    # create_markup_with_entities never fills in the place tag, so neither do we
+                    etree.SubElement(paragraph_element, tei_tag('place'))
+            else:
+                if entity_ref != None:
+                    append_entity_element(paragraph_element, tagname, entity_text,
+                                          type=entity_type, ref=entity_ref)
+                else:
+                    append_entity_element(paragraph_element, tagname, entity_text, type=entity_type)
+            index = entity.end_pos
+    append_text(paragraph_element, text[index:])
+
 def create_header(title='', author='', editor='', publisher='', publisher_address='',
                   publication_date='', license_desc='', project_description='', source_description=''):
     soup = BeautifulSoup()
@@ -143,37 +205,117 @@ def create_header(title='', author='', editor='', publisher='', publisher_addres
     if source_description != '':
         soup.fileDesc.append(soup.new_tag('sourceDesc'))
         soup.sourceDesc.append(soup.new_tag('p'))
-        markup = create_markup_with_entities(source_description)
-        markup = markup[0:-1]
-        soup.sourceDesc.p.string = markup
+        append_description(soup.sourceDesc.p, source_description, soup)
     if project_description != '':
         soup.fileDesc.append(soup.new_tag('encodingStmt'))
         soup.encodingStmt.append(soup.new_tag('projectDesc'))
         soup.projectDesc.append(soup.new_tag('p'))
-        markup = create_markup_with_entities(project_description)
-        markup = markup[0:-1]
-        soup.projectDesc.p.string = markup
+        append_description(soup.projectDesc.p, project_description, soup)
     return soup
 
+def append_description(paragraph_tag, description, soup):
+    '''Put a project or source description in a paragraph of the TEI header
+
+    paragraph_tag: the paragraph to add the description to
+    description: plain text, or the Flair-like annotated paragraphs of the description (see
+        NamedEntityRecognizer.tag_entities)
+    soup: BeautifulSoup object of the paragraph_tag
+    '''
+    if isinstance(description, str):
+        paragraph_tag.string = description
+        return
+    for index, paragraph in enumerate(description):
+        if index > 0:
+            paragraph_tag.append(' ')
+        create_markup_with_entities(paragraph, paragraph_tag, soup)
+
 
-def create_body(flair_output):
+def create_body(flair_output, use_lxml=False):
+    with metrics.time('create_body_seconds', builder='lxml' if use_lxml else 'bs4'):
+        if use_lxml:
+            return create_body_lxml(flair_output)
+        return create_body_bs4(flair_output)
+
+
+def create_body_bs4(flair_output):
     soup = BeautifulSoup()
     soup.append(soup.new_tag('text'))
     soup.find('text').append(soup.new_tag('body'))
     soup.body.append(soup.new_tag('div'))
     for paragraph in flair_output:
         paragraph_tag = soup.new_tag('p')
-        markup = create_markup_with_entities(paragraph, paragraph_tag, soup)
+        with metrics.time('paragraph_markup_seconds', context=describe_text(paragraph['text']), builder='bs4'):
+            markup = create_markup_with_entities(paragraph, paragraph_tag, soup)
         soup.div.append(paragraph_tag)
     return soup
 
 
-def create_xml(header, body):
+def create_body_lxml(flair_output):
+    """Creates the TEI text element with lxml instead of BeautifulSoup. create_xml accepts it in
+    place of the BeautifulSoup body and skips reparsing the whole document.
+
+    flair_output: list of Flair-like annotated paragraphs
+    """
+    text_element = etree.Element(tei_tag('text'))
+    div_element = etree.SubElement(etree.SubElement(text_element, tei_tag('body')), tei_tag('div'))
+    for paragraph in flair_output:
+        with metrics.time('paragraph_markup_seconds', context=describe_text(paragraph['text']), builder='lxml'):
+            create_markup_with_entities_lxml(paragraph, etree.SubElement(div_element, tei_tag('p')))
+    return text_element
+
+
+def create_paragraph_element(annotated_text, use_lxml=False):
+    """Creates a TEI paragraph element out of a single paragraph of Flair-like annotated text.
+
+    annotated_text: text that we've run through a Flair-like tagger
+    use_lxml: build the paragraph with lxml directly instead of with BeautifulSoup
+    """
+    if use_lxml:
+        paragraph_element = etree.Element(tei_tag('p'), nsmap={None: TEI_NAMESPACE})
+        create_markup_with_entities_lxml(annotated_text, paragraph_element)
+        return paragraph_element
     soup = BeautifulSoup()
-    soup.append(soup.new_tag('TEI', xmlns="http://www.tei-c.org/ns/1.0"))
-    soup.TEI.append(header)
-    soup.TEI.append(body)
-    root = etree.fromstring(str(soup))
+    paragraph_tag = soup.new_tag('p')
+    create_markup_with_entities(annotated_text, paragraph_tag, soup)
+    return to_tei_element(paragraph_tag)
+
+
+def to_tei_element(tag):
+    """Converts a BeautifulSoup tag into an lxml element in the TEI namespace, so it can be written
+    into a TEI document on its own.
+
+    tag: BeautifulSoup tag to convert
+    """
+    tag['xmlns'] = TEI_NAMESPACE
+    return etree.fromstring(str(tag))
+
+
+def create_xml(header, body):
+    if isinstance(body, etree._Element):
+        with metrics.time('create_xml_seconds', builder='lxml'):
+            return create_xml_lxml(header, body)
+    with metrics.time('create_xml_seconds', builder='bs4'):
+        soup = BeautifulSoup()
+        soup.append(soup.new_tag('TEI', xmlns=TEI_NAMESPACE))
+        soup.TEI.append(header)
+        soup.TEI.append(body)
+        with metrics.time('xml_reparse_seconds'):
+            root = etree.fromstring(str(soup))
+        xml_str = etree.tostring(root, pretty_print=True).decode()
+
+    return xml_str.encode('utf-8')
+
+
+def create_xml_lxml(header, body):
+    """Assembles the TEI document out of a BeautifulSoup header and a body made by
+    create_body_lxml. Only the (small) header gets reparsed.
+    """
+    root = etree.Element(tei_tag('TEI'), nsmap={None: TEI_NAMESPACE})
+    header_element = etree.fromstring(str(header))
+    for element in header_element.iter():
+        element.tag = tei_tag(element.tag)
+    root.append(header_element)
+    root.append(body)
     xml_str = etree.tostring(root, pretty_print=True).decode()
 
     return xml_str.encode('utf-8')
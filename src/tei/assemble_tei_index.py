@@ -1,11 +1,16 @@
 from bs4 import BeautifulSoup, Comment
 from wolframclient.language import wl, wlexpr
+import os
+import time
+import urllib.error
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import wikidata.client
-import copy
-
-template_file = open('tei_index_templates/siteindex.tei', 'r')
-template = template_file.read()
-template_file.close()
+from wikidata.cache import MemoryCachePolicy
+from src.tei.template_registry import TemplateRegistry
+from src.utils.metrics import metrics
+from src.wiki.entity_store import OfflineOpener
+from src.wiki.prefetch import WikidataPrefetcher
 
 wiki_pids = {
     'birth': 'P569',
@@ -21,13 +26,95 @@ wiki_pids = {
     'inception': 'P571'
 }
 
+# Properties whose values are entities that we read labels or properties of, and so prefetch
+linked_entity_props = ['birthplace', 'deathplace', 'occupation', 'country', 'sex']
+
+# Number of interpretations sent to the kernel in one WikidataData evaluation
+WIKIDATA_ID_BATCH_SIZE = 200
+
+# Number of Wikidata entities kept in memory while building an index
+WIKIDATA_MEMORY_CACHE_SIZE = 100000
+
+# Name of the list in siteindex.tei that holds the entries of each entity type. Each list has the
+# entity type as its type attribute.
+entry_containers = {
+    'Person': 'listPerson',
+    'Museum': 'listPlace',
+    'HistoricalSite': 'listPlace',
+    'Building': 'listPlace',
+    'City': 'listPlace',
+    'Country': 'listPlace',
+    'River': 'listPlace',
+    'Artwork': 'list',
+    'Company': 'listOrg',
+    'Ship': 'listObject'
+}
+
+# Number of entries rendered by a worker process in one go, see IndexAssembler.write_index
+INDEX_CHUNK_SIZE = 1000
+
+# IndexAssembler of an index rendering worker process, created by init_index_worker
+worker_assembler = None
+
+def init_index_worker(template_dir, wikidata_base_url, offline):
+    """Create the IndexAssembler of an index rendering worker process. It reads Wikidata entities
+    from the entity data each chunk comes with, and only fetches what's missing unless offline.
+    """
+    global worker_assembler
+    worker_assembler = IndexAssembler(None, TemplateRegistry(template_dir), wikidata_base_url)
+    if offline:
+        worker_assembler.wikiclient.opener = OfflineOpener()
+
+def render_index_chunk(entities, entity_data, ref_type, indent_level):
+    """Render the entries of a chunk of entities in an index rendering worker process. Returns
+    the prettified text of each entry, the URNs of the entities that couldn't be rendered, and the
+    metrics of the worker.
+
+    entities -- list of (Mathematica URN, xml:id, WolframEntity, Wikidata QID) of the same type
+    entity_data -- {QID: Wikidata entity JSON} of the entities and everything they link to
+    ref_type -- What kind of values we should put in ref attributes of entities
+    indent_level -- indent level of the entries in the prettified index
+    """
+    metrics.reset()
+    worker_assembler.seed_entities(entity_data)
+    worker_assembler.failed_urns = set()
+    entries = [remove_comments(entry).decode(indent_level=indent_level)
+               for _, entry in worker_assembler.render_entries(entities, ref_type)]
+    return entries, worker_assembler.failed_urns, metrics.snapshot()
+
+def remove_comments(tag):
+    """Remove every comment from a tag, returning the tag"""
+    for element in tag(text=lambda text: isinstance(text, Comment)):
+        element.extract()
+    return tag
+
 class IndexAssembler:
-    def __init__(self, wl_session):
+    def __init__(self, wl_session, templates=None, wikidata_base_url=wikidata.client.WIKIDATA_BASE_URL,
+            wikidata_workers=4, entity_store=None, tagger_cache=None):
         """Initialize the IndexAssembler
         wl_session -- an active Wolfram kernel session
+        templates -- TemplateRegistry to get TEI index templates from (defaults to the templates in
+            tei_index_templates)
+        wikidata_base_url -- base URL of the Wikidata site to get entities from
+        wikidata_workers -- maximum number of concurrent requests when prefetching Wikidata entities
+        entity_store -- EntityStore to read Wikidata entities through, or None to keep them in memory
+        tagger_cache -- TaggerCache to persist Wikidata IDs of Wolfram entities in. If every entity's
+            ID is cached, wl_session isn't used and can be None.
         """
         self.session = wl_session
-        self.wikiclient = wikidata.client.Client()
+        self.tagger_cache = tagger_cache
+        self.entity_store = entity_store
+        if entity_store != None:
+            self.wikiclient = wikidata.client.Client(wikidata_base_url, entity_store.make_opener(),
+                cache_policy=entity_store)
+        else:
+            self.wikiclient = wikidata.client.Client(wikidata_base_url,
+                cache_policy=MemoryCachePolicy(WIKIDATA_MEMORY_CACHE_SIZE))
+        self.prefetcher = WikidataPrefetcher(self.wikiclient, wikidata_workers)
+        self.templates = templates if templates != None else TemplateRegistry()
+        # URNs of the entities the last create_index or update_index call couldn't render because
+        # looking them up failed. They can be retried later.
+        self.failed_urns = set()
 
     def create_index(self, seen_entities, title, author, sponsor, authority, licence, ref_type):
         """Generate a TEI index out of the seen_entities of a NamedEntityRecognizer
@@ -40,45 +127,236 @@ class IndexAssembler:
         license -- TEI index license
         ref_type -- What kind of values we should put in ref attributes of entities (can be "Wikidata QID" or "WolframEntity URN")
         """
-        soup = BeautifulSoup(template, 'xml')
+        soup = self.create_index_soup(title, author, sponsor, authority, licence)
+        self.add_entries(soup, seen_entities, ref_type)
+        # Remove comments from final index
+        remove_comments(soup)
+        return str(soup.prettify())
+
+    def create_index_soup(self, title, author, sponsor, authority, licence):
+        """Get a BeautifulSoup of an empty TEI index with its header filled in"""
+        soup = BeautifulSoup(self.templates.get_text('siteindex.tei'), 'xml')
         soup.find('title').append(title)
         soup.find('author').append(author)
         soup.find('sponsor').append(sponsor)
         soup.find('authority').append(authority)
         soup.find('licence').append(licence)
+        return soup
 
+    def update_index(self, index_text, seen_entities, ref_type):
+        """Add entries for new entities to an existing TEI index. Entities whose xml:id is already
+        in the index are left alone, so only new entities are looked up and rendered.
+
+        index_text -- text of the existing TEI index
+        seen_entities -- entities to add to the index, in the same format as in create_index
+        ref_type -- What kind of values we should put in ref attributes of entities (can be "Wikidata QID" or "WolframEntity URN")
+        """
+        soup = BeautifulSoup(index_text, 'xml')
+        existing_ids = {tag['xml:id'] for tag in soup.find_all(attrs={'xml:id': True})}
+        new_entities = {mathematica_urn: entity_data for mathematica_urn, entity_data in seen_entities.items()
+                        if entity_data[0] not in existing_ids}
+        self.add_entries(soup, new_entities, ref_type)
+        # Remove comments from the new entries, like create_index does
+        remove_comments(soup)
+        return str(soup.prettify())
+
+    def add_entries(self, soup, seen_entities, ref_type):
+        """Look up the seen entities on Wikidata and add an entry for each of them to the index
+
+        soup -- BeautifulSoup of the TEI index
+        seen_entities -- list of entities seen by the TEI tagger
+        ref_type -- What kind of values we should put in ref attributes of entities (can be "Wikidata QID" or "WolframEntity URN")
+        """
+        # Looks like {entity type: list tag of the type}, so each list is only searched for once
+        containers = dict()
+        for entity_type, entry in self.render_entries(self.prepare_entries(seen_entities), ref_type):
+            if entity_type not in containers:
+                containers[entity_type] = soup.find(entry_containers[entity_type], attrs={'type': entity_type})
+            containers[entity_type].append(entry)
+
+    def prepare_entries(self, seen_entities):
+        """Get the Wikidata IDs of the seen entities, and prefetch their Wikidata entities and
+        everything those link to. Returns (Mathematica URN, xml:id, WolframEntity, Wikidata QID) of
+        every entity that has a Wikidata ID. Entities whose Wikidata ID couldn't be looked up go in
+        failed_urns.
+
+        seen_entities -- list of entities seen by the TEI tagger
+        """
+        wikidata_ids, failures = self.resolve_wikidata_ids(seen_entities)
+        self.failed_urns = set(failures)
+        for mathematica_urn, reason in failures.items():
+            print(f"Couldn't get the Wikidata ID of {mathematica_urn}: {reason}")
+        entities = []
         for mathematica_urn, entity_data in seen_entities.items():
             xml_id, interpretation = entity_data
-            try:
-                wikidata_id = self.session.evaluate(wl.WikidataData(interpretation, 'WikidataID'))[0][1]
-            except IndexError: # If the Wolfram Entity lacks a WikiData ID, skip it
+            if wikidata_ids.get(mathematica_urn) == None: # If the Wolfram Entity lacks a WikiData ID, skip it
                 continue
-            wikientity = self.wikiclient.get(wikidata_id, load=True)
-            entity_type = interpretation[0]
+            entities.append((mathematica_urn, xml_id, interpretation, wikidata_ids[mathematica_urn]))
+
+        # Fetch all the entities, then everything they link to, in batches before rendering
+        if self.entity_store == None or not self.entity_store.offline:
+            with metrics.time('wikidata_prefetch_seconds'):
+                self.prefetcher.prefetch_with_links([entity[3] for entity in entities],
+                                                    [wiki_pids[prop] for prop in linked_entity_props])
+        return entities
+
+    def render_entries(self, entities, ref_type):
+        """Render the index entry of each entity, yielding (entity type, entry tag). Entities of
+        types the index has no list for are skipped, and entities whose Wikidata entity can't be
+        loaded go in failed_urns.
+
+        entities -- list of (Mathematica URN, xml:id, WolframEntity, Wikidata QID), see prepare_entries
+        ref_type -- What kind of values we should put in ref attributes of entities (can be "Wikidata QID" or "WolframEntity URN")
+        """
+        for mathematica_urn, xml_id, interpretation, wikidata_id in entities:
+            entity_type = interpretation.type
             if ref_type == "Wikidata QID":
                 ref = 'https://www.wikidata.org/wiki/' + wikidata_id
             else:
                 ref = mathematica_urn
 
-            if entity_type in ['Museum', 'HistoricalSite', 'Building', 'City', 'Country', 'River']:
-                place = self.get_place_tag(ref, xml_id, wikientity)
-                soup.find('listPlace', attrs={'type': entity_type}).append(place)
-            elif entity_type == 'Person':
-                person = self.get_person_tag(ref, xml_id, wikientity)
-                soup.find('listPerson', attrs={'type': 'Person'}).append(person)
-            elif entity_type == 'Artwork':
-                figure = self.get_art_figure_tag(ref, xml_id, wikientity)
-                soup.find('list', attrs={'type': 'Artwork'}).append(figure)
-            elif entity_type == 'Company':
-                org = self.get_company_org_tag(ref, xml_id, wikientity)
-                soup.find('listOrg', attrs={'type': 'Company'}).append(org)
-            elif entity_type == 'Ship':
-                ship = self.get_ship_object_tag(ref, xml_id, wikientity)
-                soup.find('listObject', attrs={'type': 'Ship'}).append(ship)
-        # Remove comments from final index
-        for element in soup(text=lambda text: isinstance(text, Comment)):
-            element.extract()
-        return str(soup.prettify())
+            entry_start = time.perf_counter()
+            entry = None
+            try:
+                wikientity = self.wikiclient.get(wikidata_id, load=True)
+                if entity_type in ['Museum', 'HistoricalSite', 'Building', 'City', 'Country', 'River']:
+                    entry = self.get_place_tag(ref, xml_id, wikientity)
+                elif entity_type == 'Person':
+                    entry = self.get_person_tag(ref, xml_id, wikientity)
+                elif entity_type == 'Artwork':
+                    entry = self.get_art_figure_tag(ref, xml_id, wikientity)
+                elif entity_type == 'Company':
+                    entry = self.get_company_org_tag(ref, xml_id, wikientity)
+                elif entity_type == 'Ship':
+                    entry = self.get_ship_object_tag(ref, xml_id, wikientity)
+            except urllib.error.URLError as error: # e.g. in offline mode, when the entity isn't stored
+                print(f"Skipping {wikidata_id}: {error.reason}")
+                self.failed_urns.add(mathematica_urn)
+            metrics.observe('index_entry_seconds', time.perf_counter() - entry_start,
+                            context=mathematica_urn, entity_type=entity_type)
+            if entry != None:
+                yield entity_type, entry
+
+    def write_index(self, output_file, seen_entities, title, author, sponsor, authority, licence,
+                    ref_type, workers=4, shard_dir=None, chunk_size=INDEX_CHUNK_SIZE):
+        """Generate the same TEI index as create_index, rendering the entries of each list (and
+        chunks of long lists) in a pool of worker processes, and write it to a file as the lists
+        are done instead of building the whole index in memory. Wikidata IDs are looked up and
+        entities prefetched here first; the workers only render.
+
+        output_file -- text file to write the index to
+        seen_entities, title, author, sponsor, authority, licence, ref_type -- see create_index
+        workers -- number of worker processes
+        shard_dir -- directory to also write each list to, as LIST-TYPE.tei (e.g.
+            listPerson-Person.tei), or None
+        chunk_size -- maximum number of entries a worker renders in one go
+        """
+        entities = self.prepare_entries(seen_entities)
+        # Looks like {entity type: [entity]}, in the order types are first seen
+        groups = OrderedDict()
+        for entity in entities:
+            if entity[2].type in entry_containers:
+                groups.setdefault(entity[2].type, []).append(entity)
+
+        # Prettify the index with a marker where the entries of each list go, to find their indent
+        soup = self.create_index_soup(title, author, sponsor, authority, licence)
+        markers = dict()
+        for entity_type in groups:
+            markers[f'@@lestrade-index-entries:{entity_type}@@'] = entity_type
+            soup.find(entry_containers[entity_type], attrs={'type': entity_type}).append(
+                f'@@lestrade-index-entries:{entity_type}@@')
+        remove_comments(soup)
+        lines = str(soup.prettify()).splitlines(keepends=True)
+        indent_levels = {markers[line.strip()]: len(line) - len(line.lstrip(' '))
+                         for line in lines if line.strip() in markers}
+
+        offline = self.entity_store != None and self.entity_store.offline
+        linked_pids = [wiki_pids[prop] for prop in linked_entity_props]
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_index_worker,
+                                 initargs=(self.templates.template_dir, self.wikiclient.base_url, offline)) as executor:
+            # Looks like {entity type: [future of each chunk, in order]}
+            futures = dict()
+            for entity_type, group in groups.items():
+                futures[entity_type] = []
+                for start in range(0, len(group), chunk_size):
+                    chunk = group[start:start + chunk_size]
+                    qids = {entity[3] for entity in chunk}
+                    qids |= self.prefetcher.linked_qids(qids, linked_pids)
+                    entity_data = {qid: self.prefetcher.get_cached(qid) for qid in qids}
+                    futures[entity_type].append(executor.submit(
+                        render_index_chunk, chunk, {qid: data for qid, data in entity_data.items() if data != None},
+                        ref_type, indent_levels[entity_type]))
+
+            for line in lines:
+                entity_type = markers.get(line.strip())
+                if entity_type == None:
+                    output_file.write(line)
+                    continue
+                shard_file = None
+                if shard_dir != None:
+                    container = entry_containers[entity_type]
+                    shard_file = open(os.path.join(shard_dir, f'{container}-{entity_type}.tei'), 'w')
+                    shard_file.write(f'<{container} type="{entity_type}">\n')
+                for future in futures[entity_type]:
+                    entries, failed_urns, snapshot = future.result()
+                    self.failed_urns |= failed_urns
+                    metrics.merge(snapshot)
+                    for entry in entries:
+                        output_file.write(entry)
+                        if shard_file != None:
+                            shard_file.write(entry)
+                if shard_file != None:
+                    shard_file.write(f'</{container}>\n')
+                    shard_file.close()
+
+    def seed_entities(self, entity_data):
+        """Put Wikidata entity JSON in the Wikidata client's cache, e.g. entities prefetched in
+        another process
+
+        entity_data -- {QID: Wikidata entity JSON}
+        """
+        for qid, data in entity_data.items():
+            # data['id'] differs from qid when qid redirects to it, like in WikidataPrefetcher.prefetch
+            self.wikiclient.cache_policy.set(self.prefetcher.entity_data_key(qid), {'entities': {data['id']: data}})
+
+    def resolve_wikidata_ids(self, seen_entities):
+        """Get the Wikidata QIDs of all the seen entities, with one kernel evaluation per chunk of
+        entities that aren't in the tagger cache. Returns a dict mapping each URN to its QID (or to
+        None if it has no Wikidata ID), and a dict mapping the URNs of entities whose lookup failed
+        to the reason why.
+
+        seen_entities -- list of entities seen by the TEI tagger
+        """
+        wikidata_ids = dict()
+        if self.tagger_cache != None:
+            wikidata_ids = self.tagger_cache.get_wikidata_ids(list(seen_entities.keys()))
+            metrics.increment('wikidata_id_cache_hits', len(wikidata_ids))
+        unresolved = [urn for urn in seen_entities if urn not in wikidata_ids]
+
+        resolved = dict()
+        failures = dict()
+        for start in range(0, len(unresolved), WIKIDATA_ID_BATCH_SIZE):
+            urn_chunk = unresolved[start:start + WIKIDATA_ID_BATCH_SIZE]
+            expr = wl.Map(
+                wl.Function(wl.Quiet(wl.Check(wl.WikidataData(wl.Slot(1), 'WikidataID'), wl.Missing('Failed')))),
+                wl.List(*[seen_entities[urn][1].to_wl() for urn in urn_chunk])
+            )
+            metrics.increment('wikidata_id_lookups', len(urn_chunk))
+            with metrics.time('wikidata_id_lookup_seconds'):
+                results = self.session.evaluate(expr)
+            for urn, result in zip(urn_chunk, results):
+                if isinstance(result, (list, tuple)) and len(result) == 0:
+                    resolved[urn] = None
+                elif (isinstance(result, (list, tuple)) and hasattr(result[0], 'head') and
+                        result[0].head.name == 'Rule'):
+                    resolved[urn] = result[0][1]
+                else:
+                    failures[urn] = str(result)
+
+        if self.tagger_cache != None and resolved:
+            self.tagger_cache.set_wikidata_ids(resolved)
+        wikidata_ids.update(resolved)
+        return wikidata_ids, failures
 
     def wikiprop(self, wikientity, prop):
         """Get the value of the property specified by the property name for the given Wikidata
@@ -119,20 +397,14 @@ class IndexAssembler:
             else:
                 return date_string
 
-    def read_template(self, path, tag_name):
+    def read_template(self, filename, tag_name):
         """Get a BeautifulSoup of a TEI index template. You have to specify the name of the tag you
         want as well.
 
-        path -- file path of template
+        filename -- name of the template file in the template directory
         tag_name -- name of the tag the template is for
         """
-        tei_file = open(path, 'r')
-        tei_template = tei_file.read()
-        tei_file.close()
-
-        soup = BeautifulSoup(tei_template, 'xml')
-        soup = soup.find(tag_name) # we have to do this otherwise BS inserts an XML declaration
-        return copy.copy(soup)
+        return self.templates.get(filename, tag_name)
 
     def get_ship_object_tag(self, ref, xml_id, wikientity):
         """Generate an object tag for the given wikidata entity of a ship
@@ -144,8 +416,8 @@ class IndexAssembler:
         name = str(wikientity.label)
         short_desc = str(wikientity.description)
 
-        ship = self.read_template('tei_index_templates/ship.tei', 'object')
-        org.attrs = {'xml:id': xml_id, 'ref': ref}
+        ship = self.read_template('ship.tei', 'object')
+        ship.attrs = {'xml:id': xml_id, 'ref': ref}
 
         ship.find('objectName').append(name)
         ship.find('desc', type='shortDescription').append(short_desc)
@@ -162,7 +434,7 @@ class IndexAssembler:
         name = str(wikientity.label)
         short_desc = str(wikientity.description)
 
-        org = self.read_template('tei_index_templates/company.tei', 'org')
+        org = self.read_template('company.tei', 'org')
         org.attrs = {'xml:id': xml_id, 'ref': ref}
 
         org.find('orgName').append(name)
@@ -182,7 +454,7 @@ class IndexAssembler:
         author = str(self.wikiprop(wikientity, 'coordinates'))
         date = str(self.date_wikiprop(wikientity, 'inception'))
 
-        figure = self.read_template('tei_index_templates/artwork.tei', 'figure')
+        figure = self.read_template('artwork.tei', 'figure')
         figure.attrs = {'xml:id': xml_id, 'ref': ref}
 
         figure.find('title').append(name)
@@ -209,7 +481,7 @@ class IndexAssembler:
         country_name = str(country.label)
         country_code = self.wikiprop(country, 'country code')
 
-        place = self.read_template('tei_index_templates/place.tei', 'place')
+        place = self.read_template('place.tei', 'place')
         place.attrs = {'xml:id': xml_id, 'ref': ref}
 
         place.find('placeName').append(name)
@@ -240,7 +512,7 @@ class IndexAssembler:
         occupation_name = str(occupation.label)
         occupation_desc = str(occupation.description)
 
-        person = self.read_template('tei_index_templates/person.tei', 'person')
+        person = self.read_template('person.tei', 'person')
         person.attrs = {'xml:id': xml_id, 'sex': sex, 'ref': ref}
 
         person.find('persName').append(name)
@@ -0,0 +1,77 @@
+import copy
+import os
+import threading
+import time
+from bs4 import BeautifulSoup
+
+DEFAULT_TEMPLATE_DIR = 'tei_index_templates'
+
+class TemplateRegistry:
+    def __init__(self, template_dir=None, check_interval=2.0):
+        """Load and parse every TEI index template in a directory once. Templates are handed out as
+        copies of the parsed tag, and reloaded if their file changes, so long-running processes
+        pick up edited templates.
+
+        template_dir -- directory of .tei templates (defaults to tei_index_templates)
+        check_interval -- minimum number of seconds between checks for changed template files
+        """
+        self.template_dir = template_dir if template_dir != None else DEFAULT_TEMPLATE_DIR
+        self.check_interval = check_interval
+        # Looks like {'person.tei': (mtime, template text, {'person': parsed person tag})}
+        self.templates = dict()
+        self.last_checked = dict()
+        self.lock = threading.Lock()
+        for filename in sorted(os.listdir(self.template_dir)):
+            if filename.endswith('.tei'):
+                self.load(filename)
+
+    def load(self, filename):
+        """(Re)load a template file, throwing away any tags parsed out of the old version
+
+        filename -- name of the template file in the template directory
+        """
+        path = os.path.join(self.template_dir, filename)
+        mtime = os.stat(path).st_mtime_ns
+        with open(path, 'r') as tei_file:
+            text = tei_file.read()
+        self.templates[filename] = (mtime, text, dict())
+        self.last_checked[filename] = time.monotonic()
+
+    def refresh(self, filename):
+        """Reload a template if it isn't loaded yet or its file changed since it was loaded
+
+        filename -- name of the template file in the template directory
+        """
+        if filename not in self.templates:
+            self.load(filename)
+            return
+        if time.monotonic() - self.last_checked[filename] < self.check_interval:
+            return
+        self.last_checked[filename] = time.monotonic()
+        mtime = os.stat(os.path.join(self.template_dir, filename)).st_mtime_ns
+        if mtime != self.templates[filename][0]:
+            self.load(filename)
+
+    def get_text(self, filename):
+        """Get the raw text of a template, e.g. to parse a whole document template like siteindex.tei
+
+        filename -- name of the template file in the template directory
+        """
+        with self.lock:
+            self.refresh(filename)
+            return self.templates[filename][1]
+
+    def get(self, filename, tag_name):
+        """Get a fresh copy of the tag a template is for. The template is only parsed the first time
+        a tag is asked for; after that this just copies the parsed tag.
+
+        filename -- name of the template file in the template directory
+        tag_name -- name of the tag the template is for
+        """
+        with self.lock:
+            self.refresh(filename)
+            parsed_tags = self.templates[filename][2]
+            if tag_name not in parsed_tags:
+                soup = BeautifulSoup(self.templates[filename][1], 'xml')
+                parsed_tags[tag_name] = soup.find(tag_name) # we have to do this otherwise BS inserts an XML declaration
+            return copy.copy(parsed_tags[tag_name])
@@ -0,0 +1,67 @@
+import io
+import pytest
+from benchmarks.fixtures import make_synthetic_fixture
+from src.ner.backends import FakeTagger, ReplayTagger
+from src.ner.flair_ner import NamedEntityRecognizer
+from src.tei.assemble_document import (annotate_document, create_document, read_paragraphs,
+    render_annotated_file, stream_document)
+from src.utils.job_manifest import hash_file
+
+HEADER = {'title': 'A Thousand Miles up the Nile', 'author': 'Amelia Edwards', 'publisher': 'Longmans'}
+
+def make_text():
+    paragraphs, recording = make_synthetic_fixture(40)
+    # Paragraphs the recording doesn't have go to the FakeTagger, which tags capitalised words
+    paragraphs[5:5] = ['Tea & coffee at <Shepheard> Hotel.', 'no entities here', '']
+    return '\n\n\n'.join(paragraphs) + '\n', recording
+
+def create_ner(recording):
+    ner = NamedEntityRecognizer(None, ['Person', 'City', 'River', 'Building', 'HistoricalSite', 'Country'],
+                                0.5, True, 'nile', tagger_backend='fake')
+    ner.tagger = ReplayTagger(recording, FakeTagger())
+    return ner
+
+def test_paragraphs_are_read_like_tag_entities_splits_them():
+    text = 'First\n\nSecond\r\n\r\nThird\n\n\n\nFourth\nline\n\n'
+    expected = ['First', 'Second', 'Third', 'Fourth\nline', '']
+    for chunk_size in [1, 2, 3, 7, 64 * 1024]:
+        assert list(read_paragraphs(io.StringIO(text), chunk_size)) == expected
+
+@pytest.mark.parametrize('use_lxml', [False, True])
+def test_streamed_document_is_the_same_as_the_created_one(tmp_path, use_lxml):
+    text, recording = make_text()
+    document = create_document(create_ner(recording), text, use_lxml, **HEADER)
+    output_file = io.BytesIO()
+    stream_document(create_ner(recording), io.StringIO(text), output_file, use_lxml, **HEADER)
+    assert output_file.getvalue().decode('ascii') == document
+    # Same when given a file name
+    stream_document(create_ner(recording), io.StringIO(text), str(tmp_path / 'nile.tei'), use_lxml, **HEADER)
+    with open(tmp_path / 'nile.tei', 'r') as tei:
+        assert tei.read() == document
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_rendered_annotations_are_the_same_as_the_created_document(tmp_path, stream):
+    text, recording = make_text()
+    document = create_document(create_ner(recording), text, **HEADER)
+    text_path = str(tmp_path / 'nile.txt')
+    with open(text_path, 'w') as book:
+        book.write(text)
+    with open(tmp_path / 'nile.ann', 'wb') as annotation_file:
+        with open(text_path, 'r') as book:
+            annotate_document(create_ner(recording), book, annotation_file, hash_file(text_path), **HEADER)
+    render_annotated_file(text_path, str(tmp_path / 'nile.ann'), str(tmp_path / 'nile.tei'), stream=stream)
+    with open(tmp_path / 'nile.tei', 'r') as tei:
+        assert tei.read() == document
+
+    with open(text_path, 'a') as book:
+        book.write('An afterword.')
+    with pytest.raises(ValueError):
+        render_annotated_file(text_path, str(tmp_path / 'nile.ann'), str(tmp_path / 'nile.tei'))
+
+def test_descriptions_are_refused_before_tagging():
+    text, recording = make_text()
+    ner = create_ner(recording)
+    annotation_file = io.BytesIO()
+    with pytest.raises(ValueError, match='project description'):
+        annotate_document(ner, io.StringIO(text), annotation_file, project_description='A Nile journey.', **HEADER)
+    assert annotation_file.getvalue() == b''
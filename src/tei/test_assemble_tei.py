@@ -0,0 +1,39 @@
+from src.ner.entity_record import KIND_DATE, KIND_GEO, KIND_OTHER, KIND_QUANTITY, EntityRecord, get_type_id
+from src.tei.assemble_tei import create_body, create_header, create_xml, date_when
+
+def make_entity(text, paragraph, entity_type, ref=None, kind=KIND_OTHER, payload=None):
+    start_pos = paragraph.index(text)
+    return EntityRecord(start_pos, start_pos + len(text), get_type_id(entity_type), 0.9, text, ref, kind, payload)
+
+def make_paragraphs():
+    first = 'I met Amelia Edwards at Shepheard & Co. on 29 November 1873, and Lucie in 1862.'
+    second = 'Today we paid £5 for <tea> at Luxor, in March 1874.'
+    return [
+        {'text': first, 'entities': [
+            make_entity('I', first, 'Person'),
+            make_entity('Amelia Edwards', first, 'Person', 'persons.xml#amelia-edwards'),
+            make_entity('Shepheard & Co.', first, 'Company'),
+            make_entity('29 November 1873', first, 'Date', kind=KIND_DATE, payload=('1873', '11', '29')),
+            make_entity('Lucie', first, 'Person'),
+            make_entity('1862', first, 'Date', kind=KIND_DATE, payload=('1862',))]},
+        {'text': second, 'entities': [
+            make_entity('Today', second, 'Date', kind=KIND_DATE, payload=('2024', '1', '1')),
+            make_entity('£5', second, 'CurrencyAmount', kind=KIND_QUANTITY, payload=('5', 'BritishPounds')),
+            make_entity('Luxor', second, 'City', kind=KIND_GEO, payload=('25.7', '32.6')),
+            make_entity('March 1874', second, 'Date', kind=KIND_DATE, payload=('1874', '3'))]},
+        {'text': '', 'entities': []}
+    ]
+
+def test_date_when():
+    assert date_when(('1873', '11', '29')) == '1873-11-29'
+    assert date_when(('1873', '11')) == '1873-11'
+    assert date_when(('1873',)) == '1873'
+
+def test_both_builders_give_the_same_body():
+    documents = [create_xml(create_header('A Thousand Miles up the Nile', 'Amelia Edwards'),
+                            create_body(make_paragraphs(), use_lxml))
+                 for use_lxml in [False, True]]
+    assert documents[0] == documents[1]
+    assert b'when="1873-11-29"' in documents[0] and b'when="1874-3"' in documents[0]
+    # "I" and "Today" aren't tagged
+    assert b'>I<' not in documents[0] and b'>Today<' not in documents[0]
@@ -0,0 +1,63 @@
+import io
+import os
+from benchmarks.fixtures import FakeSession, WikidataStandIn, make_synthetic_fixture, make_synthetic_wikidata
+from src.ner.backends import ReplayTagger
+from src.ner.flair_ner import NamedEntityRecognizer
+from src.tei.assemble_tei_index import IndexAssembler
+
+ENTITY_TYPES = ['Person', 'City', 'River', 'Building', 'HistoricalSite', 'Country', 'Company', 'Ship']
+
+def test_written_index_is_the_same_as_the_created_one(tmp_path):
+    paragraphs, recording = make_synthetic_fixture(150)
+    ner = NamedEntityRecognizer(None, ENTITY_TYPES, 0.5, True, 'nile', tagger_backend='fake')
+    ner.tagger = ReplayTagger(recording)
+    for _ in ner.tag_paragraphs(paragraphs):
+        pass
+    seen_entities = ner.get_seen_entities()
+    wikidata_ids, entities = make_synthetic_wikidata(seen_entities)
+    stand_in = WikidataStandIn(entities)
+    stand_in.start()
+    try:
+        index_args = ['Nile', 'Amelia Edwards', 'Longmans', 'Longmans', 'CC0', 'Wikidata QID']
+        index = IndexAssembler(FakeSession(wikidata_ids), wikidata_base_url=stand_in.base_url).create_index(
+            seen_entities, *index_args)
+        output_file = io.StringIO()
+        assembler = IndexAssembler(FakeSession(wikidata_ids), wikidata_base_url=stand_in.base_url)
+        # Small chunks, so long lists are rendered by several workers
+        assembler.write_index(output_file, seen_entities, *index_args, workers=2,
+                              shard_dir=str(tmp_path), chunk_size=10)
+    finally:
+        stand_in.stop()
+    assert output_file.getvalue() == index
+    assert assembler.failed_urns == set()
+
+    shards = sorted(os.listdir(tmp_path))
+    assert 'listPerson-Person.tei' in shards and 'listPlace-City.tei' in shards
+    with open(tmp_path / 'listPerson-Person.tei', 'r') as shard:
+        people = shard.read()
+    assert people.startswith('<listPerson type="Person">\n') and people.endswith('</listPerson>\n')
+    assert people.count('<person ') == index.count('<person ') > 0
+
+def test_updated_index_is_the_same_as_a_rebuilt_one():
+    paragraphs, recording = make_synthetic_fixture(150)
+    ner = NamedEntityRecognizer(None, ENTITY_TYPES, 0.5, True, 'nile', tagger_backend='fake')
+    ner.tagger = ReplayTagger(recording)
+    for _ in ner.tag_paragraphs(paragraphs):
+        pass
+    seen_entities = ner.get_seen_entities()
+    first_entities = dict(list(seen_entities.items())[:len(seen_entities) // 2])
+    wikidata_ids, entities = make_synthetic_wikidata(seen_entities)
+    stand_in = WikidataStandIn(entities)
+    stand_in.start()
+    try:
+        index_args = ['Nile', 'Amelia Edwards', 'Longmans', 'Longmans', 'CC0', 'Wikidata QID']
+        first_index = IndexAssembler(FakeSession(wikidata_ids), wikidata_base_url=stand_in.base_url).create_index(
+            first_entities, *index_args)
+        updated_index = IndexAssembler(FakeSession(wikidata_ids), wikidata_base_url=stand_in.base_url).update_index(
+            first_index, seen_entities, index_args[-1])
+        index = IndexAssembler(FakeSession(wikidata_ids), wikidata_base_url=stand_in.base_url).create_index(
+            seen_entities, *index_args)
+    finally:
+        stand_in.stop()
+    assert '<!--' not in updated_index
+    assert updated_index == index
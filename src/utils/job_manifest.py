@@ -0,0 +1,73 @@
+import hashlib
+import json
+import os
+import time
+
+def hash_file(path):
+    """Get the SHA-256 hex digest of a file's contents"""
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+class JobManifest:
+    def __init__(self, path):
+        """Open (or create) a journal of batch tagging jobs. Every status change of a file is
+        appended to the journal as a line of JSON, so an interrupted run can tell which files are
+        done and which need to be (re)tagged. The last record of a file wins.
+
+        path -- file path of the journal
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        # Looks like {'filename': {'file': 'filename', 'status': 'done', 'input_hash': ..., ...}}
+        self.jobs = dict()
+        cut_off = False
+        if os.path.exists(path):
+            with open(path, 'r') as journal:
+                for line in journal:
+                    cut_off = not line.endswith('\n')
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError: # The last line may be cut off if we were killed
+                        continue
+                    self.jobs[record['file']] = record
+        self.journal = open(path, 'a')
+        if cut_off: # Don't append the next record to the end of a cut off line
+            self.journal.write('\n')
+
+    def close(self):
+        """Close the journal"""
+        self.journal.close()
+
+    def record(self, filename, status, **fields):
+        """Append a status change of a file to the journal
+
+        filename -- name of the input file
+        status -- 'started', 'done' or 'failed'
+        fields -- anything else to record, like input_hash, output_path, shard_path,
+            annotation_path or error
+        """
+        record = {'file': filename, 'status': status, 'time': time.time(), **fields}
+        self.jobs[filename] = record
+        self.journal.write(json.dumps(record) + '\n')
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+    def is_done(self, filename, input_hash):
+        """Check if a file was already tagged from the same input and its outputs still exist
+
+        filename -- name of the input file
+        input_hash -- hash of the input file's current contents
+        """
+        job = self.jobs.get(filename)
+        return (job != None and job['status'] == 'done' and job.get('input_hash') == input_hash and
+                os.path.exists(job['output_path']) and os.path.exists(job['shard_path']) and
+                (job.get('annotation_path') == None or os.path.exists(job['annotation_path'])))
+
+    def get_done_jobs(self):
+        """Get the records of every file that is done, sorted by file name"""
+        return [self.jobs[filename] for filename in sorted(self.jobs)
+                if self.jobs[filename]['status'] == 'done']
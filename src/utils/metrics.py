@@ -0,0 +1,269 @@
+"""metrics.py - Counters, latency histograms and a sampling profiler for seeing where a run spends
+its time
+
+Code reports to the process-wide metrics registry, e.g.
+
+    metrics.increment('kernel_evaluations')
+    with metrics.time('create_body_seconds', builder='lxml'):
+        ...
+
+The registry can be exported in the Prometheus text format (see MetricsRegistry.to_prometheus) or
+printed as a summary. Worker processes can send snapshots of their metrics to a parent, which
+merges them.
+"""
+import bisect
+import collections
+import sys
+import threading
+import time as time_module
+import traceback
+from contextlib import contextmanager
+
+# Upper bounds of the histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0)
+# Upper bounds of the histogram buckets of counts, like entities per paragraph
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+# Number of slowest observations (with what they were about) kept per histogram
+SLOWEST_KEPT = 5
+METRIC_PREFIX = 'lestrade_'
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """Distribution of observed values, bucketed Prometheus-style
+
+        buckets -- sorted upper bounds of the buckets; larger values go in the implicit +Inf bucket
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = None
+        # Looks like [(value, context)], largest first
+        self.slowest = []
+
+    def observe(self, value, context=None):
+        """Record a value, and what it was about if it's one of the largest so far
+
+        value -- value to record, e.g. a duration in seconds
+        context -- short description of what was measured, e.g. the start of a paragraph
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = value if self.max == None else max(self.max, value)
+        if context != None and (len(self.slowest) < SLOWEST_KEPT or value > self.slowest[-1][0]):
+            self.slowest.append((value, context))
+            self.slowest.sort(key=lambda slow: slow[0], reverse=True)
+            del self.slowest[SLOWEST_KEPT:]
+
+    def quantile(self, fraction):
+        """Estimate a quantile as the upper bound of the bucket it falls in"""
+        if self.count == 0:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def to_dict(self):
+        return {'buckets': list(self.buckets), 'counts': list(self.counts), 'count': self.count,
+                'sum': self.sum, 'max': self.max, 'slowest': [list(slow) for slow in self.slowest]}
+
+    def merge(self, snapshot):
+        """Add the observations of a histogram snapshot (see to_dict) with the same buckets"""
+        self.counts = [count + other for count, other in zip(self.counts, snapshot['counts'])]
+        self.count += snapshot['count']
+        self.sum += snapshot['sum']
+        if snapshot['max'] != None:
+            self.max = snapshot['max'] if self.max == None else max(self.max, snapshot['max'])
+        self.slowest = sorted(self.slowest + [tuple(slow) for slow in snapshot['slowest']],
+                              key=lambda slow: slow[0], reverse=True)[:SLOWEST_KEPT]
+
+def get_key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def format_labels(labels, extra=None):
+    labels = list(labels) + ([extra] if extra != None else [])
+    if not labels:
+        return ''
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in labels]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+class MetricsRegistry:
+    def __init__(self):
+        """Named counters and histograms, each optionally split up by labels. Safe to report to
+        from several threads at once.
+        """
+        # Both look like {(name, ((label, value), ...)): value}
+        self.counters = dict()
+        self.histograms = dict()
+        self.lock = threading.Lock()
+
+    def increment(self, name, value=1, **labels):
+        """Add to a counter
+
+        name -- name of the counter, e.g. "kernel_evaluations"
+        value -- amount to add
+        labels -- labels of the counter, e.g. builder="lxml"
+        """
+        key = get_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, context=None, **labels):
+        """Record a value in a histogram
+
+        name -- name of the histogram, e.g. "kernel_evaluate_seconds"
+        value -- value to record
+        buckets -- bucket upper bounds, used when the histogram is new
+        context -- short description of what was measured, kept for the largest values
+        labels -- labels of the histogram
+        """
+        key = get_key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram == None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value, context)
+
+    @contextmanager
+    def time(self, name, context=None, **labels):
+        """Time the body of a with statement into a latency histogram (see observe)"""
+        start = time_module.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time_module.perf_counter() - start, context=context, **labels)
+
+    def reset(self):
+        """Forget everything recorded so far"""
+        with self.lock:
+            self.counters = dict()
+            self.histograms = dict()
+
+    def snapshot(self):
+        """Get everything recorded so far in a form that can be pickled or saved as JSON"""
+        with self.lock:
+            return {
+                'counters': [[name, list(labels), value] for (name, labels), value in self.counters.items()],
+                'histograms': [[name, list(labels), histogram.to_dict()]
+                               for (name, labels), histogram in self.histograms.items()]
+            }
+
+    def merge(self, snapshot):
+        """Add the metrics of a snapshot, e.g. from a worker process, to this registry"""
+        with self.lock:
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(tuple(label) for label in labels))
+                self.counters[key] = self.counters.get(key, 0) + value
+            for name, labels, histogram_snapshot in snapshot['histograms']:
+                key = (name, tuple(tuple(label) for label in labels))
+                histogram = self.histograms.get(key)
+                if histogram == None:
+                    histogram = self.histograms[key] = Histogram(histogram_snapshot['buckets'])
+                histogram.merge(histogram_snapshot)
+
+    def to_prometheus(self, gauges=None):
+        """Export the metrics in the Prometheus text exposition format
+
+        gauges -- dict of extra {name: value} gauges to export, e.g. current queue lengths
+        """
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f'# TYPE {METRIC_PREFIX}{name}_total counter')
+                typed.add(name)
+            lines.append(f'{METRIC_PREFIX}{name}_total{format_labels(labels)} {value}')
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                lines.append(f'# TYPE {METRIC_PREFIX}{name} histogram')
+                typed.add(name)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append(f'{METRIC_PREFIX}{name}_bucket{format_labels(labels, ("le", bound))} {cumulative}')
+            lines.append(f'{METRIC_PREFIX}{name}_sum{format_labels(labels)} {histogram.sum}')
+            lines.append(f'{METRIC_PREFIX}{name}_count{format_labels(labels)} {histogram.count}')
+        for name, value in sorted((gauges or dict()).items()):
+            lines.append(f'# TYPE {METRIC_PREFIX}{name} gauge')
+            lines.append(f'{METRIC_PREFIX}{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def format_summary(self):
+        """Get a human-readable report of the metrics, with the slowest observations of each
+        latency histogram
+        """
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+        for (name, labels), value in counters:
+            lines.append(f'{name}{format_labels(labels)}: {value}')
+        for (name, labels), histogram in histograms:
+            if histogram.count == 0:
+                continue
+            lines.append(f'{name}{format_labels(labels)}: {histogram.count} observed, '
+                         f'total {histogram.sum:.3f}, mean {histogram.sum / histogram.count:.4f}, '
+                         f'p50 <= {histogram.quantile(0.5)}, p99 <= {histogram.quantile(0.99)}, '
+                         f'max {histogram.max:.4f}')
+            for value, context in histogram.slowest:
+                lines.append(f'    {value:.4f} {context}')
+        return '\n'.join(lines)
+
+# Registry everything in this process reports to
+metrics = MetricsRegistry()
+
+def describe_text(text, length=60):
+    """Get a short description of a text to use as the context of an observation"""
+    described = ' '.join(text[:length].split())
+    return repr(described + '...' if len(text) > length else described)
+
+class SamplingProfiler:
+    def __init__(self, interval=0.01):
+        """Statistical profiler that samples the stacks of every other thread every interval
+        seconds, to find out what slow runs spend their time on without slowing them down much.
+        Samples are counted per collapsed stack, the format flame graph tools read.
+
+        interval -- number of seconds between samples
+        """
+        self.interval = interval
+        # Looks like {'module:function;module:function': number of samples}
+        self.stacks = collections.Counter()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, name='SamplingProfiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread != None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        own_thread = threading.get_ident()
+        while not self.stopping.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                stack = traceback.extract_stack(frame)
+                self.stacks[';'.join(f'{entry.filename.rsplit("/", 1)[-1]}:{entry.name}'
+                                     for entry in stack)] += 1
+
+    def save(self, path):
+        """Write the samples in collapsed stack format, one "stack count" line per stack"""
+        with open(path, 'w') as profile_file:
+            for stack, count in self.stacks.most_common():
+                profile_file.write(f'{stack} {count}\n')
@@ -1,6 +1,8 @@
 import re
 
-titles = ['Mr.', 'Mr', 'Mrs.', 'Mrs', 'Miss', 'Dr.', 'Dr', 'Sir', 'Ms.', 'Ms']
+titles = {'Mr.', 'Mr', 'Mrs.', 'Mrs', 'Miss', 'Dr.', 'Dr', 'Sir', 'Ms.', 'Ms'}
+punctuation_pattern = re.compile(r'\.|,')
+non_capital_pattern = re.compile('[^A-Z]')
 
 
 def create_name_ref(x):
@@ -8,19 +10,17 @@ def create_name_ref(x):
     ref = [t for t in ref if t not in titles]
     ref.insert(0, ref.pop(-1))
     ref = '#{}'.format('_'.join(ref))
-    return re.sub(r'\.|,', '', ref)
+    return punctuation_pattern.sub('', ref)
 
 
 def create_initials_ref(x):
     ref = x.split()
     ref = [t for t in ref if t not in titles]
-    ref = re.sub('[^A-Z]', '', ''.join(ref))
+    ref = non_capital_pattern.sub('', ''.join(ref))
     return ref
 
 
 def create_ref(x):
     ref = x.split()
     ref = '#{}'.format('_'.join(ref))
-    return re.sub(r'\.|,', '', ref)
-
-
+    return punctuation_pattern.sub('', ref)
@@ -0,0 +1,92 @@
+import os
+from src.utils.job_manifest import JobManifest, hash_file
+
+def make_outputs(tmp_path, filename):
+    """Create the files a finished job leaves behind, returning their paths as record fields"""
+    paths = {'output_path': str(tmp_path / f'{filename}.tei'),
+             'shard_path': str(tmp_path / f'{filename}.wxf'),
+             'annotation_path': str(tmp_path / f'{filename}.ann')}
+    for path in paths.values():
+        with open(path, 'w') as output_file:
+            output_file.write('output')
+    return paths
+
+def make_input(tmp_path, filename, text):
+    path = tmp_path / filename
+    with open(path, 'w') as input_file:
+        input_file.write(text)
+    return hash_file(str(path))
+
+def test_done_jobs_are_skipped_after_reopening(tmp_path):
+    manifest_path = str(tmp_path / 'state' / 'manifest.jsonl')
+    manifest = JobManifest(manifest_path)
+    nile_hash = make_input(tmp_path, 'nile.txt', 'Amelia Edwards sailed to Philae.')
+    cairo_hash = make_input(tmp_path, 'cairo.txt', 'Cairo')
+    manifest.record('nile.txt', 'started', input_hash=nile_hash)
+    manifest.record('nile.txt', 'done', input_hash=nile_hash, **make_outputs(tmp_path, 'nile.txt'))
+    # Interrupted before cairo.txt finished
+    manifest.record('cairo.txt', 'started', input_hash=cairo_hash)
+    manifest.close()
+
+    manifest = JobManifest(manifest_path)
+    assert manifest.is_done('nile.txt', nile_hash)
+    assert not manifest.is_done('cairo.txt', cairo_hash)
+    assert not manifest.is_done('luxor.txt', nile_hash)
+    assert [job['file'] for job in manifest.get_done_jobs()] == ['nile.txt']
+    manifest.close()
+
+def test_changed_inputs_and_missing_outputs_are_tagged_again(tmp_path):
+    manifest = JobManifest(str(tmp_path / 'manifest.jsonl'))
+    input_hash = make_input(tmp_path, 'nile.txt', 'Amelia Edwards sailed to Philae.')
+    outputs = make_outputs(tmp_path, 'nile.txt')
+    manifest.record('nile.txt', 'done', input_hash=input_hash, **outputs)
+    assert manifest.is_done('nile.txt', input_hash)
+    assert not manifest.is_done('nile.txt', make_input(tmp_path, 'nile.txt', 'Amelia Edwards sailed to Abu Simbel.'))
+    for field in ['annotation_path', 'shard_path', 'output_path']:
+        os.remove(outputs[field])
+        assert not manifest.is_done('nile.txt', input_hash)
+    manifest.close()
+
+def test_jobs_without_annotation_files(tmp_path):
+    manifest = JobManifest(str(tmp_path / 'manifest.jsonl'))
+    outputs = make_outputs(tmp_path, 'nile.txt')
+    del outputs['annotation_path']
+    manifest.record('nile.txt', 'done', input_hash='abc', **outputs)
+    assert manifest.is_done('nile.txt', 'abc')
+    manifest.close()
+
+def test_last_record_of_a_file_wins(tmp_path):
+    manifest_path = str(tmp_path / 'manifest.jsonl')
+    manifest = JobManifest(manifest_path)
+    outputs = make_outputs(tmp_path, 'nile.txt')
+    manifest.record('nile.txt', 'done', input_hash='abc', **outputs)
+    manifest.record('nile.txt', 'started', input_hash='def')
+    manifest.record('nile.txt', 'failed', input_hash='def', error='KernelError()')
+    manifest.close()
+
+    manifest = JobManifest(manifest_path)
+    assert manifest.jobs['nile.txt']['status'] == 'failed'
+    assert not manifest.is_done('nile.txt', 'abc')
+    assert manifest.get_done_jobs() == []
+    manifest.close()
+
+def test_cut_off_last_line_is_skipped(tmp_path):
+    manifest_path = str(tmp_path / 'manifest.jsonl')
+    manifest = JobManifest(manifest_path)
+    manifest.record('nile.txt', 'done', input_hash='abc', **make_outputs(tmp_path, 'nile.txt'))
+    manifest.close()
+    # Killed while writing the next record
+    with open(manifest_path, 'a') as journal:
+        journal.write('{"file": "cairo.txt", "sta')
+
+    manifest = JobManifest(manifest_path)
+    assert manifest.is_done('nile.txt', 'abc')
+    assert 'cairo.txt' not in manifest.jobs
+    manifest.record('cairo.txt', 'done', input_hash='def', **make_outputs(tmp_path, 'cairo.txt'))
+    manifest.close()
+
+    # The record written after the cut off line isn't lost
+    manifest = JobManifest(manifest_path)
+    assert manifest.is_done('cairo.txt', 'def')
+    assert [job['file'] for job in manifest.get_done_jobs()] == ['cairo.txt', 'nile.txt']
+    manifest.close()
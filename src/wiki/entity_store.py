@@ -0,0 +1,201 @@
+"""entity_store.py - Persistent local store of Wikidata entities
+
+Can also be run to bulk import entities from a Wikidata JSON dump:
+    python -m src.wiki.entity_store STORE_PATH DUMP_PATH [--ids IDS_FILE]
+"""
+import argparse
+import bz2
+import gzip
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import urllib.error
+import urllib.request
+from wikidata.cache import CachePolicy
+
+entity_data_url_pattern = re.compile(r'/wiki/Special:EntityData/([^/]+)\.json$')
+# Number of entities written between checks of whether there are too many, so writes don't each
+# count the whole store
+EVICT_INTERVAL = 1000
+
+class OfflineOpener(urllib.request.OpenerDirector):
+    """urllib opener for wikidata.client.Client that refuses to touch the network"""
+    def open(self, fullurl, data=None, timeout=None):
+        raise urllib.error.URLError(f'Wikidata is in offline mode, not fetching {fullurl}')
+
+class EntityStore(CachePolicy):
+    def __init__(self, path, ttl=30 * 24 * 60 * 60, max_entities=None, offline=False,
+                 evict_interval=EVICT_INTERVAL):
+        """Open (or create) a SQLite store of Wikidata entity JSON. The store is a wikidata
+        CachePolicy, so a wikidata.client.Client with it as its cache_policy reads through it.
+
+        path -- file path of the store
+        ttl -- number of seconds before a fetched entity is considered stale, or None to keep forever
+        max_entities -- maximum number of entities to keep. The least recently used are evicted
+            every evict_interval writes, so the store can go over by up to that many in between.
+        offline -- if True, stale entities are still returned and nothing should be fetched
+        evict_interval -- number of entities written between evictions
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.ttl = ttl
+        self.max_entities = max_entities
+        self.offline = offline
+        self.evict_interval = evict_interval
+        self.writes_since_evict = 0
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            # id is the ID the entity was asked for, which differs from data's ID for redirects
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS entities (
+                id TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                expires_at REAL,
+                accessed_at REAL NOT NULL
+            )''')
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS entities_accessed_at ON entities (accessed_at)')
+
+    def close(self):
+        """Close the store"""
+        self.connection.close()
+
+    def make_opener(self):
+        """Get the urllib opener a wikidata.client.Client reading through this store should use"""
+        if self.offline:
+            return OfflineOpener()
+        return urllib.request.build_opener()
+
+    def get_entity(self, entity_id):
+        """Get the JSON data of an entity, or None if it isn't stored or is stale
+
+        entity_id -- Wikidata QID or PID
+        """
+        now = time.time()
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                'SELECT data, expires_at FROM entities WHERE id = ?', (entity_id,)).fetchone()
+            if row == None:
+                return None
+            data, expires_at = row
+            if expires_at != None and expires_at < now and not self.offline:
+                return None
+            self.connection.execute('UPDATE entities SET accessed_at = ? WHERE id = ?', (now, entity_id))
+        return json.loads(data)
+
+    def put_entities(self, entities, ttl=-1):
+        """Store entities in one transaction, replacing any stored versions, then evict entities
+        if there are too many and evict_interval entities were written since the last eviction
+
+        entities -- dict mapping the ID each entity was asked for to its JSON data
+        ttl -- number of seconds the entities stay fresh, None to keep them forever, or -1 to use
+            the store's ttl
+        """
+        ttl = self.ttl if ttl == -1 else ttl
+        now = time.time()
+        expires_at = now + ttl if ttl != None else None
+        rows = [(entity_id, json.dumps(data, separators=(',', ':')), expires_at, now)
+                for entity_id, data in entities.items()]
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO entities (id, data, expires_at, accessed_at) VALUES (?, ?, ?, ?)', rows)
+            self.writes_since_evict += len(rows)
+            evict = self.writes_since_evict >= self.evict_interval
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """Delete the least recently used entities until there are at most max_entities"""
+        if self.max_entities == None:
+            return
+        with self.lock, self.connection:
+            self.writes_since_evict = 0
+            count = self.connection.execute('SELECT COUNT(*) FROM entities').fetchone()[0]
+            if count > self.max_entities:
+                self.connection.execute(
+                    'DELETE FROM entities WHERE id IN (SELECT id FROM entities ORDER BY accessed_at LIMIT ?)',
+                    (count - self.max_entities,))
+
+    def get(self, key):
+        """CachePolicy interface: look up the Special:EntityData response cached under a URL"""
+        match = entity_data_url_pattern.search(key)
+        if match == None:
+            return None
+        data = self.get_entity(match.group(1))
+        if data == None:
+            return None
+        return {'entities': {data['id']: data}}
+
+    def set(self, key, value):
+        """CachePolicy interface: store the Special:EntityData response of a URL"""
+        match = entity_data_url_pattern.search(key)
+        if match == None:
+            return
+        if value == None:
+            with self.lock, self.connection:
+                self.connection.execute('DELETE FROM entities WHERE id = ?', (match.group(1),))
+            return
+        for data in value['entities'].values():
+            self.put_entities({match.group(1): data})
+
+    def set_many(self, items):
+        """Store the Special:EntityData responses of many URLs in one transaction
+
+        items -- list of (URL, response) pairs, like the args of set
+        """
+        entities = dict()
+        for key, value in items:
+            match = entity_data_url_pattern.search(key)
+            if match != None and value != None:
+                for data in value['entities'].values():
+                    entities[match.group(1)] = data
+        if entities:
+            self.put_entities(entities)
+
+    def import_dump(self, dump_path, ids=None, batch_size=1000):
+        """Bulk import entities from a Wikidata JSON dump (optionally gzip or bz2 compressed).
+        Imported entities never go stale. Returns the number of entities imported.
+
+        dump_path -- path of the dump
+        ids -- set of IDs to import, or None to import every entity in the dump
+        batch_size -- number of entities to write to the store at a time
+        """
+        opener = gzip.open if dump_path.endswith('.gz') else bz2.open if dump_path.endswith('.bz2') else open
+        imported = 0
+        batch = dict()
+        with opener(dump_path, 'rt', encoding='utf-8') as dump:
+            # Dumps are one big JSON array with one entity per line
+            for line in dump:
+                line = line.strip().rstrip(',')
+                if line in ['', '[', ']']:
+                    continue
+                data = json.loads(line)
+                if ids != None and data['id'] not in ids:
+                    continue
+                batch[data['id']] = data
+                if len(batch) >= batch_size:
+                    self.put_entities(batch, ttl=None)
+                    imported += len(batch)
+                    batch = dict()
+        if batch:
+            self.put_entities(batch, ttl=None)
+            imported += len(batch)
+        return imported
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bulk import entities from a Wikidata JSON dump')
+    parser.add_argument('store_path', help='path of the entity store')
+    parser.add_argument('dump_path', help='path of the Wikidata JSON dump (.json, .json.gz or .json.bz2)')
+    parser.add_argument('--ids', help='file of entity IDs to import, one per line (defaults to all)')
+    args = parser.parse_args()
+
+    ids = None
+    if args.ids:
+        with open(args.ids, 'r') as ids_file:
+            ids = {line.strip() for line in ids_file if line.strip()}
+    store = EntityStore(args.store_path)
+    print(f"Imported {store.import_dump(args.dump_path, ids)} entities")
+    store.close()
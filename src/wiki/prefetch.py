@@ -0,0 +1,135 @@
+import json
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from wikidata.cache import CacheKey
+from src.utils.metrics import metrics
+
+# wbgetentities accepts at most 50 IDs per request
+WBGETENTITIES_BATCH_SIZE = 50
+
+class WikidataPrefetcher:
+    def __init__(self, wikiclient, max_workers=4, opener=None):
+        """Fetch Wikidata entities in batches ahead of time, and put them in the cache of a
+        wikidata.client.Client so that loading them through the client doesn't touch the network.
+
+        wikiclient -- wikidata.client.Client whose cache_policy actually stores values
+        max_workers -- maximum number of wbgetentities requests in flight at once
+        opener -- urllib opener to make requests with (defaults to the wikiclient's opener)
+        """
+        self.client = wikiclient
+        self.api_url = urllib.parse.urljoin(wikiclient.base_url, './w/api.php')
+        self.max_workers = max_workers
+        self.opener = opener if opener != None else wikiclient.opener
+
+    def entity_data_key(self, qid):
+        """Get the cache key the Client uses for the Special:EntityData JSON of an entity"""
+        return CacheKey(urllib.parse.urljoin(self.client.base_url, f'./wiki/Special:EntityData/{qid}.json'))
+
+    def get_cached(self, qid):
+        """Get the cached data of an entity, or None if it isn't cached"""
+        result = self.client.cache_policy.get(self.entity_data_key(qid))
+        if result == None:
+            return None
+        return next(iter(result['entities'].values()))
+
+    def fetch_batch(self, qids):
+        """Fetch up to 50 entities with one wbgetentities request. Returns the entities by ID.
+
+        qids -- list of Wikidata QIDs (or PIDs) to fetch
+        """
+        query = urllib.parse.urlencode({
+            'action': 'wbgetentities',
+            'ids': '|'.join(qids),
+            'format': 'json'
+        })
+        with metrics.time('wikidata_fetch_seconds', context=f'{len(qids)} entities from {qids[0]}'):
+            response = self.opener.open(f'{self.api_url}?{query}')
+            data = response.read()
+        metrics.increment('wikidata_requests')
+        metrics.increment('wikidata_bytes_received', len(data))
+        result = json.loads(data.decode('utf-8'))
+        return result.get('entities', {})
+
+    def try_fetch_batch(self, qids):
+        """Fetch a batch like fetch_batch, but print the error and return None if the request
+        fails, so the entities are loaded one at a time when they're needed instead
+
+        qids -- list of Wikidata QIDs (or PIDs) to fetch
+        """
+        try:
+            return self.fetch_batch(qids)
+        except (OSError, ValueError) as error: # e.g. urllib.error.URLError, or a response that isn't JSON
+            print(f"Couldn't prefetch {len(qids)} entities from {qids[0]}: {error}")
+            metrics.increment('wikidata_prefetch_failures')
+            return None
+
+    def prefetch(self, qids):
+        """Fetch every entity that isn't cached yet, in batches, over a bounded thread pool, and put
+        them in the client's cache. Returns the list of IDs that were fetched. A batch that can't
+        be fetched is left out, and isn't cached.
+
+        qids -- iterable of Wikidata QIDs
+        """
+        missing = sorted({qid for qid in qids if self.get_cached(qid) == None})
+        batches = [missing[start:start + WBGETENTITIES_BATCH_SIZE]
+                   for start in range(0, len(missing), WBGETENTITIES_BATCH_SIZE)]
+        failed = set()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for batch, entities in zip(batches, executor.map(self.try_fetch_batch, batches)):
+                if entities == None:
+                    failed.update(batch)
+                    continue
+                items = []
+                for entity_id, data in entities.items():
+                    if 'missing' in data:
+                        continue
+                    # Same shape as Special:EntityData, which is what Entity.load expects
+                    result = {'entities': {data['id']: data}}
+                    items.append((self.entity_data_key(data['id']), result))
+                    if 'redirects' in data:
+                        items.append((self.entity_data_key(data['redirects']['from']), result))
+                self.store_batch(items)
+        return [qid for qid in missing if qid not in failed]
+
+    def store_batch(self, items):
+        """Put a batch of (cache key, value) pairs in the client's cache, in one go if the cache
+        can (e.g. one transaction of an EntityStore)
+        """
+        set_many = getattr(self.client.cache_policy, 'set_many', None)
+        if set_many != None:
+            set_many(items)
+            return
+        for key, value in items:
+            self.client.cache_policy.set(key, value)
+
+    def linked_qids(self, qids, pids):
+        """Get the QIDs that cached entities link to through the given properties, e.g. the
+        countries of places or the occupations of people.
+
+        qids -- iterable of Wikidata QIDs of cached entities
+        pids -- iterable of Wikidata PIDs of properties to follow
+        """
+        linked = set()
+        for qid in qids:
+            data = self.get_cached(qid)
+            if data == None:
+                continue
+            claims = data.get('claims', {})
+            for pid in pids:
+                for claim in claims.get(pid, []):
+                    snak = claim['mainsnak']
+                    if snak['snaktype'] == 'value' and snak['datavalue']['type'] == 'wikibase-entityid':
+                        linked.add(snak['datavalue']['value']['id'])
+        return linked
+
+    def prefetch_with_links(self, qids, pids):
+        """Prefetch entities, then prefetch everything they link to through the given properties in
+        one more wave.
+
+        qids -- iterable of Wikidata QIDs
+        pids -- iterable of Wikidata PIDs of properties to follow
+        """
+        qids = set(qids)
+        self.prefetch(qids)
+        self.prefetch(self.linked_qids(qids, pids))
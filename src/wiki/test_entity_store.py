@@ -0,0 +1,61 @@
+import time
+import urllib.error
+import pytest
+from benchmarks.fixtures import make_wikidata_entity
+from src.wiki.entity_store import EntityStore
+
+def entity_data_url(qid):
+    return f'https://www.wikidata.org/wiki/Special:EntityData/{qid}.json'
+
+def entity_data(qid):
+    return {'entities': {qid: make_wikidata_entity(qid, f'Entity {qid}', '', {})}}
+
+def test_entities_are_stored_under_their_urls(tmp_path):
+    store = EntityStore(str(tmp_path / 'entities.sqlite'))
+    store.set(entity_data_url('Q79'), entity_data('Q79'))
+    assert store.get(entity_data_url('Q79')) == entity_data('Q79')
+    assert store.get(entity_data_url('Q85')) == None
+    assert store.get('https://www.wikidata.org/w/api.php') == None
+    store.set(entity_data_url('Q79'), None)
+    assert store.get(entity_data_url('Q79')) == None
+    store.close()
+
+def test_set_many_stores_redirects_under_the_asked_id(tmp_path):
+    store = EntityStore(str(tmp_path / 'entities.sqlite'))
+    store.set_many([(entity_data_url('Q79'), entity_data('Q79')), (entity_data_url('Q5'), entity_data('Q79')),
+                    ('https://www.wikidata.org/w/api.php', entity_data('Q85'))])
+    assert store.get_entity('Q5')['id'] == 'Q79'
+    assert store.get_entity('Q79')['id'] == 'Q79'
+    assert store.get_entity('Q85') == None
+    store.close()
+
+def test_stale_entities_are_only_returned_offline(tmp_path):
+    path = str(tmp_path / 'entities.sqlite')
+    store = EntityStore(path, ttl=-10)
+    store.put_entities({'Q79': entity_data('Q79')['entities']['Q79']})
+    store.put_entities({'Q85': entity_data('Q85')['entities']['Q85']}, ttl=None)
+    assert store.get_entity('Q79') == None
+    assert store.get_entity('Q85') != None
+    store.close()
+
+    store = EntityStore(path, offline=True)
+    assert store.get_entity('Q79')['id'] == 'Q79'
+    with pytest.raises(urllib.error.URLError):
+        store.make_opener().open(entity_data_url('Q79'))
+    store.close()
+
+def test_least_recently_used_entities_are_evicted_every_interval(tmp_path):
+    store = EntityStore(str(tmp_path / 'entities.sqlite'), max_entities=3, evict_interval=4)
+    store.set_many([(entity_data_url(qid), entity_data(qid)) for qid in ['Q1', 'Q2', 'Q3']])
+    time.sleep(0.01)
+    assert store.get_entity('Q1') != None
+    time.sleep(0.01)
+    store.set_many([(entity_data_url('Q4'), entity_data('Q4'))])
+    ids = {row[0] for row in store.connection.execute('SELECT id FROM entities')}
+    assert len(ids) == 3 and {'Q1', 'Q4'} <= ids
+    # Over max_entities, but not evicted until evict_interval more entities are written
+    store.set_many([(entity_data_url(qid), entity_data(qid)) for qid in ['Q5', 'Q6']])
+    assert store.connection.execute('SELECT COUNT(*) FROM entities').fetchone()[0] == 5
+    store.set_many([(entity_data_url(qid), entity_data(qid)) for qid in ['Q7', 'Q8']])
+    assert store.connection.execute('SELECT COUNT(*) FROM entities').fetchone()[0] == 3
+    store.close()
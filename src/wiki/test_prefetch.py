@@ -0,0 +1,111 @@
+import pytest
+import wikidata.client
+from wikidata.cache import MemoryCachePolicy
+from benchmarks.fixtures import (FakeSession, WikidataStandIn, make_synthetic_fixture,
+                                 make_synthetic_wikidata, make_wikidata_entity)
+from src.ner.backends import ReplayTagger
+from src.ner.flair_ner import NamedEntityRecognizer
+from src.tei.assemble_tei_index import IndexAssembler
+from src.wiki.prefetch import WikidataPrefetcher
+
+@pytest.fixture
+def stand_in():
+    entities = {f'Q{number}': make_wikidata_entity(f'Q{number}', f'Entity {number}', '', {'P17': 'Q79'})
+                for number in range(100, 220)}
+    entities['Q79'] = make_wikidata_entity('Q79', 'Egypt', 'country in Africa', {})
+    stand_in = WikidataStandIn(entities)
+    stand_in.start()
+    yield stand_in
+    stand_in.stop()
+
+def make_prefetcher(stand_in):
+    client = wikidata.client.Client(stand_in.base_url, cache_policy=MemoryCachePolicy(1000))
+    return WikidataPrefetcher(client, max_workers=2)
+
+def test_entities_are_fetched_in_batches_once(stand_in):
+    prefetcher = make_prefetcher(stand_in)
+    qids = [f'Q{number}' for number in range(100, 220)]
+    assert prefetcher.prefetch(qids) == sorted(qids)
+    # 50 entities per wbgetentities request
+    assert stand_in.requests == 3
+    assert prefetcher.get_cached('Q150')['labels']['en']['value'] == 'Entity 150'
+    assert prefetcher.prefetch(qids + ['Q79']) == ['Q79']
+    assert stand_in.requests == 4
+
+def test_missing_entities_arent_cached(stand_in):
+    prefetcher = make_prefetcher(stand_in)
+    prefetcher.prefetch(['Q100', 'Q999999'])
+    assert prefetcher.get_cached('Q100') != None
+    assert prefetcher.get_cached('Q999999') == None
+
+def test_redirected_entities_are_cached_under_both_ids(stand_in):
+    stand_in.entities['Q5'] = {**stand_in.entities['Q100'], 'redirects': {'from': 'Q5', 'to': 'Q100'}}
+    prefetcher = make_prefetcher(stand_in)
+    prefetcher.prefetch(['Q5'])
+    assert prefetcher.get_cached('Q5')['id'] == 'Q100'
+    assert prefetcher.get_cached('Q100')['id'] == 'Q100'
+
+def test_linked_entities_are_fetched_in_one_more_wave(stand_in):
+    prefetcher = make_prefetcher(stand_in)
+    prefetcher.prefetch_with_links(['Q100', 'Q101'], ['P17'])
+    assert stand_in.requests == 2
+    assert prefetcher.get_cached('Q79')['labels']['en']['value'] == 'Egypt'
+    assert prefetcher.linked_qids(['Q100', 'Q101', 'Q79'], ['P17']) == {'Q79'}
+
+def test_batches_that_fail_are_left_out(stand_in):
+    stand_in.failing_ids.add('Q160')
+    prefetcher = make_prefetcher(stand_in)
+    qids = [f'Q{number}' for number in range(100, 220)]
+    # The second batch (Q150 to Q199) fails, the others are still cached
+    assert prefetcher.prefetch(qids) == [qid for qid in sorted(qids) if not 'Q150' <= qid <= 'Q199']
+    assert prefetcher.get_cached('Q100') != None
+    assert prefetcher.get_cached('Q160') == None
+
+def test_index_entities_are_loaded_from_the_prefetched_entities():
+    paragraphs, recording = make_synthetic_fixture(100)
+    ner = NamedEntityRecognizer(None, ['Person', 'City', 'River', 'Building', 'HistoricalSite', 'Country'],
+                                0.5, True, 'nile', tagger_backend='fake')
+    ner.tagger = ReplayTagger(recording)
+    for _ in ner.tag_paragraphs(paragraphs):
+        pass
+    seen_entities = ner.get_seen_entities()
+    wikidata_ids, entities = make_synthetic_wikidata(seen_entities)
+    # One entity without a Wikidata ID, which is left out of the index
+    missing_urn = sorted(wikidata_ids)[0]
+    del wikidata_ids[missing_urn]
+    stand_in = WikidataStandIn(entities)
+    stand_in.start()
+    try:
+        assembler = IndexAssembler(FakeSession(wikidata_ids), wikidata_base_url=stand_in.base_url,
+                                   wikidata_workers=2)
+        index = assembler.create_index(seen_entities, 'Nile', '', '', '', '', 'WolframEntity URN')
+    finally:
+        stand_in.stop()
+    batches = (len(wikidata_ids) + 49) // 50
+    linked_batches = 1
+    # Every entity came from a wbgetentities batch, none from its own Special:EntityData request
+    assert stand_in.requests == batches + linked_batches
+    assert assembler.failed_urns == set()
+    for urn, (xml_id, _) in seen_entities.items():
+        assert (f'xml:id="{xml_id}"' in index) == (urn != missing_urn)
+
+def test_index_entities_are_loaded_one_at_a_time_when_their_batch_fails():
+    paragraphs, recording = make_synthetic_fixture(100)
+    ner = NamedEntityRecognizer(None, ['Person', 'City', 'River', 'Building', 'HistoricalSite', 'Country'],
+                                0.5, True, 'nile', tagger_backend='fake')
+    ner.tagger = ReplayTagger(recording)
+    for _ in ner.tag_paragraphs(paragraphs):
+        pass
+    seen_entities = ner.get_seen_entities()
+    wikidata_ids, entities = make_synthetic_wikidata(seen_entities)
+    stand_in = WikidataStandIn(entities)
+    stand_in.start()
+    try:
+        index = IndexAssembler(FakeSession(wikidata_ids), wikidata_base_url=stand_in.base_url).create_index(
+            seen_entities, 'Nile', '', '', '', '', 'WolframEntity URN')
+        stand_in.failing_ids.add(sorted(wikidata_ids.values())[0])
+        assembler = IndexAssembler(FakeSession(wikidata_ids), wikidata_base_url=stand_in.base_url)
+        assert assembler.create_index(seen_entities, 'Nile', '', '', '', '', 'WolframEntity URN') == index
+    finally:
+        stand_in.stop()
+    assert assembler.failed_urns == set()
@@ -1,28 +1,107 @@
-"""tag_ia_texts.py - Downloads raw text of an Internet Archive book and TEI tags it
+"""tag_ia_texts.py - Downloads raw text of Internet Archive books and TEI tags them
+
+Books are downloaded a few at a time into a local content store (see src/ia/content_store.py)
+while the ones already downloaded are tagged, and books already in the store aren't downloaded
+again. Give identifiers, a file of identifiers (one per line) or a search query:
+    python tag_ia_texts.py reminiscencesoft00tangrich
+    python tag_ia_texts.py --ids-file ids.txt
+    python tag_ia_texts.py --query 'collection:americana AND subject:Nile'
+--source-dir serves books from a local directory instead of the Internet Archive (see
+DirectorySource in src/ia/sources.py), e.g. for testing without network access.
 """
-import io
-import re
+import argparse
 import json
-from internetarchive import get_files
+import os
+from src.ia.content_store import ContentStore
+from src.ia.pipeline import IngestPipeline
+from src.ia.sources import DirectorySource, InternetArchiveSource
 from src.ner.flair_ner import NamedEntityRecognizer
-from src.tei.assemble_document import create_document
-
-ia_idents = ["reminiscencesoft00tangrich"]
-
-with open('settings.json', 'r') as f:
-    settings = json.load(f)
-
-ner = NamedEntityRecognizer(
-    settings['wolfram_kernel_path'],
-    settings['content_types_precedence_order'],
-    settings['minimum_confidence'],
-)
-for ident in ia_idents:
-    files = get_files(ident, glob_pattern="*djvu.txt", formats="txt")
-    txt_file = next(files)
-    txt_file.download(file_path=f"./txt_files/{ident}.txt")
-    with open(f"./tei_files/{ident}.tei", "w") as output_file:
-        with open(f"./txt_files/{ident}.txt", "r") as book:
-            content = book.read()
-        output_file.write(create_document(ner, content))
-ner.close()
\ No newline at end of file
+from src.ner.wlflairshim import DEFAULT_BATCH_BYTES
+from src.tei.assemble_document import stream_document
+from src.utils.metrics import metrics
+
+def get_identifiers(args, source):
+    """Yield the identifiers given on the command line, in a file and matching the query"""
+    yield from args.identifiers
+    if args.ids_file:
+        with open(args.ids_file, 'r') as ids_file:
+            for line in ids_file:
+                if line.strip() != '':
+                    yield line.strip()
+    if args.query:
+        yield from source.search(args.query)
+
+def get_document_kwargs(record):
+    """Get the TEI header keyword args of create_document out of an item's metadata"""
+    metadata = record['metadata']
+    kwargs = {'title': metadata.get('title', record['identifier'])}
+    for field, kwarg in [('creator', 'author'), ('publisher', 'publisher'), ('date', 'publisher_date')]:
+        value = metadata.get(field)
+        if value:
+            # Internet Archive metadata fields can have several values; the header takes one
+            kwargs[kwarg] = value[0] if isinstance(value, list) else value
+    return kwargs
+
+if __name__ == '__main__':
+    with open('settings.json', 'r') as f:
+        settings = json.load(f)
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('identifiers', nargs='*', help='Internet Archive identifiers of books')
+    parser.add_argument('--ids-file', help='file of identifiers, one per line')
+    parser.add_argument('--query', help='Internet Archive search query of books to tag')
+    parser.add_argument('--source-dir', help='directory to get books from instead of the Internet Archive')
+    parser.add_argument('--store', default=settings.get('ia_store_dir', 'ia_store'),
+                        help='directory of the content store of downloaded books')
+    parser.add_argument('--fetch-workers', type=int, default=settings.get('ia_fetch_workers', 4),
+                        help='number of books to download at once')
+    parser.add_argument('--output-dir', default='tei_files')
+    args = parser.parse_args()
+    if not args.identifiers and not args.ids_file and not args.query:
+        parser.error('give identifiers, --ids-file or --query')
+
+    source = DirectorySource(args.source_dir) if args.source_dir else InternetArchiveSource()
+    store = ContentStore(args.store)
+    os.makedirs(args.output_dir, exist_ok=True)
+    ner = NamedEntityRecognizer(
+        settings['wolfram_kernel_path'],
+        settings['content_types_precedence_order'],
+        settings['minimum_confidence'],
+        settings['generate_tei_index'],
+        settings['tei_index_name'],
+        batch_bytes=settings.get('kernel_batch_bytes', DEFAULT_BATCH_BYTES),
+        kernel_pool_size=settings.get('kernel_pool_size', 1),
+        kernel_licence_limit=settings.get('kernel_licence_limit'),
+        tagger_cache_dir=settings.get('tagger_cache_dir'),
+        tagger_backend=settings.get('tagger_backend', 'wolfram'),
+        tagger_options=settings.get('tagger_options'),
+        prefilter=settings.get('prefilter_paragraphs', False),
+        gazetteer_mode=settings.get('gazetteer_mode', 'off'),
+        chunk_chars=settings.get('kernel_chunk_chars'),
+        chunk_overlap=settings.get('kernel_chunk_overlap', 200),
+        kernel_session_options=settings.get('kernel_session'),
+        dedup=settings.get('dedup_paragraphs', False),
+        dedup_boilerplate=settings.get('dedup_boilerplate', False)
+    )
+
+    def tag(record):
+        print(f"Tagging {record['identifier']}")
+        with open(record['path'], 'r') as book:
+            stream_document(ner, book, os.path.join(args.output_dir, f"{record['identifier']}.tei"),
+                            settings.get('use_lxml_builder', False), **get_document_kwargs(record))
+
+    pipeline = IngestPipeline(source, store, args.fetch_workers)
+    try:
+        stats = pipeline.run(get_identifiers(args, source), tag)
+    finally:
+        ner.close()
+        store.close()
+    for identifier, exception in stats['failures']:
+        print(f"Failed to download {identifier}: {exception}")
+    print(f"{stats['tagged']} tagged: {stats['downloaded']} downloaded, {stats['cached']} already "
+          f"downloaded, {stats['failed']} failed")
+    dedup_stats = ner.get_dedup_stats()
+    if dedup_stats['paragraphs']:
+        print(f"Dedup: {dedup_stats['duplicates']} duplicate and {dedup_stats['boilerplate']} boilerplate",
+              f"paragraphs of {dedup_stats['paragraphs']} not tagged ({dedup_stats['dedup_ratio']:.0%})")
+    print(metrics.format_summary())